@@ -35,8 +35,9 @@ reference to this stage in the original documentation of StaMPS.
 
 The code has been written to have only minimal dependencies on external
 libraries. The only required python libraries are `numpy` and `scipy`. The
-code will also need access to the `triangle` and `snaphu` executables, which
-are used for various Delaunay triangulations and phase unwrapping, respectively.
+code will also need access to the `snaphu` executable, which is used for phase
+unwrapping. Delaunay triangulations are computed with the `triangle`
+executable if it is installed, and with `scipy` otherwise.
 
 Note: At previous stage the code was under development and:
   - written in a single file for ease of (planned) refactoring,
@@ -74,7 +75,6 @@ import math
 
 from scipy.signal import fftconvolve, convolve2d, lfilter, firls
 from scipy.signal.windows import gaussian
-from scipy.optimize import least_squares
 from scipy.fft import fftshift, ifftshift  # FIXME: do we need these? replace by np.fft?
 from scipy.spatial import KDTree
 
@@ -82,7 +82,7 @@ from datetime import datetime, timezone, timedelta
 from contextlib import ExitStack, chdir
 from pathlib import Path
 
-from typing import TextIO, Any, Dict, Tuple, Optional, List, no_type_check
+from typing import TextIO, Any, Dict, Tuple, Optional, List, Callable, no_type_check
 from numpy.typing import NDArray as Array
 
 
@@ -100,6 +100,29 @@ VERBOSE: bool = True
 DEBUG: bool = False
 OPTIONS: Dict[str, Any] = {}
 
+# Spatial indices of PS files keyed by the resolved file path
+
+PS_INDEX_CACHE: Dict[str, Any] = {}
+
+# Compression of stored arrays (see `store_write_chunked`)
+
+STORE_CHUNK_BYTES: int = 2**22
+STORE_COMPRESS_MIN_BYTES: int = 2**20
+STORE_WORKERS: int = os.cpu_count() or 1
+
+# Columns (interferograms) per chunk of the chunked layout (see `store_write_grid`)
+
+STORE_CHUNK_COLS: int = 16
+
+# In-process cache of loaded arrays (see `store_cached_array`)
+
+STORE_CACHE: Dict[Tuple[Any, ...], Tuple[Any, Any, Tuple[int, ...]]] = {}
+STORE_CACHE_MAX_ENTRIES: int = 256
+
+# Inputs, options and outputs of the running stage (see `stage_begin`)
+
+STAGE_RECORD: Optional[Dict[str, Dict[str, Any]]] = None
+
 # Default options for the StaMPS configuration file in .toml format
 
 DEFAULT_OPTIONS: str = """
@@ -108,6 +131,7 @@ clap_beta = 0.3
 clap_low_pass_wavelength = 800
 clap_win = 32
 density_rand = 20
+deramp_grid_size = 0
 drop_ifg_index = []
 filter_grid_size = 50
 filter_weighting = 'P-square'
@@ -120,6 +144,7 @@ percent_rand = 20
 ref_centre_lonlat = "-175.179 -21.145" 
 ref_lat = "-21.155 -21.135"
 ref_lon = "-175.189 -175.169"
+ref_nearest = 0
 ref_radius = 100
 ref_x = ""
 ref_y = ""
@@ -128,9 +153,19 @@ scla_deramp = 'y'
 scla_drop_index = []
 scla_method = 'L2'
 select_method = 'DENSITY'
+skip_unchanged_stages = 'n'
 slc_osf = 1
 small_baseline_flag = 0
+snaphu_nproc = 1
+snaphu_ntilecol = 1
+snaphu_ntilerow = 1
+snaphu_tile_overlap = 0
+snaphu_workers = 1
+store_cache_mb = 1024
+store_compression = 'none'
+store_format = 'npy'
 subtr_tropo = 'n'
+triangulation_method = 'auto'
 tropo_method = 'a_l'
 unwrap_gold_alpha = 0.8
 unwrap_gold_n_win = 8
@@ -140,11 +175,13 @@ unwrap_la_error_flag = 'y'
 unwrap_method = '3D'
 unwrap_patch_phase = 'n'
 unwrap_prefilter_flag = 'y'
+unwrap_solver = 'snaphu'
 unwrap_spatial_cost_func_flag = 'n'
 unwrap_time_win = 730
 weed_max_noise = inf
 weed_neighbours = 'n'
 weed_standard_dev = 1
+weed_streaming = 'n'
 weed_time_win = 730
 weed_zero_elevation = 'n'
 """
@@ -179,6 +216,68 @@ class dotdict(dict):
     __dir__ = dict.keys  # type: ignore
 
 
+_NOT_LOADED: Any = object()
+
+
+class lazydict(dotdict):
+    """
+    A dotdict whose values are loaded on first access.
+
+    `stamps_load` returns this type so that only the keys that are used are
+    read from disk. All keys are present from the start; a key is loaded by
+    calling its loader the first time it is accessed, by item, attribute,
+    `get`, `pop`, `values` or `items`. Copies (`copy`, `copy.copy`, pickling)
+    are plain dotdicts with every key loaded.
+    """
+
+    def __init__(
+        self, data: Dict[str, Any], loaders: Dict[str, Callable[[], Any]]
+    ) -> None:
+        super().__init__(
+            {k: _NOT_LOADED if k in loaders else v for k, v in data.items()}
+        )
+        object.__setattr__(self, "_loaders", dict(loaders))
+
+    def __getitem__(self, k: str) -> Any:
+        v = dict.__getitem__(self, k)
+        if v is _NOT_LOADED:
+            v = self._loaders.pop(k)()
+            dict.__setitem__(self, k, v)
+        return v
+
+    @no_type_check
+    def __getattr__(self, x):
+        return self.get(x)
+
+    def __iter__(self) -> Any:
+        # Overriding __iter__ makes dict(), update() and ** unpacking go
+        # through keys() and __getitem__ instead of the raw values
+        return dict.__iter__(self)
+
+    @no_type_check
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    @no_type_check
+    def pop(self, k, *default):
+        if k in self:
+            self[k]
+        return dict.pop(self, k, *default)
+
+    def values(self) -> Any:
+        return [self[k] for k in self]
+
+    def items(self) -> Any:
+        return [(k, self[k]) for k in self]
+
+    def copy(self) -> dotdict:
+        return dotdict(self.items())
+
+    @no_type_check
+    def __reduce__(self):
+        return (dotdict, (dict(self.items()),))
+
+
 class PrepareData:
     """
     Base class for "Stage 0" of the StaMPS processing chain.
@@ -986,8 +1085,8 @@ def show_progress(step: int, total: int, title: Optional[str] = None) -> None:
         return
 
     def simple() -> None:
-        incr = total // 10
-        dots = incr // 3
+        incr = max(total // 10, 1)
+        dots = max(incr // 3, 1)
         perc = step // incr * 10
         if step == 0 and title:
             print(f"{title}: ", end="", flush=True)
@@ -1072,6 +1171,7 @@ def tabulate(data: dict[str, list], precision: int = 16) -> None:
 
 def run_triangle_on(fn: Path) -> None:
     """Run the Triangle program on the given file."""
+    stage_input_program(TRIANGLE)
     cmd = [TRIANGLE, "-V", "-e", str(fn)]
     base = fn.stem
     if VERBOSE:
@@ -1082,16 +1182,304 @@ def run_triangle_on(fn: Path) -> None:
             subprocess.call(cmd, stdout=out, stderr=out)
 
 
-def run_snaphu_on(fn: Path, ncol: int) -> None:
-    """Run the Snaphu program on the given file."""
+def delaunay_triangulate(xy: Array, method: str = "auto") -> Tuple[Array, Array]:
+    """
+    Delaunay triangulation of a set of 2-D points.
+
+    Returns the unique edges as an (n_edge, 2) array, with the lower node
+    first and sorted lexicographically, and the triangles as an (n_tri, 3)
+    array. Node indices are 0-based. With `method` 'triangle' the external
+    Triangle program is used, with 'scipy' the triangulation is computed
+    in-process with `scipy.spatial.Delaunay`, and with 'auto' Triangle is used
+    if its executable exists and scipy otherwise. The two can choose different
+    edges for cocircular points, e.g. PS on a regular grid.
+    """
+
+    xy = np.ascontiguousarray(xy, dtype=np.float64)
+
+    if method.lower() == "auto":
+        # Installing or removing Triangle changes the result
+        stage_input_program(TRIANGLE)
+        method = "triangle" if Path(TRIANGLE).exists() else "scipy"
+
+    if method.lower() == "triangle":
+        import tempfile
+
+        with tempfile.TemporaryDirectory(dir=".") as tmpdir:
+            nodepath = Path(tmpdir) / "delaunay.1.node"
+            with open(nodepath, "w") as fid:
+                fid.write(f"{xy.shape[0]} 2 0 0\n")
+                np.savetxt(
+                    fid,
+                    np.column_stack((np.arange(1, xy.shape[0] + 1), xy)),
+                    fmt="%d %.17g %.17g",
+                )
+
+            run_triangle_on(nodepath)
+
+            ele = np.loadtxt(
+                Path(tmpdir) / "delaunay.2.ele",
+                skiprows=1,
+                usecols=(1, 2, 3),
+                dtype=np.int64,
+                ndmin=2,
+            )
+            ele -= 1  # 0-based indexing
+
+    elif method.lower() == "scipy":
+        from scipy.spatial import Delaunay
+
+        ele = Delaunay(xy).simplices.astype(np.int64)
+
+    else:
+        raise ValueError(f"Unknown triangulation method `{method}`")
+
+    # Every triangle contributes three edges, each shared by at most two
+    # triangles, so the unique edges follow from a sort of the node pairs
+    edgs = np.vstack((ele[:, [0, 1]], ele[:, [1, 2]], ele[:, [2, 0]]))
+    edgs.sort(axis=1)
+    edgs = np.unique(edgs, axis=0)
+
+    log(f"Delaunay triangulation: {edgs.shape[0]} edges, {ele.shape[0]} triangles")
+
+    return edgs, ele
+
+
+def run_snaphu_on(fn: Path, ncol: int, cwd: Optional[Path] = None) -> None:
+    """Run the Snaphu program on the given file. If `cwd` is given, Snaphu is
+    run in that directory and its output is logged there."""
+    stage_input_program(SNAPHU)
     cmd = [SNAPHU, "-d", "-f", str(fn), str(ncol)]
-    if VERBOSE:
+    if VERBOSE and cwd is None:
         out = sys.stdout
         log(f"Running: {cmd}")
         subprocess.call(cmd, stdout=out, stderr=out)
     else:
-        with open("snaphu.log", "w") as out:
-            subprocess.call(cmd, stdout=out, stderr=out)
+        with open(Path(cwd or ".") / "snaphu.log", "w") as out:
+            subprocess.call(cmd, stdout=out, stderr=out, cwd=cwd)
+
+
+def mcf_unwrap(
+    ifgw: Array,
+    rowcost: Array,
+    colcost: Array,
+    nshortcycle: int = 200,
+) -> Array:
+    """Unwrap a gridded interferogram in-process as a minimum-cost flow.
+
+    This solves the same problem that Snaphu is given by `uw_stat_costs`. The
+    cost grids hold four int16 values per arc, as in Snaphu's COSTINFILE for
+    the DEFO cost mode: the offset and variance of the expected phase gradient
+    in units of 1/`nshortcycle` cycles, dzmax and laycost. Adding `k` cycles
+    to the wrapped gradient of an arc costs ((k * nshortcycle + offset) ** 2)
+    / sigsq. A laycost of zero or more is a cost shelf: Snaphu caps the cost
+    of the arc at laycost, here every cycle beyond the cheapest costs at most
+    laycost, the closest convex form. dzmax is not used, `uw_stat_costs` sets
+    it far beyond any correction.
+
+    The cycle corrections are flows on the dual graph, whose nodes are the
+    2x2 loops of the grid plus a ground node outside it, and must cancel the
+    residue of every loop. The exact convex costs are minimised with the
+    primal-dual algorithm: each phase finds the shortest paths from all
+    nodes with surplus flow by Dijkstra on costs reduced by node potentials,
+    then sends a maximum flow along the arcs of zero reduced cost. Both run
+    in `scipy.sparse.csgraph` on the sparse arc graph, so memory grows
+    linearly with the grid.
+
+    Parameters:
+    - ifgw: Wrapped complex interferogram, (nrow, ncol).
+    - rowcost: Snaphu row (vertical) arc costs, (nrow - 1, ncol * 4) int16.
+    - colcost: Snaphu column (horizontal) arc costs, (nrow, (ncol - 1) * 4) int16.
+    - nshortcycle: Number of cost units per phase cycle.
+
+    Returns:
+    - The unwrapped phase in radians, (nrow, ncol).
+    """
+
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra, maximum_flow
+
+    nrow, ncol = ifgw.shape
+
+    psi = np.angle(ifgw) / (2 * np.pi)
+    grad_v = np.angle(ifgw[1:, :] * np.conj(ifgw[:-1, :])) / (2 * np.pi)
+    grad_h = np.angle(ifgw[:, 1:] * np.conj(ifgw[:, :-1])) / (2 * np.pi)
+
+    # Arc costs, horizontal arcs first. Offsets are along the grid direction
+    # (Snaphu stores row arcs negated).
+    offset = np.concatenate(
+        (
+            colcost[:, 0::4].astype(np.float64).ravel(),
+            -rowcost[:, 0::4].astype(np.float64).ravel(),
+        )
+    )
+    sigsq = np.concatenate(
+        (
+            colcost[:, 1::4].astype(np.float64).ravel(),
+            rowcost[:, 1::4].astype(np.float64).ravel(),
+        )
+    )
+    sigsq[sigsq < 1] = 1
+    laycost = np.concatenate(
+        (
+            colcost[:, 3::4].astype(np.float64).ravel(),
+            rowcost[:, 3::4].astype(np.float64).ravel(),
+        )
+    )
+    shelf = np.where(laycost >= 0, laycost, np.inf)
+
+    n_h = nrow * (ncol - 1)
+    n_arc = n_h + (nrow - 1) * ncol
+
+    # Residue of each 2x2 loop, which runs right, down, left and up
+    residue = np.round(
+        grad_h[:-1, :] + grad_v[:, 1:] - grad_h[1:, :] - grad_v[:, :-1]
+    ).ravel()
+
+    # Dual graph. Loop (r, c) is node r * (ncol - 1) + c, surrounded by the
+    # ground node. A positive flow on an arc goes from the loop where the arc
+    # adds to the residue (tail) to the one where it subtracts (head).
+    n_loop = (nrow - 1) * (ncol - 1)
+    ground = n_loop
+    loop = np.full((nrow + 1, ncol + 1), ground)
+    loop[1:nrow, 1:ncol] = np.arange(n_loop).reshape(nrow - 1, ncol - 1)
+
+    tail = np.concatenate((loop[1:, 1:ncol].ravel(), loop[1:nrow, :ncol].ravel()))
+    head = np.concatenate((loop[:nrow, 1:ncol].ravel(), loop[1:nrow, 1:].ravel()))
+
+    # Arcs on the border all meet the ground node. To keep a single arc
+    # between any two nodes, each gets its own node joined to the ground by a
+    # free arc that carries the same flow.
+    border = np.concatenate(
+        (np.flatnonzero(tail == ground), np.flatnonzero(head == ground))
+    )
+    n_border = len(border)
+    aux = ground + 1 + np.arange(n_border)
+    to_ground = np.arange(n_border) >= np.sum(tail == ground)
+    tail[border[~to_ground]] = aux[~to_ground]
+    head[border[to_ground]] = aux[to_ground]
+    tail = np.concatenate((tail, np.where(to_ground, aux, ground)))
+    head = np.concatenate((head, np.where(to_ground, ground, aux)))
+
+    n_node = ground + 1 + n_border
+
+    # The cost of raising the flow of an arc from k to k + 1 is linear in k,
+    # capped by the cost shelf, and rounded to integers as in Snaphu so that
+    # zero reduced costs are exact. The free border arcs have a zero shelf.
+    slope = np.concatenate((2 * nshortcycle**2 / sigsq, np.zeros(n_border)))
+    intercept = np.concatenate(
+        ((nshortcycle**2 + 2 * nshortcycle * offset) / sigsq, np.zeros(n_border))
+    )
+    shelf = np.concatenate((shelf, np.zeros(n_border)))
+    shelf_step = np.round(shelf)
+
+    def step_cost(k: Array) -> Array:
+        return np.round(np.clip(slope * k + intercept, -shelf, shelf))
+
+    # Start every arc at its cheapest correction, so that no step is negative
+    k = np.round(-offset / nshortcycle)
+    k = np.concatenate((k, k[border]))
+
+    excess = np.zeros(n_node)
+    excess[:n_loop] = -residue
+    excess[ground] = np.sum(residue)
+    excess -= np.bincount(tail, k, minlength=n_node)
+    excess += np.bincount(head, k, minlength=n_node)
+
+    # Sparsity of the residual graph, one arc each way per arc, which only
+    # changes in its costs
+    arc_from = np.concatenate((tail, head))
+    arc_to = np.concatenate((head, tail))
+    order = np.lexsort((arc_to, arc_from))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(arc_from, minlength=n_node))))
+    indices = arc_to[order]
+
+    potential = np.zeros(n_node)
+    limit = np.inf
+    n_phase = 0
+
+    while True:
+        sources = np.flatnonzero(excess > 0)
+        if len(sources) == 0:
+            break
+        sinks = np.flatnonzero(excess < 0)
+        n_phase += 1
+
+        up = step_cost(k)
+        down = -step_cost(k - 1)
+
+        def reduced() -> Tuple[Array, Array]:
+            diff = potential[tail] - potential[head]
+            return up + diff, down - diff
+
+        graph = csr_matrix(
+            (np.concatenate(reduced())[order], indices, indptr), shape=(n_node, n_node)
+        )
+
+        # The search stops at the distance that reached the sinks in the last
+        # phase, and only goes further if no sink is reached within it
+        dist = dijkstra(graph, indices=sources, min_only=True, limit=limit)
+        reached = np.isfinite(dist)
+        if not np.any(reached[sinks]):
+            dist = dijkstra(graph, indices=sources, min_only=True)
+            reached = np.isfinite(dist)
+            if not np.any(reached[sinks]):
+                raise RuntimeError(
+                    "Minimum-cost flow unwrapping failed: no path to a sink"
+                )
+        sinks = sinks[reached[sinks]]
+        limit = 2 * max(np.max(dist[sinks]), 1.0)
+
+        # With the distances added to the potentials, the arcs of zero reduced
+        # cost are those on shortest paths, to every reached sink at once.
+        # Nodes beyond the limit are further than any reached node.
+        potential += np.minimum(dist, np.max(dist[reached]))
+
+        # Send a maximum flow along these arcs. Steps whose cost does not grow
+        # (on a cost shelf) take any flow, others one cycle per phase.
+        w_up, w_down = reduced()
+        is_up = w_up == 0
+        is_down = w_down == 0
+        adm_up = np.flatnonzero(is_up)
+        adm_down = np.flatnonzero(is_down)
+        big = np.sum(excess[sources])
+        cap_up = np.where(up[adm_up] == shelf_step[adm_up], big, 1)
+        cap_down = np.where(down[adm_down] == shelf_step[adm_down], big, 1)
+
+        source, sink = n_node, n_node + 1
+        cap = np.concatenate((cap_up, cap_down, excess[sources], -excess[sinks]))
+        arc_tail = np.concatenate(
+            (tail[adm_up], head[adm_down], np.full(len(sources), source), sinks)
+        )
+        arc_head = np.concatenate(
+            (head[adm_up], tail[adm_down], sources, np.full(len(sinks), sink))
+        )
+        flow_graph = csr_matrix(
+            (cap.astype(np.int32), (arc_tail, arc_head)),
+            shape=(n_node + 2, n_node + 2),
+        )
+        flow = maximum_flow(flow_graph, source, sink, method="dinic").flow
+
+        adm = np.flatnonzero(is_up | is_down)
+        dk = np.asarray(flow[tail[adm], head[adm]], dtype=np.float64).ravel()
+        k[adm] += dk
+        excess -= np.bincount(tail[adm], dk, minlength=n_node)
+        excess += np.bincount(head[adm], dk, minlength=n_node)
+
+    log(f"Minimum-cost flow: {n_phase} phases, {int(np.sum(np.abs(residue)))} residues")
+
+    k = k[:n_arc]
+
+    # Integrate the corrected gradients down the first column, then along rows
+    grad_h = grad_h + k[:n_h].reshape(nrow, ncol - 1)
+    grad_v = grad_v + k[n_h:].reshape(nrow - 1, ncol)
+
+    ph_uw = np.empty((nrow, ncol))
+    ph_uw[0, 0] = psi[0, 0]
+    ph_uw[1:, 0] = psi[0, 0] + np.cumsum(grad_v[:, 0])
+    ph_uw[:, 1:] = ph_uw[:, :1] + np.cumsum(grad_h, axis=1)
+
+    return ph_uw * 2 * np.pi
 
 
 def filedim(fn: Path, width: int, typestr: str) -> Tuple[int, int]:
@@ -1291,6 +1679,7 @@ def datestr(
 
 def get_psver() -> int:
     """Retrieve the PS version from the 'psver' file."""
+    stage_input_file("psver")
     with open("psver", "r") as f:
         return int(f.read().strip())
 
@@ -1301,228 +1690,1009 @@ def set_psver(version: int) -> None:
         f.write(str(version))
 
 
-def stamps_save(
-    fn: str, *args: Optional[Array | dict], **kwargs: Optional[Any]
-) -> None:
-    """Save a data file with the given name."""
+def stamps_paths(fn: str) -> Tuple[Path, Path]:
+    """
+    Paths of the data file with the given name: its store directory (one
+    `.npy` file per key and a `manifest.json`) and its legacy `.npz` file.
+    If the store directory exists, the `.npz` file is never read: it is left
+    from an earlier run and superseded by the store.
+    """
 
     assert not fn.endswith(".mat")
     assert not fn.endswith(".pkl")
 
     if fn.endswith(".npz"):
-        f = Path(fn)
-    else:
-        f = Path(f"{fn}.npz")
+        fn = fn[: -len(".npz")]
 
-    if len(args) > 0 and isinstance(args[0], np.ndarray):
-        np.savez(f, args[0])
-    else:
-        np.savez(f, **dotdict(kwargs))
+    return Path(f"{fn}.stamps"), Path(f"{fn}.npz")
 
 
-def stamps_load(fn: str, squeeze: bool = True) -> dotdict | Array:
-    """Load a data file with the given name."""
+def stamps_file(fn: str) -> Path:
+    """
+    The file that changes whenever the data file with the given name is
+    saved, i.e., the manifest of its store or its legacy `.npz` file. The
+    data file exists if and only if this file does: a store without a
+    manifest is an interrupted save.
+    """
 
-    assert not fn.endswith(".mat")
-    assert not fn.endswith(".pkl")
+    store, npz = stamps_paths(fn)
 
-    if fn.endswith(".npz"):
-        f = Path(fn)
-    else:
-        f = Path(f"{fn}.npz")
+    if store.exists():
+        return store / "manifest.json"
 
-    data = np.load(f, allow_pickle=True)  # FIXME: allow_pickle=False?
+    return npz
 
-    assert hasattr(data, "files")
 
-    if len(data.files) == 1:
-        if squeeze:
-            arr = data[data.files[0]]
-            assert isinstance(arr, np.ndarray)
-            return arr
-        else:
-            dn = "".join(x for x in fn if not x.isdigit())
-            return dotdict({dn: data[data.files[0]]})
+def store_codec(
+    name: str,
+) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    """The compression and decompression functions of a storage codec."""
 
-    dic = {}
-    for k in data.files:
-        if hasattr(data[k], "shape") and data[k].shape == ():
-            dic[k] = data[k].item()
-        else:
-            dic[k] = data[k]
-    return dotdict(dic)
+    import bz2
+    import lzma
+    import zlib
 
+    codecs: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+        "zlib": (lambda b: zlib.compress(b, 1), zlib.decompress),
+        "lzma": (lambda b: lzma.compress(b, preset=0), lzma.decompress),
+        "bz2": (lambda b: bz2.compress(b, 1), bz2.decompress),
+    }
 
-def stamps_exists(fn: str) -> bool:
-    """Check if a data file with the given name exists."""
+    if name not in codecs:
+        raise ValueError(
+            f"Unknown store_compression `{name}`, use one of: none, {', '.join(codecs)}"
+        )
 
-    assert not fn.endswith(".mat")
+    return codecs[name]
 
-    if fn.endswith(".npz"):
-        f = Path(fn)
-    else:
-        f = Path(f"{fn}.npz")
 
-    return f.exists()
+def store_write_chunked(f: Path, arr: Array, codec: str) -> Dict[str, Any]:
+    """
+    Write `arr` to `f` compressed with `codec`, in chunks of rows (along the
+    PS axis) of about `STORE_CHUNK_BYTES` each. The chunks are byte-shuffled
+    (all first bytes of the elements, then all second bytes, ...), which
+    makes floating-point and complex data compress much better, and are
+    compressed in parallel threads.
 
+    Returns the manifest entry with the codec and chunk metadata.
+    """
 
-def loadmat(fname: str) -> dotdict:
-    """Loads a .mat file."""
-    import scipy.io as sio
+    from concurrent.futures import ThreadPoolExecutor
 
-    if fname.endswith(".mat"):
-        mat = sio.loadmat(fname, squeeze_me=True)
-    else:
-        mat = sio.loadmat(fname + ".mat", squeeze_me=True)
+    compress, _ = store_codec(codec)
 
-    kvs = {k: v for k, v in mat.items() if not k.startswith("__")}
+    itemsize = arr.dtype.itemsize
+    row_bytes = max(1, arr.nbytes // max(1, arr.shape[0]))
+    chunk_rows = max(1, STORE_CHUNK_BYTES // row_bytes)
 
-    for k in kvs.keys():
-        try:
-            v = kvs[k]
-            if isinstance(v, np.ndarray) and v.size == 1:
-                v = v.flat[0]
-        except IndexError:
-            pass
-        kvs[k] = v
+    def work(start: int) -> bytes:
+        chunk = np.ascontiguousarray(arr[start : start + chunk_rows])
+        shuffled = chunk.reshape(-1).view(np.uint8).reshape(-1, itemsize).T
+        return compress(shuffled.tobytes())
 
-    return dotdict(kvs)
+    with ThreadPoolExecutor(STORE_WORKERS) as executor:
+        blobs = list(executor.map(work, range(0, arr.shape[0], chunk_rows)))
 
+    with open(f, "wb") as fid:
+        for blob in blobs:
+            fid.write(blob)
 
-def llh2local_alternate(llh: Array, origin: Array) -> Array:
+    offsets = np.cumsum([0] + [len(blob) for blob in blobs])
+
+    return {
+        "codec": codec,
+        "shuffle": True,
+        "dtype": np.lib.format.dtype_to_descr(arr.dtype),
+        "shape": list(arr.shape),
+        "chunk_rows": chunk_rows,
+        "offsets": offsets.tolist(),
+        "nbytes": int(arr.nbytes),
+    }
+
+
+def store_read_chunked(
+    f: Path, entry: Dict[str, Any], chunks: Optional[Array] = None
+) -> Array:
     """
-    Converts from longitude and latitude to local coordinates given an origin.
-    llh (lon, lat, height) and origin should be in decimal degrees.
-    Note that heights are ignored and that xy is in km.
+    Read the rows of the given `chunks` (default all) of an array written by
+    `store_write_chunked`. Only these chunks are read and decompressed, in
+    parallel threads.
     """
 
-    import pymap3d as pm  # type: ignore
+    from concurrent.futures import ThreadPoolExecutor
 
-    xy = np.zeros((2, llh.shape[1]))
-    for i, (lon, lat) in enumerate(llh.T):
-        x, y, z = pm.geodetic2enu(lat, lon, 0, origin[1], origin[0], 0)
-        xy[0, i] = x
-        xy[1, i] = y
-    return xy / 1000
+    _, decompress = store_codec(entry["codec"])
 
+    dtype = np.lib.format.descr_to_dtype(entry["dtype"])
+    shape = tuple(entry["shape"])
+    chunk_rows = entry["chunk_rows"]
+    offsets = entry["offsets"]
 
-def llh2local(llh: Array, origin: Array) -> Array:
-    """
-    Converts from longitude and latitude to local coordinates given an origin.
-    llh (lon, lat, height) and origin should be in decimal degrees.
-    Note that heights are ignored and that xy is in km.
-    """
+    if chunks is None:
+        chunks = np.arange(len(offsets) - 1)
 
-    # Set ellipsoid constants (WGS84)
+    rows = [min(chunk_rows, shape[0] - c * chunk_rows) for c in chunks]
+    starts = np.concatenate(([0], np.cumsum(rows, dtype=np.int64)))
 
-    a = 6378137.0  # semi-major axis
-    e = 0.08209443794970  # eccentricity
+    out = np.empty((int(starts[-1]),) + shape[1:], dtype=dtype)
+    flat = out.reshape(-1).view(np.uint8).reshape(-1, dtype.itemsize)
+    row_elems = int(np.prod(shape[1:], dtype=np.int64))
 
-    # Convert to radians
+    with open(f, "rb") as fid:
+        blobs = []
+        for c in chunks:
+            fid.seek(offsets[c])
+            blobs.append(fid.read(offsets[c + 1] - offsets[c]))
 
-    llh = np.deg2rad(llh)
-    origin = np.deg2rad(origin)
+    def work(i: int) -> None:
+        raw = np.frombuffer(decompress(blobs[i]), dtype=np.uint8)
+        a, b = starts[i] * row_elems, starts[i + 1] * row_elems
+        flat[a:b] = raw.reshape(dtype.itemsize, -1).T
 
-    # Initialize xy array
+    with ThreadPoolExecutor(STORE_WORKERS) as executor:
+        list(executor.map(work, range(len(blobs))))
 
-    xy = np.zeros((2, llh.shape[1]))
+    return out
 
-    # Do the projection
 
-    z = llh[1, :] != 0
-    dlambda = llh[0, z] - origin[0]
+def array_hash(arr: Array) -> str:
+    """Hash of the content, type and shape of an array."""
 
-    # calculates the meridional arc length M for each point and the origin M0, considering
-    # the ellipsoidal shape of the Earth. This involves a series expansion that accounts
-    # for the ellipsoid's eccentricity.
+    import hashlib
 
-    M = a * (
-        (1 - e**2 / 4 - 3 * e**4 / 64 - 5 * e**6 / 256) * llh[1, z]
-        - (3 * e**2 / 8 + 3 * e**4 / 32 + 45 * e**6 / 1024) * np.sin(2 * llh[1, z])
-        + (15 * e**4 / 256 + 45 * e**6 / 1024) * np.sin(4 * llh[1, z])
-        - (35 * e**6 / 3072) * np.sin(6 * llh[1, z])
-    )
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{arr.dtype.str}{arr.shape}".encode())
+    h.update(np.ascontiguousarray(arr).reshape(-1).view(np.uint8).data)
+    return h.hexdigest()
 
-    M0 = a * (
-        (1 - e**2 / 4 - 3 * e**4 / 64 - 5 * e**6 / 256) * origin[1]
-        - (3 * e**2 / 8 + 3 * e**4 / 32 + 45 * e**6 / 1024) * np.sin(2 * origin[1])
-        + (15 * e**4 / 256 + 45 * e**6 / 1024) * np.sin(4 * origin[1])
-        - (35 * e**6 / 3072) * np.sin(6 * origin[1])
-    )
 
-    N = a / np.sqrt(1 - e**2 * np.sin(llh[1, z]) ** 2)
-    E = dlambda * np.sin(llh[1, z])
+def file_hash(f: Path | str) -> str:
+    """Hash of the content of a file, or an empty string if it does not exist."""
 
-    xy[0, z] = N / np.tan(llh[1, z]) * np.sin(E)
-    xy[1, z] = M - M0 + N / np.tan(llh[1, z]) * (1 - np.cos(E))
+    import hashlib
 
-    # Handle special case of latitude = 0
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(f, "rb") as fid:
+            while block := fid.read(2**22):
+                h.update(block)
+    except FileNotFoundError:
+        return ""
+    return h.hexdigest()
 
-    dlambda = llh[0, ~z] - origin[0]
-    xy[0, ~z] = a * dlambda
-    xy[1, ~z] = -M0
 
-    # Convert to km
+def file_state(f: Path | str) -> str:
+    """Size and modification time of a file, or an empty string if it does
+    not exist. This stands in for the content hash of files that can be
+    large, such as the raw inputs of stage 1."""
 
-    xy = xy / 1000
+    try:
+        st = os.stat(f)
+    except FileNotFoundError:
+        return ""
+    return f"{st.st_size}:{st.st_mtime_ns}"
 
-    return xy
 
+def program_hash(cmd: Path | str) -> str:
+    """Path and content hash of an external program, or an empty string if
+    it is not found, so that another build or version of it is noticed."""
 
-def vincenty_direct(
-    lat0: float,
-    lon0: float,
-    distance: float,
-    bearing: float,
-    earth_semi_major_axis: float = 6378137.0,
-    earth_semi_minor_axis: float = 6356752.3141,
-) -> tuple[float, float]:
-    """Calculates the destination point (lat1, lon1) given the start point (lat0, lon0),
-    bearing (in degrees) and distance (in meters) using Vincenty's direct method.
+    import shutil
 
-    Vincety's approach is based on the assumption that the Earth is an oblate
-    spheroid, and hence are more accurate than methods that assume
-    a spherical Earth, such as great-circle distance (see `haversine_direct` function).
+    path = shutil.which(str(cmd))
+    if path is None and Path(cmd).exists():
+        path = str(cmd)
+    if path is None:
+        return ""
+
+    path = os.path.realpath(path)
+    return f"{path}:{file_hash(path)}"
+
+
+def text_hash(text: str) -> str:
+    """Hash of a string."""
+
+    import hashlib
+
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def store_cached_array(key: Tuple[Any, ...], load: Callable[[], Array]) -> Array:
+    """
+    Load an array through the in-process artifact cache.
+
+    `key` identifies the array on disk (path, inode, mtime and size of its
+    file, plus the member name for `.npz` files), so a saved file that
+    changes is never served from the cache. On a miss the array is loaded
+    with `load()` and copied into an anonymous in-memory file. Every call
+    returns a copy-on-write memory map of that file: callers may change their
+    array in place without affecting the cached data or other callers.
+
+    The cache holds at most `store_cache_mb` MB (option, 0 disables it) and
+    `STORE_CACHE_MAX_ENTRIES` arrays; the least recently used arrays are
+    evicted first. Memory-mapped `.npy` files are not cached here, as the
+    page cache of the OS already makes their repeated loads cheap.
     """
 
-    a = earth_semi_major_axis  # Semi-major axis of the Earth (meters)
-    b = earth_semi_minor_axis  # Semi-minor axis of the Earth (meters)
-    f = (a - b) / a  # Flattening of the Earth
+    import tempfile
 
-    lat0 = np.radians(lat0)
-    lon0 = np.radians(lon0)
-    alpha1 = np.radians(bearing)
-    sin_alpha1 = np.sin(alpha1)
-    cos_alpha1 = np.cos(alpha1)
+    budget = int(float(OPTIONS.get("store_cache_mb", 1024)) * 2**20)
 
-    tanU1 = (1 - f) * np.tan(lat0)
-    cosU1 = 1 / np.sqrt(1 + tanU1**2)
-    sinU1 = tanU1 * cosU1
+    if budget <= 0:
+        return load()
 
-    sigma1 = np.arctan2(tanU1, cos_alpha1)
-    sin_alpha = cosU1 * sin_alpha1
-    cos2_alpha = 1 - sin_alpha**2
-    u2 = cos2_alpha * (a**2 - b**2) / (b**2)
-    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
-    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    if key in STORE_CACHE:
+        buf, dtype, shape = STORE_CACHE.pop(key)
+        STORE_CACHE[key] = (buf, dtype, shape)
+        return np.memmap(buf, dtype=dtype, mode="c", shape=shape)
 
-    sigma = distance / (b * A)
-    sigma_p = 2 * np.pi
+    arr = load()
 
-    # Iterative calculation of sigma
+    if arr.dtype.hasobject or arr.ndim == 0 or arr.nbytes == 0 or arr.nbytes > budget:
+        return arr
 
-    while np.abs(sigma - sigma_p) > 1e-12:
-        cos2_sigma_m = np.cos(2 * sigma1 + sigma)
-        sin_sigma = np.sin(sigma)
-        cos_sigma = np.cos(sigma)
-        delta_sigma = (
-            B
-            * sin_sigma
-            * (
-                cos2_sigma_m
-                + B
-                / 4
-                * (
+    while STORE_CACHE and (
+        len(STORE_CACHE) >= STORE_CACHE_MAX_ENTRIES
+        or sum(np.prod(s, dtype=np.int64) * d.itemsize for _, d, s in STORE_CACHE.values())
+        + arr.nbytes
+        > budget
+    ):
+        STORE_CACHE.pop(next(iter(STORE_CACHE)))[0].close()
+
+    if hasattr(os, "memfd_create"):
+        buf = open(os.memfd_create("stamps_cache"), "w+b")
+    else:
+        buf = tempfile.TemporaryFile()
+
+    buf.write(np.ascontiguousarray(arr).data)
+    buf.flush()
+
+    STORE_CACHE[key] = (buf, arr.dtype, arr.shape)
+    return np.memmap(buf, dtype=arr.dtype, mode="c", shape=arr.shape)
+
+
+def store_cache_key(f: Path, *extra: str) -> Tuple[Any, ...]:
+    """The key of the file `f` (and e.g. the member of an archive) in the
+    artifact cache."""
+
+    st = f.stat()
+    return (str(f.resolve()), st.st_ino, st.st_mtime_ns, st.st_size, *extra)
+
+
+def store_write_grid(d: Path, arr: Array, codec: str) -> Dict[str, Any]:
+    """
+    Write `arr` to the directory `d` as a grid of chunks along its first two
+    axes (PS and interferograms), one file `{i}.{j}` per chunk, like a Zarr
+    array. 1-D arrays are chunked along the PS axis only. Chunks hold
+    `STORE_CHUNK_COLS` columns and about `STORE_CHUNK_BYTES` bytes, and are
+    compressed with `codec` (after byte shuffling) unless it is "none". They
+    are written in parallel threads.
+
+    Returns the manifest entry with the grid metadata.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    compress = store_codec(codec)[0] if codec != "none" else None
+
+    view = arr[:, np.newaxis] if arr.ndim == 1 else arr
+    itemsize = arr.dtype.itemsize
+    inner = int(np.prod(view.shape[2:], dtype=np.int64)) * itemsize
+    chunk_cols = min(view.shape[1], STORE_CHUNK_COLS) if view.shape[1] > 0 else 1
+    chunk_rows = max(1, STORE_CHUNK_BYTES // max(1, chunk_cols * inner))
+
+    def work(ij: Tuple[int, int]) -> None:
+        i, j = ij
+        block = np.ascontiguousarray(
+            view[
+                i * chunk_rows : (i + 1) * chunk_rows,
+                j * chunk_cols : (j + 1) * chunk_cols,
+            ]
+        )
+        data = block.reshape(-1).view(np.uint8)
+        if compress is not None:
+            data = compress(data.reshape(-1, itemsize).T.tobytes())
+        with open(d / f"{i}.{j}", "wb") as f:
+            f.write(data)
+
+    n_i = -(-view.shape[0] // chunk_rows)
+    n_j = -(-view.shape[1] // chunk_cols)
+
+    d.mkdir()
+
+    with ThreadPoolExecutor(STORE_WORKERS) as executor:
+        list(executor.map(work, [(i, j) for i in range(n_i) for j in range(n_j)]))
+
+    return {
+        "codec": codec,
+        "dtype": np.lib.format.dtype_to_descr(arr.dtype),
+        "shape": list(arr.shape),
+        "chunk_shape": [chunk_rows, chunk_cols],
+    }
+
+
+def store_read_grid(
+    d: Path,
+    entry: Dict[str, Any],
+    rows: Optional[int | slice | Array] = None,
+    cols: Optional[int | slice | Array] = None,
+) -> Array:
+    """
+    Read the given `rows` and `cols` (default all) of the first two axes of
+    an array written by `store_write_grid`, indexed as with `arr[rows, cols]`.
+    Only the chunks that hold them are read, in parallel threads. Many
+    processes can read the same array at once, as the chunk files are never
+    changed after they are written.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    decompress = store_codec(entry["codec"])[1] if entry["codec"] != "none" else None
+
+    dtype = np.lib.format.descr_to_dtype(entry["dtype"])
+    shape = tuple(entry["shape"])
+    vshape = (shape[0], 1) if len(shape) == 1 else shape
+    chunk_rows, chunk_cols = entry["chunk_shape"]
+
+    row_ix = np.arange(vshape[0])[slice(None) if rows is None else rows]
+    col_ix = np.arange(vshape[1])[slice(None) if cols is None else cols]
+    scalar_row, scalar_col = row_ix.ndim == 0, col_ix.ndim == 0
+    row_ix, col_ix = np.atleast_1d(row_ix), np.atleast_1d(col_ix)
+    row_chunk, col_chunk = row_ix // chunk_rows, col_ix // chunk_cols
+
+    out = np.empty((len(row_ix), len(col_ix)) + vshape[2:], dtype=dtype)
+
+    def is_range(ix: Array) -> bool:
+        return bool(ix[-1] - ix[0] == len(ix) - 1 and np.all(np.diff(ix) == 1))
+
+    def work(ij: Tuple[int, int]) -> None:
+        i, j = ij
+        n_rows = min(chunk_rows, vshape[0] - i * chunk_rows)
+        n_cols = min(chunk_cols, vshape[1] - j * chunk_cols)
+
+        data = (d / f"{i}.{j}").read_bytes()
+        if decompress is not None:
+            raw = np.frombuffer(decompress(data), dtype=np.uint8)
+            block = np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T).view(dtype)
+        else:
+            block = np.frombuffer(data, dtype=dtype)
+        block = block.reshape((n_rows, n_cols) + vshape[2:])
+
+        p = np.flatnonzero(row_chunk == i)
+        q = np.flatnonzero(col_chunk == j)
+        r = row_ix[p] - i * chunk_rows
+        c = col_ix[q] - j * chunk_cols
+
+        # Ranges of rows and columns (the usual case) are copied as slices
+        if is_range(p) and is_range(r) and is_range(q) and is_range(c):
+            out[p[0] : p[-1] + 1, q[0] : q[-1] + 1] = block[
+                r[0] : r[-1] + 1, c[0] : c[-1] + 1
+            ]
+        else:
+            out[p[:, np.newaxis], q] = block[r[:, np.newaxis], c]
+
+    chunks = [(i, j) for i in np.unique(row_chunk) for j in np.unique(col_chunk)]
+
+    with ThreadPoolExecutor(STORE_WORKERS) as executor:
+        list(executor.map(work, chunks))
+
+    if len(shape) == 1:
+        out = out[:, 0]
+    elif scalar_col:
+        out = out[:, 0]
+
+    return out[0] if scalar_row else out
+
+
+def store_encode(
+    store: Path, name: str, v: Any, codec: str, layout: str, stats: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Write the value `v` to the store directory `store` (as `name` and, for
+    nested values, `name.*`) and return its manifest entry.
+
+    - None, numbers and strings are kept in the entry itself.
+    - Arrays are written as `.npy` files, or compressed (see
+      `store_write_chunked`) when `codec` is not "none" and they are large.
+      With `layout` "chunked" they are written as a grid of chunks instead
+      (see `store_write_grid`).
+    - Sparse matrices are written as their index and data arrays.
+    - Dicts are written as nested entries, one per key.
+    - Object arrays (e.g. lists of arrays) are written element by element.
+
+    Only values that fit none of these are pickled. The entry of every file
+    holds the hash of its content. The files written and the compression
+    statistics are collected in `stats`.
+    """
+
+    import re
+    import shutil
+    from scipy.sparse import issparse
+
+    def write_npy(arr: Array, allow_pickle: bool = False) -> Dict[str, Any]:
+        fname = f"{name}.npy"
+        tmp = store / f".{fname}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, arr, allow_pickle=allow_pickle)
+        digest = file_hash(tmp) if allow_pickle else array_hash(arr)
+        tmp.replace(store / fname)
+        stats["files"].add(fname)
+        return {"file": fname, "pickle": allow_pickle, "hash": digest}
+
+    if v is None:
+        return {"value": None}
+
+    if issparse(v):
+        m = v if v.format in ("csr", "csc") else v.tocsr()
+        return {
+            "sparse": type(v).__name__,
+            "format": m.format,
+            "shape": list(m.shape),
+            "arrays": {
+                part: store_encode(
+                    store, f"{name}.{part}", getattr(m, part), codec, layout, stats
+                )
+                for part in ["data", "indices", "indptr"]
+            },
+        }
+
+    if isinstance(v, dict) and all(isinstance(k, str) for k in v):
+        entries = {}
+        used = set()
+        for i, (k, x) in enumerate(v.items()):
+            part = re.sub(r"[^\w\-]", "_", k)
+            if part in used:
+                part = f"{part}_{i}"
+            used.add(part)
+            entries[k] = store_encode(store, f"{name}.{part}", x, codec, layout, stats)
+        return {"dict": entries}
+
+    arr = np.asanyarray(v)
+
+    if arr.ndim == 0 and arr.dtype.kind in "biufU":
+        return {"value": arr.item()}
+
+    if arr.dtype.hasobject:
+        if isinstance(v, np.ndarray) and arr.ndim == 0:
+            return store_encode(store, name, arr.item(), codec, layout, stats)
+
+        if arr.ndim > 0:
+            return {
+                "list": [
+                    store_encode(store, f"{name}.{i}", x, codec, layout, stats)
+                    for i, x in enumerate(arr.ravel())
+                ],
+                "shape": list(arr.shape),
+            }
+
+        log(f"Storing {store.name}/{name} of type {type(v).__name__} with pickle")
+        return write_npy(arr, allow_pickle=True)
+
+    if layout == "chunked" and arr.ndim > 0 and arr.size > 0:
+        fname = f"{name}.chunks"
+        tmp = store / f".{fname}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        entry = store_write_grid(tmp, arr, codec)
+        shutil.rmtree(store / fname, ignore_errors=True)
+        tmp.replace(store / fname)
+        stats["files"].add(fname)
+        if codec != "none":
+            stats["raw_bytes"] += arr.nbytes
+            stats["stored_bytes"] += sum(
+                c.stat().st_size for c in (store / fname).iterdir()
+            )
+        return {"grid": fname, "hash": array_hash(arr), **entry}
+
+    if codec != "none" and arr.ndim > 0 and arr.nbytes >= STORE_COMPRESS_MIN_BYTES:
+        fname = f"{name}.zc"
+        tmp = store / f".{fname}.tmp"
+        entry = store_write_chunked(tmp, arr, codec)
+        tmp.replace(store / fname)
+        stats["files"].add(fname)
+        stats["raw_bytes"] += arr.nbytes
+        stats["stored_bytes"] += entry["offsets"][-1]
+        return {"file": fname, "pickle": False, "hash": array_hash(arr), **entry}
+
+    return write_npy(arr)
+
+
+def store_decode(store: Path, entry: Dict[str, Any], squeeze: bool = True) -> Any:
+    """
+    Read a value written by `store_encode` from its manifest `entry`. Arrays
+    are memory-mapped copy-on-write, compressed and chunked ones read in full, and
+    dicts returned as `lazydict`s that read their keys on first access. 0-d
+    arrays are returned as scalars, unless `squeeze` is False.
+    """
+
+    if "value" in entry:
+        return entry["value"]
+
+    if "dict" in entry:
+        entries = entry["dict"]
+        return lazydict(
+            {k: e.get("value") for k, e in entries.items()},
+            {
+                k: (lambda e=e: store_decode(store, e))
+                for k, e in entries.items()
+                if "value" not in e
+            },
+        )
+
+    if "sparse" in entry:
+        import scipy.sparse
+
+        parts = {k: store_decode(store, e) for k, e in entry["arrays"].items()}
+        matrix = (
+            scipy.sparse.csc_matrix if entry["format"] == "csc" else scipy.sparse.csr_matrix
+        )
+        m = matrix(
+            (parts["data"], parts["indices"], parts["indptr"]),
+            shape=tuple(entry["shape"]),
+        )
+        cls = getattr(scipy.sparse, entry["sparse"], None)
+        if isinstance(cls, type) and entry["sparse"].endswith(("_matrix", "_array")):
+            m = cls(m)
+        return m
+
+    if "list" in entry:
+        arr = np.empty(len(entry["list"]), dtype=object)
+        for i, e in enumerate(entry["list"]):
+            arr[i] = store_decode(store, e)
+        return arr.reshape(entry["shape"])
+
+    if "grid" in entry:
+        d = store / entry["grid"]
+        return store_cached_array(
+            (str(d.resolve()), entry["hash"]), lambda: store_read_grid(d, entry)
+        )
+
+    f = store / entry["file"]
+
+    if "codec" in entry:
+        t0 = time.perf_counter()
+        arr = store_cached_array(
+            store_cache_key(f), lambda: store_read_chunked(f, entry)
+        )
+        if DEBUG:
+            elapsed = time.perf_counter() - t0
+            log(
+                f"Loaded {store.name}/{entry['file']} with {entry['codec']} at "
+                f"{arr.nbytes / 2**20 / elapsed:.0f} MB/s"
+            )
+    elif entry["pickle"]:
+        arr = np.load(f, allow_pickle=True)
+    else:
+        arr = np.load(f, mmap_mode="c", allow_pickle=False)
+
+    if squeeze and arr.shape == ():
+        return arr.item()
+
+    return arr
+
+
+def stamps_save(
+    fn: str, *args: Optional[Array | dict], **kwargs: Optional[Any]
+) -> None:
+    """
+    Save a data file with the given name.
+
+    The data is stored in the directory `{fn}.stamps`, with one `.npy` file per
+    array and a JSON manifest listing the keys. Scalars (numbers, strings and
+    None) are kept in the manifest itself, sparse matrices and dicts are
+    stored as their parts (see `store_encode`), so that nothing needs to be
+    pickled. Every file is written to a temporary name and renamed, so arrays
+    of a previous version that are still memory-mapped stay intact. The
+    manifest is removed first and written last, so an interrupted save never
+    leaves a valid-looking file. A legacy `.npz` file of the same name is
+    left in place, but no longer read (see `stamps_paths`).
+    The manifest also holds a hash of the whole content (see `stamps_hash`).
+
+    With the option `store_compression` set to a codec (zlib, lzma or bz2),
+    arrays of at least `STORE_COMPRESS_MIN_BYTES` are instead written
+    compressed in chunks along their first (PS) axis, see
+    `store_write_chunked`.
+
+    The option `store_format` selects the layout: "npy" (the default) as
+    above, "chunked" to write arrays as a grid of chunks along the PS and
+    interferogram axes (see `store_write_grid`), so that ranges of both can be
+    read cheaply, or "npz" to write a single legacy `.npz` file instead of
+    the store.
+    """
+
+    import json
+    import shutil
+
+    store, npz = stamps_paths(fn)
+    codec = str(OPTIONS.get("store_compression", "none"))
+    layout = str(OPTIONS.get("store_format", "npy"))
+    stats: Dict[str, Any] = {"files": set(), "raw_bytes": 0, "stored_bytes": 0}
+    t0 = time.perf_counter()
+
+    if len(args) > 0 and isinstance(args[0], np.ndarray):
+        data = {"arr_0": args[0]}
+    else:
+        data = dict(kwargs)
+
+    if layout not in ("npy", "chunked", "npz"):
+        raise ValueError(
+            f"Unknown store_format `{layout}`, use one of: npy, chunked, npz"
+        )
+
+    if layout == "npz":
+        shutil.rmtree(store, ignore_errors=True)
+        tmp = npz.with_name(f".{npz.name}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, **data)
+        tmp.replace(npz)
+        if STAGE_RECORD is not None:
+            STAGE_RECORD["outputs"][stamps_name(fn)] = file_hash(npz)
+        return
+
+    # Without a manifest the data file does not exist, so an interrupted save
+    # never looks like a valid one. A legacy `.npz` file is kept, but as the
+    # store exists it is no longer read.
+
+    if npz.exists():
+        log(f"Saving {fn} to {store}, the existing {npz} is no longer used")
+
+    store.mkdir(exist_ok=True)
+    (store / "manifest.json").unlink(missing_ok=True)
+
+    keys = {k: store_encode(store, k, v, codec, layout, stats) for k, v in data.items()}
+
+    manifest: Dict[str, Any] = {
+        "format": 3,
+        "hash": text_hash(json.dumps(keys, sort_keys=True)),
+        "keys": keys,
+    }
+
+    # Remove the arrays of keys that are no longer saved
+
+    for f in [*store.glob("*.npy"), *store.glob("*.zc"), *store.glob("*.chunks")]:
+        if f.name not in stats["files"]:
+            if f.is_dir():
+                shutil.rmtree(f)
+            else:
+                f.unlink()
+
+    tmp = store / ".manifest.json.tmp"
+    tmp.write_text(json.dumps(manifest))
+    tmp.replace(store / "manifest.json")
+
+    if STAGE_RECORD is not None:
+        STAGE_RECORD["outputs"][stamps_name(fn)] = manifest["hash"]
+
+    raw_bytes, stored_bytes = stats["raw_bytes"], stats["stored_bytes"]
+
+    if raw_bytes > 0:
+        elapsed = time.perf_counter() - t0
+        log(
+            f"Saved {store.name} ({layout}) with {codec}: "
+            f"{raw_bytes / 2**20:.1f} MB to "
+            f"{stored_bytes / 2**20:.1f} MB ({raw_bytes / max(stored_bytes, 1):.2f}x) "
+            f"at {raw_bytes / 2**20 / elapsed:.0f} MB/s"
+        )
+
+
+def stamps_load(fn: str, squeeze: bool = True) -> dotdict | Array:
+    """
+    Load a data file with the given name.
+
+    Data is loaded lazily: the returned `lazydict` reads each key on its first
+    access. Arrays in a store directory are memory-mapped copy-on-write, so
+    only the parts that are used are read from disk, and changing them does
+    not change the file. Compressed arrays are decompressed in full on their
+    first access; use `stamps_load_rows` to read only some of their rows.
+    Decompressed arrays and arrays of legacy `.npz` files are kept in an
+    in-process cache (see `store_cached_array`), so that loading them again
+    in a later stage or function is free.
+    Nothing is unpickled, except values that `store_encode` could not store
+    otherwise. Legacy `.npz` files are read one key at a time.
+    """
+
+    import json
+
+    store, npz = stamps_paths(fn)
+
+    if STAGE_RECORD is not None:
+        stage_record_input(stamps_name(fn), lambda: stamps_hash(fn))
+
+    if store.exists():
+        manifest = json.loads((store / "manifest.json").read_text())
+        entries = manifest["keys"]
+
+        def read(k: str, squeeze: bool = True) -> Any:
+            return store_decode(store, entries[k], squeeze)
+
+        keys = list(entries)
+        values = {k: e["value"] for k, e in entries.items() if "value" in e}
+
+    else:
+        # Legacy files can hold pickled objects (e.g. sparse matrices and None)
+        data = np.load(npz, allow_pickle=True)
+
+        assert hasattr(data, "files")
+
+        def read(k: str, squeeze: bool = True) -> Any:
+            x = store_cached_array(store_cache_key(npz, k), lambda: data[k])
+            if squeeze and x.shape == ():
+                return x.item()
+            return x
+
+        keys = list(data.files)
+        values = {}
+
+    if len(keys) == 1:
+        if keys[0] in values:
+            arr = np.array(values[keys[0]])
+        else:
+            arr = read(keys[0], squeeze=False)
+            if not isinstance(arr, np.ndarray):
+                value, arr = arr, np.empty((), dtype=object)
+                arr[()] = value
+        if squeeze:
+            return arr
+        else:
+            dn = "".join(x for x in fn if not x.isdigit())
+            return dotdict({dn: arr})
+
+    loaders = {k: (lambda k=k: read(k)) for k in keys if k not in values}
+
+    return lazydict({k: values.get(k) for k in keys}, loaders)
+
+
+def stamps_load_rows(
+    fn: str, key: str, rows: slice | Array, cols: Optional[slice | Array] = None
+) -> Array:
+    """
+    Load the given rows (first axis, usually the PS) and optionally columns
+    (second axis, usually the interferograms) of the array `key` of a data
+    file. Of compressed and chunked arrays only the chunks holding these are
+    read and decompressed; uncompressed ones are read through a memory map.
+    """
+
+    import json
+
+    store, npz = stamps_paths(fn)
+
+    def select_cols(x: Array) -> Array:
+        if cols is None:
+            return x
+        return x[cols] if isinstance(rows, (int, np.integer)) else x[:, cols]
+
+    if not store.exists():
+        with np.load(npz, allow_pickle=True) as data:
+            return select_cols(data[key][rows])
+
+    manifest = json.loads((store / "manifest.json").read_text())
+    entry = manifest["keys"][key]
+
+    if "grid" in entry:
+        if len(entry["shape"]) == 1:
+            return select_cols(store_read_grid(store / entry["grid"], entry, rows))
+        return store_read_grid(store / entry["grid"], entry, rows, cols)
+
+    if "codec" not in entry:
+        x = np.load(store / entry["file"], mmap_mode="r")[rows]
+        return np.array(select_cols(x))
+
+    n_rows = entry["shape"][0]
+    ix = np.arange(n_rows)[rows]
+    chunks = np.unique(ix // entry["chunk_rows"])
+
+    # Rows of the decompressed chunks, in the order of the requested rows
+    chunk_start = np.searchsorted(chunks, ix // entry["chunk_rows"])
+    local = chunk_start * entry["chunk_rows"] + ix % entry["chunk_rows"]
+
+    return select_cols(store_read_chunked(store / entry["file"], entry, chunks)[local])
+
+
+def stamps_name(fn: str) -> str:
+    """The normalised name of a data file, e.g. `ps1` for `./ps1.npz`."""
+
+    return os.path.normpath(str(stamps_paths(fn)[1]))[: -len(".npz")]
+
+
+def stamps_hash(fn: str) -> str:
+    """
+    Hash of the content of the data file with the given name, or an empty
+    string if it does not exist. For stores this is the hash recorded in the
+    manifest when saving; legacy `.npz` files are hashed in full.
+    """
+
+    import json
+
+    store, npz = stamps_paths(fn)
+
+    if store.exists():
+        if not (store / "manifest.json").exists():
+            return ""
+        manifest = json.loads((store / "manifest.json").read_text())
+        if "hash" in manifest:
+            return manifest["hash"]
+        files = sorted(store.glob("*.npy")) + sorted(store.glob("*.zc"))
+        return text_hash(
+            json.dumps(manifest["keys"], sort_keys=True)
+            + "".join(file_hash(f) for f in files)
+        )
+
+    return file_hash(npz)
+
+
+def stamps_exists(fn: str) -> bool:
+    """Check if a data file with the given name exists."""
+
+    return stamps_file(fn).exists()
+
+
+def stamps_remove(fn: str) -> None:
+    """Remove the data file with the given name, if it exists."""
+
+    import shutil
+
+    store, npz = stamps_paths(fn)
+
+    shutil.rmtree(store, ignore_errors=True)
+    npz.unlink(missing_ok=True)
+
+
+def loadmat(fname: str) -> dotdict:
+    """Loads a .mat file."""
+    import scipy.io as sio
+
+    if fname.endswith(".mat"):
+        mat = sio.loadmat(fname, squeeze_me=True)
+    else:
+        mat = sio.loadmat(fname + ".mat", squeeze_me=True)
+
+    kvs = {k: v for k, v in mat.items() if not k.startswith("__")}
+
+    for k in kvs.keys():
+        try:
+            v = kvs[k]
+            if isinstance(v, np.ndarray) and v.size == 1:
+                v = v.flat[0]
+        except IndexError:
+            pass
+        kvs[k] = v
+
+    return dotdict(kvs)
+
+
+def llh2local_alternate(llh: Array, origin: Array) -> Array:
+    """
+    Converts from longitude and latitude to local coordinates given an origin.
+    llh (lon, lat, height) and origin should be in decimal degrees.
+    Note that heights are ignored and that xy is in km.
+    """
+
+    import pymap3d as pm  # type: ignore
+
+    xy = np.zeros((2, llh.shape[1]))
+    for i, (lon, lat) in enumerate(llh.T):
+        x, y, z = pm.geodetic2enu(lat, lon, 0, origin[1], origin[0], 0)
+        xy[0, i] = x
+        xy[1, i] = y
+    return xy / 1000
+
+
+def llh2local(llh: Array, origin: Array) -> Array:
+    """
+    Converts from longitude and latitude to local coordinates given an origin.
+    llh (lon, lat, height) and origin should be in decimal degrees.
+    Note that heights are ignored and that xy is in km.
+    """
+
+    # Set ellipsoid constants (WGS84)
+
+    a = 6378137.0  # semi-major axis
+    e = 0.08209443794970  # eccentricity
+
+    # Convert to radians
+
+    llh = np.deg2rad(llh)
+    origin = np.deg2rad(origin)
+
+    # Initialize xy array
+
+    xy = np.zeros((2, llh.shape[1]))
+
+    # Do the projection
+
+    z = llh[1, :] != 0
+    dlambda = llh[0, z] - origin[0]
+
+    # calculates the meridional arc length M for each point and the origin M0, considering
+    # the ellipsoidal shape of the Earth. This involves a series expansion that accounts
+    # for the ellipsoid's eccentricity.
+
+    M = a * (
+        (1 - e**2 / 4 - 3 * e**4 / 64 - 5 * e**6 / 256) * llh[1, z]
+        - (3 * e**2 / 8 + 3 * e**4 / 32 + 45 * e**6 / 1024) * np.sin(2 * llh[1, z])
+        + (15 * e**4 / 256 + 45 * e**6 / 1024) * np.sin(4 * llh[1, z])
+        - (35 * e**6 / 3072) * np.sin(6 * llh[1, z])
+    )
+
+    M0 = a * (
+        (1 - e**2 / 4 - 3 * e**4 / 64 - 5 * e**6 / 256) * origin[1]
+        - (3 * e**2 / 8 + 3 * e**4 / 32 + 45 * e**6 / 1024) * np.sin(2 * origin[1])
+        + (15 * e**4 / 256 + 45 * e**6 / 1024) * np.sin(4 * origin[1])
+        - (35 * e**6 / 3072) * np.sin(6 * origin[1])
+    )
+
+    N = a / np.sqrt(1 - e**2 * np.sin(llh[1, z]) ** 2)
+    E = dlambda * np.sin(llh[1, z])
+
+    xy[0, z] = N / np.tan(llh[1, z]) * np.sin(E)
+    xy[1, z] = M - M0 + N / np.tan(llh[1, z]) * (1 - np.cos(E))
+
+    # Handle special case of latitude = 0
+
+    dlambda = llh[0, ~z] - origin[0]
+    xy[0, ~z] = a * dlambda
+    xy[1, ~z] = -M0
+
+    # Convert to km
+
+    xy = xy / 1000
+
+    return xy
+
+
+def vincenty_direct(
+    lat0: float,
+    lon0: float,
+    distance: float,
+    bearing: float,
+    earth_semi_major_axis: float = 6378137.0,
+    earth_semi_minor_axis: float = 6356752.3141,
+) -> tuple[float, float]:
+    """Calculates the destination point (lat1, lon1) given the start point (lat0, lon0),
+    bearing (in degrees) and distance (in meters) using Vincenty's direct method.
+
+    Vincety's approach is based on the assumption that the Earth is an oblate
+    spheroid, and hence are more accurate than methods that assume
+    a spherical Earth, such as great-circle distance (see `haversine_direct` function).
+    """
+
+    a = earth_semi_major_axis  # Semi-major axis of the Earth (meters)
+    b = earth_semi_minor_axis  # Semi-minor axis of the Earth (meters)
+    f = (a - b) / a  # Flattening of the Earth
+
+    lat0 = np.radians(lat0)
+    lon0 = np.radians(lon0)
+    alpha1 = np.radians(bearing)
+    sin_alpha1 = np.sin(alpha1)
+    cos_alpha1 = np.cos(alpha1)
+
+    tanU1 = (1 - f) * np.tan(lat0)
+    cosU1 = 1 / np.sqrt(1 + tanU1**2)
+    sinU1 = tanU1 * cosU1
+
+    sigma1 = np.arctan2(tanU1, cos_alpha1)
+    sin_alpha = cosU1 * sin_alpha1
+    cos2_alpha = 1 - sin_alpha**2
+    u2 = cos2_alpha * (a**2 - b**2) / (b**2)
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+
+    sigma = distance / (b * A)
+    sigma_p = 2 * np.pi
+
+    # Iterative calculation of sigma
+
+    while np.abs(sigma - sigma_p) > 1e-12:
+        cos2_sigma_m = np.cos(2 * sigma1 + sigma)
+        sin_sigma = np.sin(sigma)
+        cos_sigma = np.cos(sigma)
+        delta_sigma = (
+            B
+            * sin_sigma
+            * (
+                cos2_sigma_m
+                + B
+                / 4
+                * (
                     cos_sigma * (-1 + 2 * cos2_sigma_m**2)
                     - B
                     / 6
@@ -1734,9 +2904,14 @@ def getparm(parmname: Optional[str] = None, verbose: bool = False) -> str:
     """Retrieves a parameter value from parameter files."""
 
     if parmname in OPTIONS:
+        if STAGE_RECORD is not None and parmname not in STAGE_RECORD["set_options"]:
+            STAGE_RECORD["options"].setdefault(parmname, str(OPTIONS[parmname]))
         return str(OPTIONS[parmname])
     else:
         log(f"Parameter {parmname} not found in OPTIONS")
+        # The value comes from the parameter files, which are recorded below
+        if STAGE_RECORD is not None and parmname is not None:
+            STAGE_RECORD["options"].setdefault(parmname, None)
 
     # TODO: Remove the following old code:
 
@@ -1757,9 +2932,13 @@ def getparm(parmname: Optional[str] = None, verbose: bool = False) -> str:
     else:
         raise FileNotFoundError(f"`{parmfile}` not found")
 
+    stage_input_file(Path("parms.mat"))
+    stage_input_file(parmfile)
+
     # Load local parameters, if available
 
     localparmfile = Path("localparms.mat")
+    stage_input_file(localparmfile)
     if localparmfile.exists():
         localparms = loadmat(str(localparmfile))
     else:
@@ -1797,6 +2976,9 @@ def setparm(parmname: str, value: Any) -> None:
 
     OPTIONS[parmname] = value
 
+    if STAGE_RECORD is not None:
+        STAGE_RECORD["set_options"][parmname] = value
+
     return
 
     # FIXME: Write to disk as toml?
@@ -2371,11 +3553,16 @@ def stage1_load_data(endian: str = "b", opts: dotdict = dotdict()) -> None:
     rscname = Path("../rsc.txt")  # config with master rslc.par file location
     pscname = Path("../pscphase.in")  # config with width and diff phase file locataions
 
+    for fn in [phname, ijname, llname, hgtname, daname, rscname, pscname]:
+        stage_input_file(fn)
+
     # Read master day from rsc file
 
     with rscname.open() as f:
         rslcpar = Path(f.readline().strip())
 
+    stage_input_file(rslcpar)
+
     log(f"{rslcpar = }")
 
     log(f"Reading inteferogram dates from `{pscname.resolve()}`")
@@ -2474,6 +3661,7 @@ def stage1_load_data(endian: str = "b", opts: dotdict = dotdict()) -> None:
 
     for i in range(n_ifg):
         basename = ifgs[i].with_suffix(".base")
+        stage_input_file(basename)
 
         B_TCN = np.array(
             [float(x) for x in read_params(basename, "initial_baseline(TCN)", 3)]
@@ -3155,6 +4343,7 @@ def stage3_select_ps(reest_flag: int = 0, opts: dotdict = dotdict()) -> None:
     log("# Stage 3: selecting PS based on coherence and phase stability")
 
     # Reading candidate coherence threshold from file
+    stage_input_file("../selpsc.in")
     with open("../selpsc.in", "r") as fd:
         cand_coh_thresh = float(fd.readline().strip())
     log(f"{cand_coh_thresh = :.3f} (candidate coherence threshold)")
@@ -3704,6 +4893,7 @@ def stage4_weed_ps(
 
     # Load hardcoded pixels
     input_azrg = Path("../input_azrg")
+    stage_input_file(input_azrg)
     if input_azrg.exists():
         forced_ij = np.loadtxt(str(input_azrg), dtype=int)
         log(f"loaded {forced_ij.shape[0]} hardcoded pixels from `input_azrg`")
@@ -3716,6 +4906,7 @@ def stage4_weed_ps(
     weed_max_noise = float(getparm("weed_max_noise"))
     weed_zero_elevation = getparm("weed_zero_elevation")  # string
     weed_neighbours = getparm("weed_neighbours")  # string
+    weed_streaming = getparm("weed_streaming")  # string
     small_baseline_flag = getparm("small_baseline_flag")  # string
 
     drop_ifg_index = eval(getparm("drop_ifg_index"))  # FIXME?
@@ -3726,6 +4917,7 @@ def stage4_weed_ps(
     log(f"{weed_max_noise = } (max noise)")
     log(f"{weed_zero_elevation = } (zero elevation)")
     log(f"{weed_neighbours = } (neighbours)")
+    log(f"{weed_streaming = } (streaming edge blocks)")
     log(f"{drop_ifg_index = } (interferogram indices to drop)")
     log(f"{small_baseline_flag = } (small baseline flag)")
 
@@ -3920,22 +5112,16 @@ def stage4_weed_ps(
 
     log("Removing duplicated points")
 
+    # Sort by x, then y, then by decreasing coherence so that the first PS of
+    # each run of identical coordinates is the one to keep. The sort is stable,
+    # so ties in coherence keep the lowest index as `np.argmax` would.
     ix_weed_num = np.where(ix_weed)[0]
-    _, unique_indices = np.unique(xy_weed[:, 1:], axis=0, return_index=True)
-    dups = np.setdiff1d(
-        np.arange(np.sum(ix_weed)), unique_indices
-    )  # pixels with duplicate lon/lat
-
-    for i in range(len(dups)):
-        dups_ix_weed = np.where(
-            (xy_weed[:, 1] == xy_weed[dups[i], 1])
-            & (xy_weed[:, 2] == xy_weed[dups[i], 2])
-        )[0]
-        dups_ix = ix_weed_num[dups_ix_weed]
-        max_coh_ix = np.argmax(coh_ps2[dups_ix])
-        ix_weed[dups_ix[np.arange(len(dups_ix)) != max_coh_ix]] = (
-            False  # drop dups with lowest coh
-        )
+    sort_ix = np.lexsort((-coh_ps2[ix_weed_num], xy_weed[:, 2], xy_weed[:, 1]))
+    xy_sorted = xy_weed[sort_ix, 1:]
+    same_xy = np.all(xy_sorted[1:] == xy_sorted[:-1], axis=1)
+    dups = sort_ix[1:][same_xy]  # pixels with duplicate lon/lat
+
+    ix_weed[ix_weed_num[dups]] = False  # drop dups with lowest coh
 
     if len(dups) > 0:
         xy_weed = xy2[ix_weed, :]
@@ -3952,39 +5138,13 @@ def stage4_weed_ps(
 
     ps_std = np.zeros(n_ps)
     ps_max = np.zeros(n_ps)
+    ps_degree = np.zeros(n_ps, dtype=np.int32)
 
     if n_ps > 0 and not no_weed_noisy:
-        if Path(TRIANGLE).exists():
-            nodename = "psweed.1.node"
-            with open(nodename, "w") as fid:
-                fid.write(f"{n_ps} 2 0 0\n")
-                for i in range(n_ps):
-                    fid.write(f"{i+1} {xy_weed[i, 1]} {xy_weed[i, 2]}\n")
-
-            if DEBUG:
-                subprocess.call([TRIANGLE, "-e", "psweed.1.node"], stdout=sys.stdout)
-            else:
-                subprocess.call(
-                    [TRIANGLE, "-e", "psweed.1.node"],
-                    stdout=open("triangle_weed.log", "w"),
-                )
-
-            with open("psweed.2.edge", "r") as fid:
-                header = np.fromstring(fid.readline().strip(), sep=" ")
-                n = int(header[0])
-                log(f"{n} edges found")
-                edgs = np.zeros((n, 4), dtype=int)
-                for i in range(n):
-                    edgs[i, :] = np.fromstring(fid.readline().strip(), sep=" ")
-                edgs = edgs[:, 1:3] - 1  # 0-based indexing
-
-        else:
-            # use Delaunay triangulation from scipy
-            from scipy.spatial import Delaunay
-
-            xy_weed = xy_weed.astype(float)
-            tri = Delaunay(xy_weed[:, 1:3])
-            edgs = tri.simplices.copy()
+        edgs, _ = delaunay_triangulate(
+            xy_weed[:, 1:3], method=getparm("triangulation_method")
+        )
+        log(f"{edgs.shape[0]} edges found")
 
         n_edge = edgs.shape[0]
 
@@ -4000,8 +5160,18 @@ def stage4_weed_ps(
         # Noise estimation for edges
         edge_std = np.zeros(n_edge)
         edge_max = np.zeros(n_edge)
-        dph_space = ph_weed[edgs[:, 1], :] * np.conj(ph_weed[edgs[:, 0], :])
-        dph_space = dph_space[:, ifg_index]
+
+        # In streaming mode the edge phases are formed block by block and
+        # never held for all edges at once
+        streaming = (
+            weed_streaming.lower() == "y" and small_baseline_flag.lower() != "y"
+        )
+
+        if streaming:
+            ph_weed = ph_weed[:, ifg_index]
+        else:
+            dph_space = ph_weed[edgs[:, 1], :] * np.conj(ph_weed[edgs[:, 0], :])
+            dph_space = dph_space[:, ifg_index]
 
         n_use = len(ifg_index)
         for i in drop_ifg_index:
@@ -4014,7 +5184,14 @@ def stage4_weed_ps(
                 ds = datetime.strptime(str(day[i]), "%Y%m%d").strftime("%Y-%m-%d")
                 log(f"{ds} dropped from noise estimation")
 
-        if not small_baseline_flag.lower() == "y":
+        if streaming:
+            log(f"Estimating noise for {n_use} arcs in edge blocks:")
+
+            edge_std, edge_max = weed_edge_noise_streaming(
+                ph_weed, edgs, day[ifg_index], bperp[ifg_index], time_win
+            )
+
+        elif not small_baseline_flag.lower() == "y":
             log(f"Estimating noise for {n_use} arcs:")
 
             # This section performs noise estimation for all edges in a set of
@@ -4024,57 +5201,24 @@ def stage4_weed_ps(
             # temporal changes and estimates DEM error to further refine the
             # noise estimates.
 
-            # Initialize arrays to store smoothed differential phase values
+            # The Gaussian time weights only depend on the interferogram
+            # dates, so they are computed once for all interferograms and
+            # edges. The smoothing is then done in blocks of edges to bound
+            # the memory used by the (n_block, n_use, n_use) phase residuals.
+            time_diff, weight = weed_time_weights(day[ifg_index], time_win)
+
             dph_smooth = np.zeros((n_edge, n_use), dtype=np.complex64)
             dph_smooth2 = np.zeros((n_edge, n_use), dtype=np.complex64)
 
-            for i1 in range(n_use):
-                # Calculate time differences between the current interferogram
-                # and all others
-                time_diff = day[ifg_index[i1]] - day[ifg_index]
-
-                # Calculate weighting factors based on time differences, using a
-                # Gaussian function
-                weight_factor = np.exp(-(time_diff**2) / (2 * time_win**2))
-                weight_factor /= np.sum(weight_factor)  # Normalize
-
-                # Compute the mean differential phase for each edge, weighted by
-                # time proximity
-                dph_mean = np.sum(dph_space * weight_factor[None, :], axis=1)
-
-                # Adjust the mean differential phase by subtracting the weighted
-                # mean from each value
-                dph_mean_adj = np.angle(dph_space * np.conj(dph_mean[:, None]))
-
-                # Prepare a design matrix for linear regression, including a
-                # constant term and time differences
-                G = np.vstack([np.ones(n_use), time_diff]).T
-
-                # Perform weighted linear least squares to fit the adjusted mean
-                # differential phase
-                m = lscov(G, dph_mean_adj.T, weight_factor)
-
-                # Update the adjusted mean differential phase by subtracting the
-                # linear fit
-                dph_mean_adj = np.angle(np.exp(1j * (dph_mean_adj - (G @ m).T)))
-
-                # Perform a second round of weighted linear least squares on the
-                # updated adjusted mean differential phase
-                m2 = lscov(G, dph_mean_adj.T, weight_factor)
-
-                # Combine the original mean phase with the corrections from both
-                # rounds of linear regression
-                dph_smooth[:, i1] = dph_mean * np.exp(1j * (m[0] + m2[0]))
-
-                # Zero out the weight factor for the current interferogram to
-                # exclude it from its own smoothing
-                weight_factor[i1] = 0
-
-                # Recalculate the smoothed differential phase without the
-                # current interferogram
-                dph_smooth2[:, i1] = np.sum(dph_space * weight_factor[None, :], axis=1)
-
-                show_progress(i1, n_use)
+            block_size = weed_block_size(n_use)
+            n_block = int(np.ceil(n_edge / block_size))
+            for ib in range(n_block):
+                i1 = ib * block_size
+                i2 = min(i1 + block_size, n_edge)
+                dph_smooth[i1:i2], dph_smooth2[i1:i2] = weed_smooth_edges(
+                    dph_space[i1:i2], time_diff, weight
+                )
+                show_progress(ib, n_block)
 
             # Calculate the noise by subtracting the smoothed phase from the
             # original differential phase
@@ -4132,15 +5276,20 @@ def stage4_weed_ps(
 
         log("Estimating max noise for all pixels")
 
+        # Each PS takes the minimum noise over the edges at either of its ends
+        nodes = edgs.ravel()
         ps_std = np.full(n_ps, np.inf, dtype=np.float32)
         ps_max = np.full(n_ps, np.inf, dtype=np.float32)
-        for i in range(n_edge):
-            ps_std[edgs[i, :]] = np.minimum(
-                ps_std[edgs[i, :]], [edge_std[i], edge_std[i], edge_std[i]]
-            )
-            ps_max[edgs[i, :]] = np.minimum(
-                ps_max[edgs[i, :]], [edge_max[i], edge_max[i], edge_max[i]]
-            )
+        np.minimum.at(ps_std, nodes, np.repeat(edge_std, 2))
+        np.minimum.at(ps_max, nodes, np.repeat(edge_max, 2))
+
+        # Number of edges connected to each PS, kept for quality assessment
+        ps_degree = np.bincount(nodes, minlength=n_ps).astype(np.int32)
+
+        log(
+            f"Edges per PS: min {np.min(ps_degree)}, "
+            f"median {np.median(ps_degree):.0f}, max {np.max(ps_degree)}"
+        )
 
         ix_weed2 = (ps_std < weed_standard_dev) & (ps_max < weed_max_noise)
         ix_weed[ix_weed] = ix_weed2
@@ -4170,6 +5319,7 @@ def stage4_weed_ps(
         ix_weed2=ix_weed2,
         ps_std=ps_std,
         ps_max=ps_max,
+        ps_degree=ps_degree,  # number of edges per PS (n_ps,) - count
         ifg_index=ifg_index + 1,  # Back to 1-based indexing
     )
 
@@ -4189,53 +5339,305 @@ def stage4_weed_ps(
         C_ps=C_ps,  # static phase offset (n_ps,) - radians
     )
 
-    # Prepare phase data for saving
-    ph2 = ph2[ix_weed, :]
-    stamps_save(f"ph{psver+1}", ph2)  # phase data (n_ps, n_ifg) - complex
+    # Prepare phase data for saving
+    ph2 = ph2[ix_weed, :]
+    stamps_save(f"ph{psver+1}", ph2)  # phase data (n_ps, n_ifg) - complex
+
+    # Update PS information with weed results
+    xy2 = xy2[ix_weed, :]
+    ij2 = ij2[ix_weed, :]
+    lonlat2 = lonlat2[ix_weed, :]
+
+    ps.update({"xy": xy2, "ij": ij2, "lonlat": lonlat2, "n_ps": ph2.shape[0]})
+    psname = f"ps{psver + 1}"
+    stamps_save(psname, ps)  # phase data (n_ps, n_ifg) - complex
+
+    # Process and save height data if available
+    if stamps_exists(f"hgt{psver}"):
+        hgt = hgt[ix_weed]
+        stamps_save(f"hgt{psver + 1}", hgt)
+
+    # Process and save look angle data if available
+    if stamps_exists(f"la{psver}"):
+        la = stamps_load(f"la{psver}")
+        la = la[ix2]
+        if all_da_flag:
+            la_other = la[ix_other]
+            la = np.concatenate([la, la_other])
+        la = la[ix_weed]
+        stamps_save(f"la{psver + 1}", la)  # look angle data (n_ps,) - radians
+
+    # Process and save incidence angle data if available
+    if stamps_exists(f"inc{psver}"):
+        inc = stamps_load(f"inc{psver}")
+        inc = inc[ix2]
+        if all_da_flag:
+            inc_other = inc[ix_other]
+            inc = np.concatenate([inc, inc_other])
+        inc = inc[ix_weed]
+        stamps_save(f"inc{psver + 1}", inc)  # incidence angle data (n_ps,) - radians
+
+    # Process and save baseline data if available
+    if stamps_exists(f"bp{psver}"):
+        bperp_mat = stamps_load(f"bp{psver}")
+        bperp_mat = bperp_mat[ix2, :]
+        if all_da_flag:
+            bperp_other = bperp[ix_other, :]
+            bperp_mat = np.concatenate([bperp_mat, bperp_other])
+        bperp_mat = bperp_mat[ix_weed, :]
+        stamps_save(f"bp{psver + 1}", bperp_mat)  # baseline data (n_ps, n_ifg) - meters
+
+
+def weed_time_weights(day: Array, time_win: float) -> Tuple[Array, Array]:
+    """
+    Gaussian time weights used to smooth the edge phases in stage 4.
+
+    Returns the (n_use, n_use) matrix of time differences, where row `i` holds
+    `day[i] - day`, and the matching weights normalised so that each row sums
+    to one.
+    """
+
+    time_diff = day[:, np.newaxis] - day[np.newaxis, :]
+    weight = np.exp(-(time_diff**2) / (2 * time_win**2))
+    weight /= np.sum(weight, axis=1, keepdims=True)
+
+    return time_diff, weight
+
+
+def weed_block_size(n_use: int, max_bytes: int = 2**28) -> int:
+    """Number of edges to smooth at once so that the temporaries of
+    `weed_smooth_edges` stay below `max_bytes`."""
+
+    # Per edge, the peak holds an (n_use, n_use) complex128 phase product and
+    # its float64 angle, plus up to 64 bytes per interferogram for the
+    # (n_block, n_use) means, fit parameters and outputs (measured with
+    # `tracemalloc`)
+    return max(1, max_bytes // (24 * n_use**2 + 64 * n_use))
+
+
+def weed_smooth_edges(
+    dph_space: Array, time_diff: Array, weight: Array
+) -> Tuple[Array, Array]:
+    """
+    Smooth the differential phase of a block of edges in time.
+
+    For every interferogram `i`, the phase of each edge is smoothed with the
+    weighted mean phasor over all interferograms using the weights in row `i`
+    of `weight`. The mean is then corrected by two rounds of a weighted linear
+    fit in time of the residual phase. The second output is the weighted mean
+    that leaves interferogram `i` out.
+
+    All interferograms are processed together: the weighted means are complex
+    matrix products and the two-parameter weighted fits are solved in closed
+    form from the weighted sums of the residuals.
+
+    Parameters:
+    - dph_space: (n_edge, n_use) complex differential phase of the edges.
+    - time_diff: (n_use, n_use) time differences from `weed_time_weights`.
+    - weight: (n_use, n_use) normalised weights from `weed_time_weights`.
+
+    Returns:
+    - dph_smooth: (n_edge, n_use) smoothed phase.
+    - dph_smooth2: (n_edge, n_use) smoothed phase without interferogram `i`.
+    """
+
+    # Weighted sums of the design matrix [1, time_diff]. The weights of each
+    # row sum to one so the determinant of the normal equations is simple.
+    weight_t = weight * time_diff
+    sum_t = np.sum(weight_t, axis=1)
+    sum_tt = np.sum(weight_t * time_diff, axis=1)
+    det = sum_tt - sum_t**2
+
+    # When the weights collapse onto a single time (a narrow window or
+    # duplicate dates) the slope is undetermined, and the minimum norm
+    # solution of `lstsq` is the weighted mean with zero slope
+    singular = det <= 1e-10 * np.maximum(sum_tt, 1.0)
+    det = np.where(singular, 1.0, det)
+
+    def fit(res: Array) -> Tuple[Array, Array]:
+        sum_y = np.einsum("bij,ij->bi", res, weight)
+        sum_ty = np.einsum("bij,ij->bi", res, weight_t)
+        offset = np.where(singular, sum_y, (sum_tt * sum_y - sum_t * sum_ty) / det)
+        slope = np.where(singular, 0.0, (sum_ty - sum_t * sum_y) / det)
+        return offset, slope
+
+    # Weighted mean phasor of each edge for every interferogram
+    dph_mean = dph_space @ weight.T
+
+    # Residual phase of each interferogram `j` relative to the mean for `i`
+    dph_mean_adj = np.angle(
+        dph_space[:, np.newaxis, :] * np.conj(dph_mean)[:, :, np.newaxis]
+    )
+
+    m0, m1 = fit(dph_mean_adj)
+
+    # Remove the linear fit and rewrap the residual phase
+    dph_mean_adj -= m0[:, :, np.newaxis] + m1[:, :, np.newaxis] * time_diff
+    dph_mean_adj += np.pi
+    np.mod(dph_mean_adj, 2 * np.pi, out=dph_mean_adj)
+    dph_mean_adj -= np.pi
+
+    m2, _ = fit(dph_mean_adj)
+
+    dph_smooth = dph_mean * np.exp(1j * (m0 + m2))
+
+    # Mean without the interferogram itself, which is not renormalised
+    weight2 = weight.copy()
+    np.fill_diagonal(weight2, 0)
+    dph_smooth2 = dph_space @ weight2.T
+
+    return dph_smooth.astype(np.complex64), dph_smooth2.astype(np.complex64)
+
+
+def weed_edge_noise_streaming(
+    ph: Array, edgs: Array, day: Array, bperp: Array, time_win: float
+) -> Tuple[Array, Array]:
+    """
+    Estimate the phase noise of each edge in blocks of edges.
+
+    This gives the same `edge_std` and `edge_max` as the edge noise estimation
+    in stage 4 for a single master, but only ever holds one block of edge
+    phases in memory. The first pass accumulates the variance of the
+    leave-one-out noise of each interferogram (`ifg_var`) over all edges. The
+    second pass smooths each block, removes the arc DEM error `K` weighted by
+    `1 / ifg_var` and keeps only the standard deviation and maximum of the
+    noise of each edge.
+
+    Parameters:
+    - ph: (n_ps, n_use) complex phase of the weeded PS.
+    - edgs: (n_edge, 2) node indices of the edges.
+    - day: (n_use,) dates of the interferograms in days.
+    - bperp: (n_use,) perpendicular baselines of the interferograms.
+    - time_win: Width of the Gaussian time window in days.
+
+    Returns:
+    - edge_std: (n_edge,) standard deviation of the noise of each edge.
+    - edge_max: (n_edge,) maximum absolute noise of each edge.
+    """
+
+    n_edge = edgs.shape[0]
+    n_use = ph.shape[1]
+
+    time_diff, weight = weed_time_weights(day, time_win)
+    weight2 = weight.copy()
+    np.fill_diagonal(weight2, 0)
+
+    block_size = weed_block_size(n_use)
+    n_block = int(np.ceil(n_edge / block_size))
+
+    def edge_phase(ib: int) -> Tuple[int, int, Array]:
+        i1 = ib * block_size
+        i2 = min(i1 + block_size, n_edge)
+        return i1, i2, ph[edgs[i1:i2, 1], :] * np.conj(ph[edgs[i1:i2, 0], :])
+
+    # First pass: variance of the noise of each interferogram relative to the
+    # mean of the others, merged across blocks with the pairwise update of
+    # Chan et al. so no block needs to be kept
+
+    count = np.zeros(n_use)
+    mean = np.zeros(n_use)
+    m2 = np.zeros(n_use)
+
+    for ib in range(n_block):
+        _, _, dph_space = edge_phase(ib)
+        dph_smooth2 = (dph_space @ weight2.T).astype(np.complex64)
+        dph_noise2 = np.angle(dph_space * np.conj(dph_smooth2))
+
+        n_b = np.sum(~np.isnan(dph_noise2), axis=0)
+        mean_b = np.nansum(dph_noise2, axis=0) / np.maximum(n_b, 1)
+        m2_b = np.nansum((dph_noise2 - mean_b) ** 2, axis=0)
+
+        n_ab = count + n_b
+        delta = mean_b - mean
+        mean += delta * n_b / np.maximum(n_ab, 1)
+        m2 += m2_b + delta**2 * count * n_b / np.maximum(n_ab, 1)
+        count = n_ab
+
+        show_progress(ib, 2 * n_block)
+
+    ifg_var = m2 / (count - 1)
+
+    # Second pass: noise of each edge after removing the arc DEM error,
+    # estimated with a weighted one-parameter fit solved in closed form
+
+    w_bperp = bperp / ifg_var
+    sum_w_bperp_sq = np.sum(w_bperp * bperp)
+
+    edge_std = np.zeros(n_edge)
+    edge_max = np.zeros(n_edge)
+
+    for ib in range(n_block):
+        i1, i2, dph_space = edge_phase(ib)
+        dph_smooth, _ = weed_smooth_edges(dph_space, time_diff, weight)
+        dph_noise = np.angle(dph_space * np.conj(dph_smooth))
+        del dph_space, dph_smooth
+
+        K = (dph_noise @ w_bperp) / sum_w_bperp_sq
+        dph_noise -= K[:, np.newaxis] * bperp[np.newaxis, :]
+
+        edge_std[i1:i2] = np.std(dph_noise, axis=1, ddof=1)
+        edge_max[i1:i2] = np.max(np.abs(dph_noise), axis=1)
+
+        show_progress(n_block + ib, 2 * n_block)
+
+    return edge_std, edge_max
+
+
+def ps_correct_phase(
+    ph: Array,
+    K_ps: Array,
+    bperp_mat: Array,
+    C_ps: Optional[Array] = None,
+    out: Optional[Array] = None,
+    max_bytes: int = 2**26,
+) -> Array:
+    """
+    Subtract the look angle (DEM) error and, if given, the master noise from
+    the wrapped phase of the PS.
+
+    The correction `exp(-1j * (K_ps * bperp_mat + C_ps))` is formed for a
+    block of PS at a time directly in complex64 in the output, and then
+    multiplied by the phase in place, so no full-size temporaries are made.
+    `out` may be `ph` itself to correct the phase in place.
+
+    Parameters:
+    - ph: (n_ps, n_ifg) complex phase of the PS.
+    - K_ps: (n_ps,) look angle error coefficients.
+    - bperp_mat: (n_ps, n_ifg) perpendicular baselines.
+    - C_ps: (n_ps,) master noise, not subtracted if None.
+    - out: (n_ps, n_ifg) complex64 output array, allocated if None.
+    - max_bytes: Approximate memory budget of the temporaries of a block.
 
-    # Update PS information with weed results
-    xy2 = xy2[ix_weed, :]
-    ij2 = ij2[ix_weed, :]
-    lonlat2 = lonlat2[ix_weed, :]
+    Returns:
+    - The corrected (n_ps, n_ifg) complex64 phase.
+    """
 
-    ps.update({"xy": xy2, "ij": ij2, "lonlat": lonlat2, "n_ps": ph2.shape[0]})
-    psname = f"ps{psver + 1}"
-    stamps_save(psname, ps)  # phase data (n_ps, n_ifg) - complex
+    n_ps, n_ifg = ph.shape
 
-    # Process and save height data if available
-    if stamps_exists(f"hgt{psver}"):
-        hgt = hgt[ix_weed]
-        stamps_save(f"hgt{psver + 1}", hgt)
+    if out is None:
+        out = np.empty((n_ps, n_ifg), dtype=np.complex64)
 
-    # Process and save look angle data if available
-    if stamps_exists(f"la{psver}"):
-        la = stamps_load(f"la{psver}")
-        la = la[ix2]
-        if all_da_flag:
-            la_other = la[ix_other]
-            la = np.concatenate([la, la_other])
-        la = la[ix_weed]
-        stamps_save(f"la{psver + 1}", la)  # look angle data (n_ps,) - radians
+    block = max(1, max_bytes // (4 * n_ifg))
 
-    # Process and save incidence angle data if available
-    if stamps_exists(f"inc{psver}"):
-        inc = stamps_load(f"inc{psver}")
-        inc = inc[ix2]
-        if all_da_flag:
-            inc_other = inc[ix_other]
-            inc = np.concatenate([inc, inc_other])
-        inc = inc[ix_weed]
-        stamps_save(f"inc{psver + 1}", inc)  # incidence angle data (n_ps,) - radians
+    for start in range(0, n_ps, block):
+        stop = min(start + block, n_ps)
 
-    # Process and save baseline data if available
-    if stamps_exists(f"bp{psver}"):
-        bperp_mat = stamps_load(f"bp{psver}")
-        bperp_mat = bperp_mat[ix2, :]
-        if all_da_flag:
-            bperp_other = bperp[ix_other, :]
-            bperp_mat = np.concatenate([bperp_mat, bperp_other])
-        bperp_mat = bperp_mat[ix_weed, :]
-        stamps_save(f"bp{psver + 1}", bperp_mat)  # baseline data (n_ps, n_ifg) - meters
+        phase = bperp_mat[start:stop].astype(np.float32)
+        phase *= K_ps[start:stop, np.newaxis]
+        if C_ps is not None:
+            phase += C_ps[start:stop, np.newaxis]
+        phase *= -1
+
+        rc = out[start:stop]
+        ph_block = ph[start:stop]
+        if np.shares_memory(ph_block, rc):
+            ph_block = ph_block.copy()
+
+        np.cos(phase, out=rc.real)
+        np.sin(phase, out=rc.imag)
+        rc *= ph_block
+
+    return out
 
 
 def stage5_correct_phases(opts: dotdict = dotdict()) -> None:
@@ -4274,9 +5676,13 @@ def stage5_correct_phases(opts: dotdict = dotdict()) -> None:
 
     del pm
 
+    # Correct in place when the phase is already complex64, so that only one
+    # copy of the phase is held
+    out = ph if ph.dtype == np.complex64 else None
+
     if small_baseline_flag.lower() == "y":
         # Perform phase correction by subtracting range error
-        ph_rc = ph * np.exp(-1j * (K_ps[:, np.newaxis] * bp))
+        ph_rc = ps_correct_phase(ph, K_ps, bp, out=out)
 
         # Save the corrected phase
         stamps_save(f"rc{psver}", ph_rc=ph_rc)
@@ -4294,20 +5700,12 @@ def stage5_correct_phases(opts: dotdict = dotdict()) -> None:
 
     
         # Perform phase correction by subtracting range error and master noise
-        ph_rc = ph * np.exp(
-            1j
-            * (
-                -K_ps[:, np.newaxis] * bperp_mat - C_ps[:, np.newaxis] * np.ones(n_ifg)
-            )  # - range error  # - master noise
-        )
+        ph_rc = ps_correct_phase(ph, K_ps, bperp_mat, C_ps, out=out)
 
-        ph_reref = np.hstack(
-            (
-                ph_patch[:, :master_ix],
-                np.ones((n_ps, 1)),
-                ph_patch[:, master_ix:],
-            )
-        )
+        # Phase reference with a unit master column
+        ph_reref = np.ones((n_ps, ph_patch.shape[1] + 1), dtype=ph_patch.dtype)
+        ph_reref[:, :master_ix] = ph_patch[:, :master_ix]
+        ph_reref[:, master_ix + 1 :] = ph_patch[:, master_ix:]
 
         # Save the corrected phase and ph_reref
         stamps_save(
@@ -4333,47 +5731,59 @@ def ps_calc_ifg_std() -> None:
     assert isinstance(bp, np.ndarray)
     assert isinstance(ph, np.ndarray)
 
-    # n_ifg = ps["n_ifg"]
-    n_ps = ps["n_ps"]
-    master_ix = np.sum(ps["master_day"] > ps["day"])
+    n_ps, n_ifg = ph.shape
+    master_ix = int(np.sum(ps["master_day"] > ps["day"]))
 
     log("Estimating noise standard deviation (in degrees)")
 
-    if small_baseline_flag == "y":
-        ph_diff = np.angle(
-            ph * np.conj(pm.ph_patch) * np.exp(-1j * (pm.K_ps[:, np.newaxis] * bp))
-        )
-    else:
-        bperp_mat = np.hstack(
-            (
-                bp[:, :master_ix],
-                np.zeros((n_ps, 1)),
-                bp[:, master_ix:],
-            )
-        )
+    K_ps = np.ravel(pm.K_ps).astype(np.float32)
+    C_ps = np.ravel(pm.C_ps).astype(np.float32)
 
-        ph_patch = np.hstack(
-            (
-                pm.ph_patch[:, :master_ix],
-                np.ones((n_ps, 1)),
-                pm.ph_patch[:, master_ix:],
-            )
-        )
+    def with_master(x: Array, value: float) -> Array:
+        """Insert the master column into a block if it does not have one."""
+        if x.shape[1] == n_ifg - 1:
+            return np.insert(x, master_ix, value, axis=1)
+        return x
 
-        ph_diff = np.angle(
-            ph
-            * np.conj(ph_patch)
-            * np.exp(
-                1j
-                * (
-                    -pm.K_ps[:, np.newaxis] * bperp_mat
-                    - pm.C_ps[:, np.newaxis] * np.ones_like(bperp_mat)
-                )
+    # The mean and variance of the residual phase of each interferogram are
+    # accumulated over blocks of PS with the pairwise update of Chan et al.
+
+    count = np.zeros(n_ifg)
+    mean = np.zeros(n_ifg)
+    m2 = np.zeros(n_ifg)
+
+    block = max(1, 2**26 // (8 * n_ifg))
+
+    for start in range(0, n_ps, block):
+        stop = min(start + block, n_ps)
+
+        if small_baseline_flag == "y":
+            ph_diff = ps_correct_phase(ph[start:stop], K_ps[start:stop], bp[start:stop])
+            ph_diff *= np.conj(pm.ph_patch[start:stop])
+        else:
+            ph_diff = ps_correct_phase(
+                ph[start:stop],
+                K_ps[start:stop],
+                with_master(bp[start:stop], 0),
+                C_ps[start:stop],
             )
-        )
+            ph_diff *= np.conj(with_master(pm.ph_patch[start:stop], 1))
+
+        ph_diff = np.angle(ph_diff).astype(np.float64)
+
+        n_b = np.sum(~np.isnan(ph_diff), axis=0)
+        mean_b = np.nansum(ph_diff, axis=0) / np.maximum(n_b, 1)
+        m2_b = np.nansum((ph_diff - mean_b) ** 2, axis=0)
+
+        n_ab = count + n_b
+        delta = mean_b - mean
+        mean += delta * n_b / np.maximum(n_ab, 1)
+        m2 += m2_b + delta**2 * count * n_b / np.maximum(n_ab, 1)
+        count = n_ab
 
-    ifg_mean = np.degrees(np.nanmean(ph_diff, axis=0))
-    ifg_std = np.degrees(np.nanstd(ph_diff, axis=0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ifg_mean = np.degrees(np.where(count > 0, mean, np.nan))
+        ifg_std = np.degrees(np.sqrt(m2 / count))
 
     if small_baseline_flag == "y":
         ifgday = ps.ifgday
@@ -4520,9 +5930,7 @@ def stage6_unwrap_phases(opts: dotdict = dotdict()) -> None:
                 log("   wrong number of PS in scla - subtraction skipped...")
                 os.remove(sclaname + ".mat")  # FIXME: Check if this is correct
 
-    if small_baseline_flag == "y" and os.path.exists(
-        sclaname + ".mat"
-    ):  # Small baselines
+    if small_baseline_flag == "y" and stamps_exists(sclaname):  # Small baselines
         log("   subtracting scla...")
 
         scla = stamps_load(sclaname)
@@ -4576,6 +5984,15 @@ def stage6_unwrap_phases(opts: dotdict = dotdict()) -> None:
 
     options["gold_alpha"] = float(getparm("unwrap_gold_alpha"))
 
+    options["snaphu_workers"] = int(getparm("snaphu_workers"))
+    options["snaphu_tiles"] = (
+        int(getparm("snaphu_ntilerow")),
+        int(getparm("snaphu_ntilecol")),
+    )
+    options["snaphu_tile_overlap"] = int(getparm("snaphu_tile_overlap"))
+    options["snaphu_nproc"] = int(getparm("snaphu_nproc"))
+    options["unwrap_solver"] = getparm("unwrap_solver")
+
     max_topo_err = float(getparm("max_topo_err"))
     lambda_ = float(getparm("lambda"))
 
@@ -4761,6 +6178,11 @@ def uw_3d(
     options.setdefault("max_bperp_for_temp_est", 100)
     options.setdefault("variance", [])
     options.setdefault("ph_uw_predef", None)
+    options.setdefault("snaphu_workers", 1)
+    options.setdefault("snaphu_tiles", (1, 1))
+    options.setdefault("snaphu_tile_overlap", 0)
+    options.setdefault("snaphu_nproc", 1)
+    options.setdefault("unwrap_solver", "snaphu")
 
     # FIXME: This is horrible logic around unwrap_method in matlab code
 
@@ -4829,7 +6251,15 @@ def uw_3d(
 
     # check("uw_space_time", stamps_load("uw_space_time"), tol=1e-5)
 
-    uw_stat_costs(options.unwrap_method, options.variance)
+    uw_stat_costs(
+        options.unwrap_method,
+        options.variance,
+        n_workers=options.snaphu_workers,
+        tiles=options.snaphu_tiles,
+        tile_overlap=options.snaphu_tile_overlap,
+        n_proc=options.snaphu_nproc,
+        solver=options.unwrap_solver,
+    )
 
     ph_uw, msd = uw_unwrap_from_grid(xy, options.grid_size)
 
@@ -4840,8 +6270,33 @@ def uw_stat_costs(
     unwrap_method: str = "3D",
     variance: Optional[Array] = None,
     subset_ifg_index: Optional[Array] = None,
+    n_workers: int = 1,
+    tiles: Tuple[int, int] = (1, 1),
+    tile_overlap: int = 0,
+    n_proc: int = 1,
+    solver: str = "snaphu",
 ) -> None:
-    """Find unwrapped solutions using MAP cost functions"""
+    """Find unwrapped solutions using MAP cost functions.
+
+    Up to `n_workers` Snaphu processes run at the same time, each in its own
+    scratch directory, while the cost file of the next interferogram is
+    prepared. `tiles`, `tile_overlap` and
+    `n_proc` are passed to Snaphu as NTILEROW/NTILECOL, ROWOVRLP/COLOVRLP and
+    NPROC to tile very large grids.
+
+    `solver` selects the program that minimises the costs: "snaphu" runs the
+    external Snaphu executable, "mcf" solves the minimum-cost flow problem
+    in-process with `mcf_unwrap`, without writing any files.
+    """
+
+    solver = solver.lower()
+    if solver not in ["snaphu", "mcf"]:
+        raise ValueError(f"Unknown unwrap solver '{solver}'")
+
+    import shutil
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from scipy.sparse import issparse
 
     costscale = 100
     nshortcycle = 200
@@ -4852,6 +6307,8 @@ def uw_stat_costs(
     log(f"{unwrap_method = }")
     log(f"{variance = }")
     log(f"{subset_ifg_index = }")
+    log(f"{n_workers = }")
+    log(f"{tiles = }")
 
     uw = stamps_load("uw_grid")
     ui = stamps_load("uw_interp")
@@ -4923,9 +6380,9 @@ def uw_stat_costs(
     rowix = ui.rowix.astype(np.float32)  # uses 1-based indexing
 
     nostats_ix = np.flatnonzero(np.isnan(sigsq_noise))
-    for i in nostats_ix:
-        rowix[np.abs(rowix) == i + 1] = np.nan
-        colix[np.abs(colix) == i + 1] = np.nan
+    if len(nostats_ix) > 0:
+        rowix[np.isin(np.abs(rowix), nostats_ix + 1)] = np.nan
+        colix[np.isin(np.abs(colix), nostats_ix + 1)] = np.nan
 
     with np.errstate(invalid="ignore"):  # handle nans
         sigsq = np.round(
@@ -4937,18 +6394,21 @@ def uw_stat_costs(
     # check("n_edges", n_edges)
     # check("sigsq", sigsq, tol=1e-6)
 
+    # The cost grids are reused for every interferogram. Only the sigma
+    # (1::4) and offset (0::4) columns of cells that map to an edge change
+    # between interferograms, everything else is filled in once here.
     rowcost = np.zeros(((nrow - 1), ncol * 4), dtype=np.int16)
     colcost = np.zeros((nrow, (ncol - 1) * 4), dtype=np.int16)
 
     nzrowix = np.abs(rowix) > 0
-    rowstdgrid = np.ones(rowix.shape, dtype=np.int16)
-
     nzcolix = np.abs(colix) > 0
-    colstdgrid = np.ones(colix.shape, dtype=np.int16)
 
     # check("nzrowix", nzrowix)
     # check("nzcolix", nzcolix)
 
+    rowcost[:, 1::4] = 1
+    colcost[:, 1::4] = 1
+
     rowcost[:, 2::4] = maxshort
     colcost[:, 2::4] = maxshort
 
@@ -4958,81 +6418,57 @@ def uw_stat_costs(
     stats_ix = ~np.isnan(colix)
     colcost[:, 3::4] = stats_ix * (-1 - maxshort) + 1
 
+    # Edge index (0-based), direction and position in the flat cost grid of
+    # every cell that maps to an edge
+    row_edge_ix = np.abs(rowix[nzrowix]).astype(np.int32) - 1
+    row_offset_scale = np.sign(rowix[nzrowix]) * nshortcycle
+    nz_r, nz_c = np.nonzero(nzrowix)
+    row_cost_ix = nz_r * rowcost.shape[1] + 4 * nz_c
+
+    col_edge_ix = np.abs(colix[nzcolix]).astype(np.int32) - 1
+    col_offset_scale = np.sign(colix[nzcolix]) * nshortcycle
+    nz_r, nz_c = np.nonzero(nzcolix)
+    col_cost_ix = nz_r * colcost.shape[1] + 4 * nz_c
+
+    rowcost_flat = rowcost.reshape(-1)
+    colcost_flat = colcost.reshape(-1)
+
+    # Column access is cheap in CSC form, an all-zero spread adds nothing
+    spread_all = ut.spread
+    if issparse(spread_all):
+        spread_all = spread_all.tocsc() if spread_all.nnz > 0 else None
+    elif not np.any(spread_all):
+        spread_all = None
+    else:
+        spread_all = np.asarray(spread_all, dtype=np.float32)
+
     ph_uw = np.zeros((uw.n_ps, uw.n_ifg), dtype=np.float64)
     ifguw = np.zeros((nrow, ncol))
     msd = np.zeros((uw.n_ifg,), dtype=np.float64)
 
-    with open("snaphu.conf", "w") as fid:
-        fid.write("INFILE  snaphu.in\n")
-        fid.write("OUTFILE snaphu.out\n")
-        fid.write("COSTINFILE snaphu.costinfile\n")
-        fid.write("STATCOSTMODE  DEFO\n")
-        fid.write("INFILEFORMAT  COMPLEX_DATA\n")
-        fid.write("OUTFILEFORMAT FLOAT_DATA\n")
-
-    for i1 in subset_ifg_index:
-        log(f"Processing IFG {i1+1} of {len(subset_ifg_index)}")
-
-        spread = np.ravel(ut.spread[:, i1].todense())
-        spread = ((np.abs(spread) * nshortcycle**2) / 6 / costscale * n_edges).astype(
-            np.int16
-        )
-
-        sigsqtot = sigsq + spread
-
-        if ut.predef_ix is not None:
-            sigsqtot[ut.predef_ix[:, i1]] = 1
-
-        ix = np.abs(rowix[nzrowix]).astype(np.int32) - 1  # 0-based indexing
-        rowstdgrid[nzrowix] = sigsqtot[ix]
-        rowcost[:, 1::4] = rowstdgrid
-
-        ix = np.abs(colix[nzcolix]).astype(np.int32) - 1  # 0-based indexing
-        colstdgrid[nzcolix] = sigsqtot[ix]
-        colcost[:, 1::4] = colstdgrid
-
-        offset_cycle = (
-            np.angle(np.exp(1j * ut.dph_space_uw[:, i1])) - dph_smooth[:, i1]
-        ) / (2 * np.pi)
-
-        ix = np.abs(rowix[nzrowix]).astype(np.int32) - 1  # 0-based indexing
-        offgrid = np.zeros(rowix.shape, dtype=np.int16)
-        offgrid[nzrowix] = np.round(
-            offset_cycle[ix] * np.sign(rowix[nzrowix]) * nshortcycle, 0
-        )
-        rowcost[:, ::4] = -offgrid
-
-        ix = np.abs(colix[nzcolix]).astype(np.int32) - 1  # 0-based indexing
-        offgrid = np.zeros(colix.shape, dtype=np.int16)
-        offgrid[nzcolix] = np.round(
-            offset_cycle[ix] * np.sign(colix[nzcolix]) * nshortcycle, 0
-        )
-        colcost[:, ::4] = offgrid
-
-        # check("offset_cycle", offset_cycle)
-        # check("rowix", rowix)
-        # check("colix", colix)
-        # check("offgrid", offgrid)
-
-        with open("snaphu.costinfile", "wb") as fid:
-            rowcost.tofile(fid)
-            colcost.tofile(fid)
-
-        ifgw = uw.ph[Z - 1, i1].reshape(nrow, ncol)
-        mask = np.isfinite(ifgw)
-        ifgw[~mask] = 0
-
-        # writecpx(Path("snaphu.in"), ifgw)
-        ifgw.astype(np.complex64).tofile("snaphu.in")
-
-        run_snaphu_on(Path("snaphu.conf"), ncol)
-
-        with open("snaphu.out", "rb") as fid:
-            ifguw = (
-                np.fromfile(fid, dtype=np.float32)
-                .astype(np.float64)
-                .reshape(nrow, ncol)
-            )
+    def write_conf(workdir: Path) -> None:
+        with open(workdir / "snaphu.conf", "w") as fid:
+            fid.write("INFILE  snaphu.in\n")
+            fid.write("OUTFILE snaphu.out\n")
+            fid.write("COSTINFILE snaphu.costinfile\n")
+            fid.write("STATCOSTMODE  DEFO\n")
+            fid.write("INFILEFORMAT  COMPLEX_DATA\n")
+            fid.write("OUTFILEFORMAT FLOAT_DATA\n")
+            if tiles[0] * tiles[1] > 1:
+                fid.write(f"NTILEROW {tiles[0]}\n")
+                fid.write(f"NTILECOL {tiles[1]}\n")
+                fid.write(f"ROWOVRLP {tile_overlap}\n")
+                fid.write(f"COLOVRLP {tile_overlap}\n")
+                fid.write(f"NPROC {n_proc}\n")
+
+    def collect(i1: int, workdir: Path, ifguw: Optional[Array]) -> None:
+        if ifguw is None:
+            with open(workdir / "snaphu.out", "rb") as fid:
+                ifguw = (
+                    np.fromfile(fid, dtype=np.float32)
+                    .astype(np.float64)
+                    .reshape(nrow, ncol)
+                )
 
         check(f"ifguw_{i1+1}", ifguw, tol=1e-2)
 
@@ -5053,6 +6489,102 @@ def uw_stat_costs(
 
         ph_uw[:, i1] = ifguw_ur[nzix_ur]
 
+        if workdir != Path(".") and not DEBUG:
+            shutil.rmtree(workdir)
+
+    # Interferograms being unwrapped, oldest first
+    pending: deque = deque()
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as pool:
+        for i1 in subset_ifg_index:
+            log(f"Processing IFG {i1+1} of {len(subset_ifg_index)}")
+
+            sigsqtot = sigsq.copy()
+            if spread_all is None:
+                pass
+            elif issparse(spread_all):
+                start, stop = spread_all.indptr[i1], spread_all.indptr[i1 + 1]
+                edge_ix = spread_all.indices[start:stop]
+                sigsqtot[edge_ix] += (
+                    (np.abs(spread_all.data[start:stop]) * nshortcycle**2)
+                    / 6
+                    / costscale
+                    * n_edges[edge_ix]
+                ).astype(np.int16)
+            else:
+                sigsqtot += (
+                    (np.abs(spread_all[:, i1]) * nshortcycle**2)
+                    / 6
+                    / costscale
+                    * n_edges
+                ).astype(np.int16)
+
+            if ut.predef_ix is not None:
+                sigsqtot[ut.predef_ix[:, i1]] = 1
+
+            rowcost_flat[row_cost_ix + 1] = sigsqtot[row_edge_ix]
+            colcost_flat[col_cost_ix + 1] = sigsqtot[col_edge_ix]
+
+            offset_cycle = (
+                np.angle(np.exp(1j * ut.dph_space_uw[:, i1])) - dph_smooth[:, i1]
+            ) / (2 * np.pi)
+
+            with np.errstate(invalid="ignore"):
+                rowcost_flat[row_cost_ix] = -np.round(
+                    offset_cycle[row_edge_ix] * row_offset_scale, 0
+                ).astype(np.int16)
+                colcost_flat[col_cost_ix] = np.round(
+                    offset_cycle[col_edge_ix] * col_offset_scale, 0
+                ).astype(np.int16)
+
+            # check("offset_cycle", offset_cycle)
+            # check("rowix", rowix)
+            # check("colix", colix)
+
+            ifgw = uw.ph[Z - 1, i1].reshape(nrow, ncol)
+            mask = np.isfinite(ifgw)
+            ifgw[~mask] = 0
+
+            if solver == "mcf":
+                # The cost buffers are reused, so each solve gets its own copy
+                workdir = Path(".")
+                future = pool.submit(
+                    mcf_unwrap,
+                    ifgw.astype(np.complex64),
+                    rowcost.copy(),
+                    colcost.copy(),
+                    nshortcycle,
+                )
+                pending.append((i1, workdir, future))
+            else:
+                # Each Snaphu run gets its own directory and config, as the
+                # next interferogram is prepared while it runs
+                workdir = Path(f"snaphu_{i1+1}")
+                workdir.mkdir(exist_ok=True)
+                write_conf(workdir)
+
+                with open(workdir / "snaphu.costinfile", "wb") as fid:
+                    rowcost.tofile(fid)
+                    colcost.tofile(fid)
+
+                # writecpx(Path("snaphu.in"), ifgw)
+                ifgw.astype(np.complex64).tofile(workdir / "snaphu.in")
+
+                future = pool.submit(
+                    run_snaphu_on, Path("snaphu.conf"), ncol, workdir
+                )
+                pending.append((i1, workdir, future))
+
+            # Bound the number of unwrapping jobs in flight. The jobs left
+            # running overlap with preparing the next interferogram.
+            while len(pending) > max(n_workers, 1):
+                i_done, workdir_done, future_done = pending.popleft()
+                collect(i_done, workdir_done, future_done.result())
+
+        while pending:
+            i_done, workdir_done, future_done = pending.popleft()
+            collect(i_done, workdir_done, future_done.result())
+
     # check("ph_uw", ph_uw, tol=1e-2)
     # check("msd", msd, tol=1e-1)
 
@@ -5075,25 +6607,27 @@ def uw_unwrap_from_grid(xy: Array, pix_size: int) -> Tuple[Array, Array]:
     gridix = np.zeros_like(uw.nzix, dtype=np.int32)
     gridix.T[uw.nzix.T] = np.arange(1, uw.n_ps + 1)
 
-    ph_uw = np.zeros((n_ps, n_ifg), dtype=np.float32)
+    # Grid cell of every PS, zero where the wrapped phase values were zero
+    ix = gridix[uw.grid_ij[:, 0] - 1, uw.grid_ij[:, 1] - 1]
+    ps_ix = np.flatnonzero(ix != 0)
 
-    for i in range(n_ps):
-        ix = gridix[uw.grid_ij[i, 0] - 1, uw.grid_ij[i, 1] - 1]
+    ph_uw = np.full((n_ps, n_ifg), np.nan, dtype=np.float32)
 
-        if ix == 0:
-            # wrapped phase values were zero
-            ph_uw[i, :] = np.nan
-        else:
-            ph_uw_pix = uu.ph_uw[int(ix) - 1, :]
+    # Re-wrap the PS phase about the unwrapped phase of its cell, a block of
+    # PS at a time to bound the complex temporaries
+    chunk = max(1, 2**26 // (16 * n_ifg))
+    for start in range(0, len(ps_ix), chunk):
+        rows = ps_ix[start : start + chunk]
+        ph_uw_pix = uu.ph_uw[ix[rows] - 1, :]
 
-            if np.isrealobj(uw.ph_in):
-                ph_uw[i, :] = ph_uw_pix + np.angle(
-                    np.exp(1j * (uw.ph_in[i, :] - ph_uw_pix))
-                )
-            else:
-                ph_uw[i, :] = ph_uw_pix + np.angle(
-                    uw.ph_in[i, :] * np.exp(-1j * ph_uw_pix)
-                )
+        if np.isrealobj(uw.ph_in):
+            ph_uw[rows, :] = ph_uw_pix + np.angle(
+                np.exp(1j * (uw.ph_in[rows, :] - ph_uw_pix))
+            )
+        else:
+            ph_uw[rows, :] = ph_uw_pix + np.angle(
+                uw.ph_in[rows, :] * np.exp(-1j * ph_uw_pix)
+            )
 
     if uw.ph_in_predef is not None and len(uw.ph_in_predef) > 0:
         predef_ix = ~np.isnan(uw.ph_in_predef)
@@ -5113,6 +6647,190 @@ def uw_unwrap_from_grid(xy: Array, pix_size: int) -> Tuple[Array, Array]:
     return ph_uw, msd
 
 
+def uw_trial_search(
+    dph_sub: Array,
+    x_sub: Array,
+    x_range: float,
+    trial_mult: Array,
+    max_bytes: int = 2**28,
+) -> Tuple[Array, Array]:
+    """Estimate, for every edge, the coefficient `K` of the phase term that
+    is proportional to `x_sub` (e.g., perpendicular baseline for the look
+    angle error) and the temporal coherence of the residual phase.
+
+    The coherence of each trial coefficient `pi / 4 / x_range * trial_mult`
+    is found for a block of edges at once as a complex matrix product. The
+    peak is accepted if it exceeds any coherence outside its flanks by more
+    than 0.1, and is then refined by a weighted least-squares fit of the
+    residual phase, which for one parameter is solved in closed form.
+
+    Parameters:
+    - dph_sub: Complex phase of the edges, (n_edge, n_sub).
+    - x_sub: Value of the variable in each interferogram, (n_sub,).
+    - x_range: Range of the variable over all interferograms.
+    - trial_mult: Trial multiples of `pi / 4 / x_range`, (n_trials,).
+    - max_bytes: Approximate memory budget of the temporaries of a block.
+
+    Returns:
+    - K: Coefficient of every edge, zero where no clear peak was found, (n_edge, 1).
+    - coh: Coherence of the residual phase, (n_edge, 1).
+    """
+
+    n_edge, n_sub = dph_sub.shape
+    n_trials = len(trial_mult)
+
+    trial_phase = x_sub / x_range * np.pi / 4
+    trial_phase_mat = np.exp(-1j * trial_phase[:, None] * trial_mult)
+
+    K = np.zeros((n_edge, 1), dtype=np.float32)
+    coh = np.zeros((n_edge, 1), dtype=np.float32)
+
+    trial_ix = np.arange(n_trials)
+    diff_ix = np.arange(n_trials - 1)
+
+    block = max(1, max_bytes // (32 * max(n_sub, n_trials)))
+
+    for start in range(0, n_edge, block):
+        cpxphase = dph_sub[start : start + block, :]
+        weighting = np.abs(cpxphase)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coh_trial = np.abs(cpxphase @ trial_phase_mat) / np.sum(
+                weighting, axis=1, keepdims=True
+            )
+
+        coh_max_ix = np.argmax(coh_trial, axis=1)
+        coh_max = coh_trial[np.arange(len(coh_trial)), coh_max_ix]
+
+        # The peak spans from after the last fall before the maximum to the
+        # first rise after it
+        coh_diff = np.diff(coh_trial, axis=1)
+
+        falling = (coh_diff < 0) & (diff_ix < coh_max_ix[:, None])
+        peak_start_ix = np.where(
+            falling.any(axis=1), n_trials - 1 - np.argmax(falling[:, ::-1], axis=1), 0
+        )
+
+        rising = (coh_diff > 0) & (diff_ix >= coh_max_ix[:, None])
+        peak_end_ix = np.where(
+            rising.any(axis=1), np.argmax(rising, axis=1), n_trials - 1
+        )
+
+        in_peak = (trial_ix >= peak_start_ix[:, None]) & (
+            trial_ix <= peak_end_ix[:, None]
+        )
+        coh_off_peak = np.where(in_peak, 0, coh_trial).max(axis=1)
+
+        with np.errstate(invalid="ignore"):
+            ok = np.flatnonzero(coh_max - coh_off_peak > 0.1)  # FIXME: hardcoded
+
+        if len(ok) == 0:
+            continue
+
+        cpxphase = cpxphase[ok]
+        weighting = weighting[ok]
+
+        K0 = np.pi / 4 / x_range * trial_mult[coh_max_ix[ok]]
+
+        resphase = cpxphase * np.exp(-1j * (K0[:, None] * x_sub))
+        offset_phase = np.sum(resphase, axis=1, keepdims=True)
+        resphase = np.angle(resphase * np.conj(offset_phase))
+
+        # Weighted one-parameter least squares
+        w2x = weighting**2 * x_sub
+        denom = np.sum(w2x * x_sub, axis=1)
+        mopt = np.divide(
+            np.sum(w2x * resphase, axis=1),
+            denom,
+            out=np.zeros_like(denom),
+            where=denom > 0,
+        )
+
+        K_ok = (K0 + mopt).astype(np.float32)
+
+        phase_residual = cpxphase * np.exp(-1j * (K_ok[:, None] * x_sub))
+        mean_phase_residual = np.nansum(phase_residual, axis=1)
+
+        K[start + ok, 0] = K_ok
+        coh[start + ok, 0] = np.abs(mean_phase_residual) / np.sum(
+            np.abs(phase_residual), axis=1
+        )
+
+    return K, coh
+
+
+def uw_smooth_time(
+    dph_sub: Array, day_sub: Array, time_win: float, max_bytes: int = 2**28
+) -> Array:
+    """
+    Smooth the phase of the edges in time for the interferograms of one image.
+
+    For every sub-interferogram `i`, the phase of each edge is the Gaussian
+    weighted mean phasor over all sub-interferograms, corrected by the offset
+    of a weighted linear fit in time of the residual phase. The weight
+    matrices are computed once, the means are complex matrix products and the
+    fits are solved in closed form, for a block of edges at a time.
+
+    Parameters:
+    - dph_sub: (n_edge, n_sub) complex phase of the edges, sorted by day.
+    - day_sub: (n_sub,) days of the sub-interferograms.
+    - time_win: Width of the Gaussian time window in days.
+    - max_bytes: Approximate memory budget of the temporaries of a block.
+
+    Returns:
+    - dph_smooth: (n_edge, n_sub) smoothed phase.
+    """
+
+    n_edge, n_sub = dph_sub.shape
+
+    time_diff, weight = weed_time_weights(day_sub, time_win)
+
+    # Weighted sums of the design matrix [1, time_diff], the weights of each
+    # row sum to one
+    weight_t = weight * time_diff
+    sum_t = np.sum(weight_t, axis=1)
+    sum_tt = np.sum(weight_t * time_diff, axis=1)
+    det = sum_tt - sum_t**2
+
+    # Without spread in the weighted times, fall back to the weighted mean as
+    # in `weed_smooth_edges`
+    singular = det <= 1e-10 * np.maximum(sum_tt, 1.0)
+    det = np.where(singular, 1.0, det)
+
+    dph_sub_angle = np.angle(dph_sub + 1e-9)
+    dph_smooth = np.zeros((n_edge, n_sub), dtype=np.complex64)
+
+    block = weed_block_size(n_sub, max_bytes)
+
+    for start in range(0, n_edge, block):
+        stop = min(start + block, n_edge)
+
+        # Weighted mean phasor of each edge for every sub-interferogram
+        dph_mean = dph_sub[start:stop] @ weight.T
+
+        if n_sub == 1:
+            dph_smooth[start:stop] = dph_mean
+            continue
+
+        # Residual phase of each sub-interferogram `j` relative to the mean
+        # for `i`
+        dph_mean_adj = (
+            dph_sub_angle[start:stop, np.newaxis, :]
+            - np.angle(dph_mean)[:, :, np.newaxis]
+            + np.pi
+        )
+        np.mod(dph_mean_adj, 2 * np.pi, out=dph_mean_adj)
+        dph_mean_adj -= np.pi
+
+        sum_y = np.einsum("bij,ij->bi", dph_mean_adj, weight)
+        sum_ty = np.einsum("bij,ij->bi", dph_mean_adj, weight_t)
+        offset = np.where(singular, sum_y, (sum_tt * sum_y - sum_t * sum_ty) / det)
+
+        dph_smooth[start:stop] = dph_mean * np.exp(1j * offset)
+
+    return dph_smooth
+
+
 def uw_sb_unwrap_space_time(
     day: Array,
     ifgday_ix: Array,
@@ -5391,59 +7109,8 @@ def uw_sb_unwrap_space_time(
         trial_mult = np.arange(
             -np.ceil(8 * n_trial_wraps), np.ceil(8 * n_trial_wraps) + 1
         )
-        n_trials = len(trial_mult)
-
-        trial_phase = bperp_sub / bperp_range_sub * np.pi / 4
-        trial_phase_mat = np.exp(-1j * trial_phase[:, None] * trial_mult)
-
-        K = np.zeros((ui.n_edge, 1), dtype=np.float32)
-        coh = np.zeros((ui.n_edge, 1), dtype=np.float32)
-
-        for i in range(ui.n_edge):
-            cpxphase = dph_sub[i, :].flatten()
-            cpxphase_mat = np.tile(cpxphase, (n_trials, 1)).T
-
-            phaser = trial_phase_mat * cpxphase_mat
-            phaser_sum = np.sum(phaser, axis=1)
-
-            with np.errstate(divide="ignore", invalid="ignore"):
-                coh_trial = np.abs(phaser_sum) / np.sum(np.abs(cpxphase))
-
-            coh_max_ix = np.argmax(coh_trial)
-            coh_max = coh_trial[coh_max_ix]
-
-            falling_ix = np.where(np.diff(coh_trial[: coh_max_ix + 1]) < 0)[0]
-            if falling_ix.size > 0:
-                peak_start_ix = falling_ix[-1] + 1
-            else:
-                peak_start_ix = 0
-
-            rising_ix = np.where(np.diff(coh_trial[coh_max_ix:]) > 0)[0]
-            if rising_ix.size > 0:
-                peak_end_ix = rising_ix[0] + coh_max_ix
-            else:
-                peak_end_ix = n_trials - 1
-
-            coh_trial[peak_start_ix : peak_end_ix + 1] = 0
 
-            if coh_max - np.max(coh_trial) > 0.1:  # FIXME: hardcoded value
-                K0 = np.pi / 4 / bperp_range_sub * trial_mult[coh_max_ix]
-
-                resphase = cpxphase * np.exp(-1j * (K0 * bperp_sub))
-                offset_phase = np.sum(resphase)
-                resphase = np.angle(resphase * np.conj(offset_phase))
-
-                weighting = np.abs(cpxphase)
-                mopt = lstsq(
-                    weighting[:, None] * bperp_sub[:, None], weighting * resphase
-                )[0]
-
-                K[i] = K0 + mopt
-
-                phase_residual = cpxphase * np.exp(-1j * (K[i] * bperp_sub))
-                mean_phase_residual = np.nansum(phase_residual)
-
-                coh[i] = np.abs(mean_phase_residual) / np.sum(np.abs(phase_residual))
+        K, coh = uw_trial_search(dph_sub, bperp_sub, bperp_range_sub, trial_mult)
 
         K[coh < 0.31] = 0  # FIXME: hardcoded value
 
@@ -5523,61 +7190,18 @@ def uw_sb_unwrap_space_time(
                     gsub = G[ix, i]
                     dph_sub = dph_space[:, ix]
 
-                    sign_ix = -np.sign(gsub.flatten())
-                    dph_sub[:, sign_ix == -1] = np.conj(dph_sub[:, sign_ix == -1])
-
-                    slave_ix = np.sum(ifgday_ix[ix, :], axis=1) - i
-                    day_sub = day[slave_ix]
-
-                    sort_ix = np.argsort(day_sub)
-                    day_sub = day_sub[sort_ix]
-                    dph_sub = dph_sub[:, sort_ix]
-
-                    dph_sub_angle = np.angle(dph_sub + 1e-9)
-                    n_sub = day_sub.shape[0]
-
-                    dph_smooth = np.zeros((ui.n_edge, n_sub), dtype=np.complex64)
-
-                    for i1 in range(n_sub):
-                        time_diff = (day_sub[i1] - day_sub).flatten()
-
-                        # Exponential weighting
-                        weight_factor = np.exp(-(time_diff**2) / (2 * time_win**2))
-                        weight_factor = weight_factor / np.sum(weight_factor)
-
-                        # Calculate the weighted mean phase
-                        dph_mean = np.sum(
-                            dph_sub * weight_factor[np.newaxis, :], axis=1
-                        )
-                        dph_mean_adj = (
-                            np.mod(
-                                dph_sub_angle
-                                - np.angle(dph_mean)[:, np.newaxis]
-                                + np.pi,
-                                2 * np.pi,
-                            )
-                            - np.pi
-                        )
-
-                        GG = np.column_stack((np.ones(n_sub), time_diff))
-
-                        if GG.shape[0] > 1:
-                            m = lscov(GG, dph_mean_adj.T, weight_factor)
-                        else:
-                            m = np.zeros((GG.shape[1], ui.n_edge))
+                    sign_ix = -np.sign(gsub.flatten())
+                    dph_sub[:, sign_ix == -1] = np.conj(dph_sub[:, sign_ix == -1])
 
-                        dph_smooth[:, i1] = dph_mean * np.exp(1j * m[0, :])
+                    slave_ix = np.sum(ifgday_ix[ix, :], axis=1) - i
+                    day_sub = day[slave_ix]
 
-                        # GG matches to 6 decimal places at this point
-                        # dph_mean matches to 6 decimal places at this point
-                        # dph_mean_adj has problems as difference can be -pi vs pi
+                    sort_ix = np.argsort(day_sub)
+                    day_sub = day_sub[sort_ix]
+                    dph_sub = dph_sub[:, sort_ix]
 
-                        # check(
-                        #    f"test_{i+1}_{i1+1}",
-                        #    dph_mean,
-                        #    tol=1e-6,
-                        #    # modulo=2 * np.pi,
-                        # )
+                    dph_smooth = uw_smooth_time(dph_sub, day_sub, time_win)
+                    n_sub = day_sub.shape[0]
 
                     check(f"dph_smooth_{i+1}", dph_smooth, tol=1e-6)
 
@@ -5895,9 +7519,9 @@ def uw_grid_wrapped(
     if pix_size == 0:
         grid_x_min = 1
         grid_y_min = 1
-        n_i = np.max(xy_in[:, 2])  # seems weird? x and y inverted?
-        n_j = np.max(xy_in[:, 1])
-        grid_ij = xy_in[:, [2, 1]]
+        n_i = int(np.max(xy_in[:, 2]))  # seems weird? x and y inverted?
+        n_j = int(np.max(xy_in[:, 1]))
+        grid_ij = xy_in[:, [2, 1]].astype(int)
     else:
         grid_x_min = np.min(xy_in[:, 1])
         grid_y_min = np.min(xy_in[:, 2])
@@ -5920,107 +7544,106 @@ def uw_grid_wrapped(
 
     log("Resampling phase to grid:")
 
-    ph_grid = np.zeros((n_i, n_j), dtype=np.complex64)
-
-    if ph_in_predef is not None:
-        ph_grid_uw = np.zeros((n_i, n_j), dtype=np.complex64)
-        N_grid_uw = np.zeros((n_i, n_j), dtype=np.float32)
-
-    if np.min(ph_grid.shape) < prefilt_win:
+    if min(n_i, n_j) < prefilt_win:
         raise ValueError(
-            f"Minimum dimension of the resampled grid ({np.min(ph_grid.shape)} pixels) is less than prefilter window size ({prefilt_win})"
+            f"Minimum dimension of the resampled grid ({min(n_i, n_j)} pixels) is less than prefilter window size ({prefilt_win})"
         )
 
-    for i1 in range(n_ifg):
-        if np.isreal(ph_in).all():
-            ph_this = np.exp(1j * ph_in[:, i1])
-        else:
-            # DEBUG: default case
-            ph_this = ph_in[:, i1]
-
-        if ph_in_predef is not None:
-            # DEBUG: ignored by default
-            ph_this_uw = ph_in_predef[:, i1]
-            ph_grid_uw[:] = 0
-            N_grid_uw[:] = 0
+    # The grid cell of each PS is the same for all interferograms. Sorting the
+    # PS by cell lets us sum the phase of all interferograms in each cell with
+    # a single reduction over an (n_cells, n_ifg) target.
+    cell_ix = grid_ij[:, 0] * n_j + grid_ij[:, 1]
+    sort_ix = np.argsort(cell_ix, kind="stable")
+    cells, starts = np.unique(cell_ix[sort_ix], return_index=True)
 
-        ph_grid[:] = 0
-
-        if pix_size == 0:
-            ph_grid[(xy_in[:, 1] - 1) * n_i + xy_in[:, 2]] = ph_this
-            if ph_in_predef is not None:
-                ph_grid_uw[(xy_in[:, 1] - 1) * n_i + xy_in[:, 2]] = ph_this_uw
+    if np.isreal(ph_in).all():
+        ph_sorted = np.exp(1j * ph_in[sort_ix, :])
+    else:
+        # DEBUG: default case
+        ph_sorted = ph_in[sort_ix, :]
 
-        else:
-            # DEBUG: default case
-            for i in range(n_ps):
-                ph_grid[grid_ij[i, 0], grid_ij[i, 1]] += ph_this[i]
+    ph_grid = np.zeros((n_i * n_j, n_ifg), dtype=np.complex64)
+    ph_grid[cells] = np.add.reduceat(ph_sorted, starts, axis=0)
+    ph_grid = ph_grid.reshape(n_i, n_j, n_ifg)
 
-            if ph_in_predef is not None:
-                # DEBUG: ignored by default
-                for i in range(n_ps):
-                    if not np.isnan(ph_this_uw[i]):
-                        ph_grid_uw[grid_ij[i, 0], grid_ij[i, 1]] += ph_this_uw[i]
-                        N_grid_uw[grid_ij[i, 0], grid_ij[i, 1]] += 1
+    del ph_sorted
 
-                ph_grid_uw = ph_grid_uw / N_grid_uw
+    if ph_in_predef is not None:
+        # DEBUG: ignored by default
+        # Mean of the predefined unwrapped phase in each cell, ignoring NaNs
+        ph_sorted_uw = ph_in_predef[sort_ix, :]
+        valid = ~np.isnan(ph_sorted_uw)
+
+        ph_grid_uw = np.zeros((n_i * n_j, n_ifg), dtype=np.complex64)
+        N_grid_uw = np.zeros((n_i * n_j, n_ifg), dtype=np.float32)
+        ph_grid_uw[cells] = np.add.reduceat(
+            np.where(valid, ph_sorted_uw, 0), starts, axis=0
+        )
+        N_grid_uw[cells] = np.add.reduceat(valid.astype(np.int32), starts, axis=0)
 
-        if i1 == 0:
-            # DEBUG: default case
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ph_grid_uw = (ph_grid_uw / N_grid_uw).reshape(n_i, n_j, n_ifg)
 
-            nzix = ph_grid != 0
-            n_ps_grid = np.sum(nzix)
+        del ph_sorted_uw, valid, N_grid_uw
 
-            ph = np.zeros((n_ps_grid, n_ifg), dtype=np.complex64)
+    # Cells are numbered in column-major order, as in MATLAB
+    nzix = ph_grid[:, :, 0] != 0
+    n_ps_grid = np.sum(nzix)
 
-            if lowfilt_flag.lower() == "y":
-                ph_lowpass = ph
-            else:
-                # DEBUG: default case
-                ph_lowpass = None
+    ph = np.zeros((n_ps_grid, n_ifg), dtype=np.complex64)
 
-            if ph_in_predef is not None:
-                ph_uw_predef = np.zeros((n_ps_grid, n_ifg), dtype=np.complex64)
-            else:
-                # DEBUG: default case
-                ph_uw_predef = None
+    if lowfilt_flag.lower() == "y":
+        ph_lowpass = np.zeros((n_ps_grid, n_ifg), dtype=np.complex64)
+    else:
+        # DEBUG: default case
+        ph_lowpass = None
 
-        if goldfilt_flag.lower() == "y" or lowfilt_flag.lower() == "y":
-            # DEBUG: default case
-            ph_this_gold, ph_this_low = wrap_filter(
-                ph_grid, prefilt_win, gold_alpha, low_flag=lowfilt_flag
-            )
+    if goldfilt_flag.lower() == "y" or lowfilt_flag.lower() == "y":
+        # DEBUG: default case
+        ph_gold, ph_low = wrap_filter_stack(
+            ph_grid, prefilt_win, gold_alpha, low_flag=lowfilt_flag
+        )
 
-            if lowfilt_flag.lower() == "y" and ph_lowpass is not None:
-                ph_lowpass[:, i1] = ph_this_low[nzix]
+        if lowfilt_flag.lower() == "y" and ph_lowpass is not None:
+            ph_lowpass[:] = ph_low.transpose(1, 0, 2)[nzix.T]
 
-        if goldfilt_flag.lower() == "y":
-            # DEBUG: default case
-            ph[:, i1] = ph_this_gold.T[nzix.T]  # Matlab ravels in column-major order
-        else:
-            ph[:, i1] = ph_grid.T[nzix.T]
+        del ph_low
 
-        if ph_in_predef is not None and ph_uw_predef is not None:
-            ph_uw_predef[:, i1] = ph_grid_uw[nzix]
-            ix = ~np.isnan(ph_uw_predef[:, i1])
-            ph_diff = np.angle(ph[ix, i1] * np.conj(np.exp(1j * ph_uw_predef[ix, i1])))
-            ph_diff[np.abs(ph_diff) > 1] = np.nan
-            ph_uw_predef[ix, i1] = ph_uw_predef[ix, i1] + ph_diff
+    if goldfilt_flag.lower() == "y":
+        # DEBUG: default case
+        ph[:] = ph_gold.transpose(1, 0, 2)[nzix.T]  # Matlab ravels in column-major order
+        del ph_gold
+    else:
+        ph[:] = ph_grid.transpose(1, 0, 2)[nzix.T]
 
-        # check(f"ph_grid_{i1+1}", ph_grid, atol=1e-2, rtol=1e-2)
+    for i1 in range(n_ifg):
+        # check(f"ph_grid_{i1+1}", ph_grid[:, :, i1], atol=1e-2, rtol=1e-2)
         log(
             f"{i1+1:{len(str(n_ifg))}d}/{n_ifg}: "
-            f"nansum(abs(ph_grid)) = {np.nansum(np.abs(ph_grid)):.2f} "
-            f"nansum(abs(ph)) = {np.nansum(np.abs(ph)):.2f}"
+            f"nansum(abs(ph_grid)) = {np.nansum(np.abs(ph_grid[:, :, i1])):.2f} "
+            f"nansum(abs(ph)) = {np.nansum(np.abs(ph[:, i1])):.2f}"
         )
 
+    if ph_in_predef is not None:
+        # DEBUG: ignored by default
+        # Snap the predefined phase to within one radian of the filtered phase
+        ph_uw_predef = ph_grid_uw.transpose(1, 0, 2)[nzix.T]
+        with np.errstate(invalid="ignore"):
+            ph_diff = np.angle(ph * np.conj(np.exp(1j * ph_uw_predef)))
+            ph_diff[np.abs(ph_diff) > 1] = np.nan
+        ph_uw_predef += ph_diff
+        del ph_grid_uw
+    else:
+        # DEBUG: default case
+        ph_uw_predef = None
+
     n_ps = n_ps_grid
 
     log(f"Number of resampled points: {n_ps}")
 
-    check("ph_grid", ph_grid, tol=1e-2)
+    check("ph_grid", ph_grid[:, :, -1], tol=1e-2)
 
-    nz_j, nz_i = np.where(ph_grid.T != 0)
+    nz_j, nz_i = np.where(nzix.T)
     if pix_size == 0:
         xy = xy_in
     else:
@@ -6076,25 +7699,64 @@ def wrap_filter(
     - Filtered phase array. If low_flag is 'y', also returns low-pass filtered phase array.
     """
 
-    ph = np.array(ph_in, dtype=np.complex64)
+    ph_out, ph_out_low = wrap_filter_stack(
+        np.asarray(ph_in)[:, :, np.newaxis], n_win, alpha, n_pad, low_flag
+    )
+
+    if low_flag == "y":
+        ph_out_low = ph_out_low[:, :, 0]
+
+    return ph_out[:, :, 0], ph_out_low
+
+
+def wrap_filter_stack(
+    ph_in: Array,
+    n_win: int,
+    alpha: float,
+    n_pad: Optional[int] = None,
+    low_flag: str = "n",
+    workers: int = -1,
+    max_bytes: int = 2**29,
+) -> Tuple[Array, Array]:
+    """
+    Apply Goldstein adaptive and optional lowpass filtering to a stack of
+    gridded interferograms.
+
+    This gives the same result as applying `wrap_filter` to each interferogram
+    in turn. Interferograms are processed in chunks so the windows take at
+    most about `max_bytes` of memory: all windows of a chunk are extracted
+    from a strided view and filtered together, with the FFTs run on `workers`
+    threads, then overlap-added with `np.bincount` and written to the complex64
+    output. Apart from the output, memory does not grow with the number of
+    interferograms.
+
+    Parameters:
+    - ph_in: 3D numpy array of phase values (n_i, n_j, n_ifg).
+    - n_win: Size of the window for the filter.
+    - alpha: Alpha parameter for the Goldstein filter.
+    - n_pad: Padding size, default is 25% of n_win.
+    - low_flag: Flag for performing lowpass filtering ('y' for yes, 'n' for no).
+    - workers: Number of threads for the FFTs, -1 uses all CPUs.
+    - max_bytes: Approximate memory limit for the windows of a chunk.
+
+    Returns:
+    - Filtered phase stack. If low_flag is 'y', also returns low-pass filtered phase stack.
+    """
+
+    import scipy.fft
+    from scipy.ndimage import convolve1d
+    from numpy.lib.stride_tricks import sliding_window_view
 
     # Set default padding if not provided
     if n_pad is None:
         n_pad = round(n_win * 0.25)
 
     # Initialize variables and compute increments for window processing
-    n_i, n_j = ph.shape
+    n_i, n_j, n_ifg = np.shape(ph_in)
     n_inc = n_win // 2
     n_win_i = int(np.ceil(n_i / n_inc) - 1)
     n_win_j = int(np.ceil(n_j / n_inc) - 1)
-
-    # Initialize output arrays
-    ph_out = np.zeros_like(ph, dtype=ph.dtype)
-
-    if low_flag == "y":
-        ph_out_low = np.zeros_like(ph)
-    else:
-        ph_out_low = np.array([])
+    n_fft = n_win + n_pad
 
     # Create the wind function for filtering
     x = np.arange(1, n_win / 2 + 1)
@@ -6103,95 +7765,114 @@ def wrap_filter(
         [[X + Y, np.fliplr(X + Y)], [np.flipud(X + Y), np.flipud(np.fliplr(X + Y))]]
     )
 
-    # Replace NaN values with 0 in the input phase array
-    ph[np.isnan(ph)] = 0
-
-    # Create Gaussian windows for filtering
-    B = np.outer(gausswin(7), gausswin(7))
-    L = ifftshift(np.outer(gausswin(n_win + n_pad, 16), gausswin(n_win + n_pad, 16)))
-
-    ph_bit = np.zeros((n_win + n_pad, n_win + n_pad), dtype=ph.dtype)
-
-    HH = np.zeros((n_win_i, n_win_j), dtype=np.complex64)
-
-    for ix1 in range(n_win_i):
-        wf = wind_func.copy()
-        i1 = ix1 * n_inc + 1
-        i2 = i1 + n_win - 1
-        if i2 > n_i:  # Adjust the window if it exceeds the image bounds
-            i_shift = i2 - n_i
-            i2 = n_i
-            i1 = n_i - n_win + 1
-            wf = np.vstack((np.zeros((i_shift, n_win)), wf[: (n_win - i_shift), :]))
-
-        for ix2 in range(n_win_j):
-            wf2 = wf.copy()
-            j1 = ix2 * n_inc + 1
-            j2 = j1 + n_win - 1
-            if j2 > n_j:  # Adjust the window for the horizontal dimension
-                j_shift = j2 - n_j
-                j2 = n_j
-                j1 = n_j - n_win + 1
-                wf2 = np.hstack(
-                    (np.zeros((n_win, j_shift)), wf2[:, : (n_win - j_shift)])
-                )
-
-            # Initialize the phase bit for the current window
-            ph_bit[:n_win, :n_win] = ph[(i1 - 1) : i2, (j1 - 1) : j2]
+    # Window origins and window functions. Windows that would exceed the image
+    # bounds are moved back inside and their window function is shifted so
+    # that only the part beyond the previous window contributes.
+    i_start = np.arange(n_win_i) * n_inc
+    j_start = np.arange(n_win_j) * n_inc
+    i_shift = np.maximum(i_start + n_win - n_i, 0)
+    j_shift = np.maximum(j_start + n_win - n_j, 0)
+    i_start -= i_shift
+    j_start -= j_shift
+
+    # Rows and columns of the window function at each position of the shifted
+    # windows, negative where the shift brings in zeros
+    i_src = np.arange(n_win)[np.newaxis, :] - i_shift[:, np.newaxis]
+    j_src = np.arange(n_win)[np.newaxis, :] - j_shift[:, np.newaxis]
+    wfs = (
+        wind_func[
+            np.maximum(i_src, 0)[:, np.newaxis, :, np.newaxis],
+            np.maximum(j_src, 0)[np.newaxis, :, np.newaxis, :],
+        ]
+        * (i_src >= 0)[:, np.newaxis, :, np.newaxis]
+        * (j_src >= 0)[np.newaxis, :, np.newaxis, :]
+    )
 
-            # Apply FFT and filter the phase data
-            ph_fft = np.fft.fft2(ph_bit)
-            H = np.abs(ph_fft)
-            H = ifftshift(
-                convolve2d(fftshift(H), B, mode="same")
-            )  # Smooth the frequency response
+    # Flat index in the (n_i, n_j) grid of every pixel of every window, used
+    # to overlap-add the filtered windows with one `np.bincount`
+    pix = (
+        (i_start[:, np.newaxis] + np.arange(n_win))[:, np.newaxis, :, np.newaxis] * n_j
+        + (j_start[:, np.newaxis] + np.arange(n_win))[np.newaxis, :, np.newaxis, :]
+    )[:, :, np.newaxis]
 
-            medianH = np.median(H)
-            if medianH != 0:
-                H = (H / medianH) ** alpha
-            else:
-                H = H**alpha
+    def overlap_add(ph_filt: Array) -> Array:
+        n_chunk = ph_filt.shape[2]
+        ix = (pix + n_i * n_j * np.arange(n_chunk)[:, np.newaxis, np.newaxis]).ravel()
+        acc = np.empty(n_chunk * n_i * n_j, dtype=np.complex64)
+        acc.real = np.bincount(ix, ph_filt.real.ravel(), minlength=acc.size)
+        acc.imag = np.bincount(ix, ph_filt.imag.ravel(), minlength=acc.size)
+        return np.moveaxis(acc.reshape(n_chunk, n_i, n_j), 0, -1)
 
-            HH[ix1, ix2] = np.mean(np.abs(ph_bit))
+    # Gaussian windows for filtering. B is separable so the smoothing of the
+    # frequency response is done as two 1D convolutions.
+    b = gausswin(7)
+    L = ifftshift(np.outer(gausswin(n_fft, 16), gausswin(n_fft, 16)))
 
-            # Apply inverse FFT and window function
-            ph_filt = np.fft.ifft2(ph_fft * H)
+    ph_out = np.zeros((n_i, n_j, n_ifg), dtype=np.complex64)
 
-            ph_filt = ph_filt[:n_win, :n_win] * wf2
+    if low_flag == "y":
+        ph_out_low = np.zeros((n_i, n_j, n_ifg), dtype=np.complex64)
+    else:
+        ph_out_low = np.array([])
 
-            # Optionally apply lowpass filtering
-            if low_flag == "y":
-                ph_filt_low = (
-                    np.fft.ifft2(ph_fft * L)[:n_win, :n_win] * wf2
-                )  # Lowpass filter
-                ph_out_low[i1 - 1 : i2, j1 - 1 : j2] += ph_filt_low
+    # A window takes one complex64 FFT (scipy.fft keeps single precision) and
+    # float32 and complex64 temporaries of the same shape, which peak at about
+    # 35 bytes per FFT element, or 43 with the lowpass filter. 64 bytes leaves
+    # room for the smaller (n_win, n_win) temporaries.
+    chunk = max(1, max_bytes // (64 * n_win_i * n_win_j * n_fft**2))
+
+    for k1 in range(0, n_ifg, chunk):
+        k2 = min(k1 + chunk, n_ifg)
+
+        # Replace NaN values with 0 in the input phase
+        ph = np.array(ph_in[:, :, k1:k2], dtype=np.complex64)
+        ph[np.isnan(ph)] = 0
+
+        # Strided view of the (n_win, n_win) windows, as
+        # (n_win_i, n_win_j, n_chunk, n_win, n_win)
+        views = sliding_window_view(ph, (n_win, n_win), axis=(0, 1))
+        ph_bits = views[i_start[:, np.newaxis], j_start[np.newaxis, :]]
+
+        # Apply FFT (zero padded to n_fft) and filter the phase data
+        ph_fft = scipy.fft.fft2(ph_bits, s=(n_fft, n_fft), workers=workers)
+        del ph_bits, views
+
+        H = scipy.fft.fftshift(np.abs(ph_fft), axes=(-2, -1))
+        H = convolve1d(H, b, axis=-1, mode="constant")
+        H = convolve1d(H, b, axis=-2, mode="constant")
+        H = scipy.fft.ifftshift(H, axes=(-2, -1))  # Smooth the frequency response
+
+        medianH = np.median(H, axis=(-2, -1), keepdims=True)
+        H = np.where(medianH != 0, H / np.where(medianH != 0, medianH, 1), H)
+        H **= alpha
+
+        # Apply inverse FFT and window function, then overlap-add the
+        # filtered windows and reset the magnitude to match the input phase
+        ph_filt = scipy.fft.ifft2(ph_fft * H, workers=workers)
+        del H
+        ph_filt = ph_filt[..., :n_win, :n_win] * wfs[:, :, np.newaxis]
+        ph_out[:, :, k1:k2] = np.abs(ph) * np.exp(1j * np.angle(overlap_add(ph_filt)))
+        del ph_filt
 
-            # Update the output array with filtered data
-            ph_out[i1 - 1 : i2, j1 - 1 : j2] = (
-                ph_out[i1 - 1 : i2, j1 - 1 : j2] + ph_filt
+        # Optionally apply lowpass filtering
+        if low_flag == "y":
+            ph_filt = scipy.fft.ifft2(ph_fft * L, workers=workers)
+            ph_filt = ph_filt[..., :n_win, :n_win] * wfs[:, :, np.newaxis]
+            ph_out_low[:, :, k1:k2] = np.abs(ph) * np.exp(
+                1j * np.angle(overlap_add(ph_filt))
             )
+            del ph_filt
 
-    # Reset the magnitude of the output phase to match the input phase
-    ph_out = abs(ph) * np.exp(1j * np.angle(ph_out))
-
-    if low_flag == "y":
-        ph_out_low = abs(ph) * np.exp(1j * np.angle(ph_out_low))  # Reset magnitude
+        del ph_fft
 
     return ph_out, ph_out_low
 
 
-def dsearchn(data: Array, query: Array) -> Tuple[Array, Array]:
-    """
-    Find nearest neighbors for query points in data set.
-    """
-    tree = KDTree(data, leafsize=10)
-    dist, idx = tree.query(query, p=2, k=1)
-    return np.array(idx), np.array(dist)
-
-
 def uw_interp() -> None:
     """Interpolate grid using nearest neighbour."""
 
+    from scipy.ndimage import distance_transform_edt
+
     log("Interpolating grid")
 
     # uw_grid_wrapped generated the file `uw_grid`
@@ -6202,106 +7883,57 @@ def uw_interp() -> None:
     nzix = uw.nzix
 
     nrow, ncol = nzix.shape
-    II, JJ = np.meshgrid(np.arange(1, nrow + 1), np.arange(1, ncol + 1))
-    PQ = np.column_stack((II.ravel(), JJ.ravel()))
 
     # Make i,j the indices of the non-zero indices which are the
     # pixel locations of the PS points in the grid (1-based indexing)
     jj, ii = np.where(nzix.T)
     ij = np.column_stack((np.arange(1, n_ps + 1), ii + 1, jj + 1))
 
-    use_triangle = True
-    if use_triangle:
-        log("Using TRIANGLE to generate a Delaunay triangulation")
-
-        nodepath = Path("unwrap.1.node")
-        with open(nodepath, "w") as fid:
-            fid.write(f"{n_ps} 2 0 0\n")
-            np.savetxt(fid, ij, fmt="%d %d %d")
-
-        run_triangle_on(nodepath)
-
-        with open("unwrap.2.edge", "r") as fid:
-            header = np.fromstring(fid.readline(), sep=" ", dtype=int)
-            N = header[0]
-            edgs = np.loadtxt(fid, dtype=int)
-
-        n_edge = edgs.shape[0]
-        if n_edge != N:
-            raise ValueError("missing lines in unwrap.2.edge")
-
-        with open("unwrap.2.ele", "r") as fid:
-            header = np.fromstring(fid.readline(), sep=" ", dtype=int)
-            N = header[0]
-            ele = np.loadtxt(fid, dtype=int)
-
-        n_ele = ele.shape[0]
-        if n_ele != N:
-            raise ValueError("missing lines in unwrap.2.ele")
-
-        P = ij[:, 1:]
-        # Z is the index (0-indexing) of the nearest point in P for each point in PQ
-        Z, D = dsearchn(P, PQ)
-
-        Z = Z.reshape(nrow, ncol)
-        D = D.reshape(nrow, ncol)
-
-    else:
-        log("Using scipy.Delaunay for interpolation")
-        raise NotImplementedError
+    # Z is the index (1-based, as in the PS numbering of `ij`) of the PS in
+    # the nearest non-empty cell of every grid cell. The indices returned by
+    # the exact Euclidean distance transform are those of the nearest
+    # non-empty cell, so no triangulation or tree search is needed.
+    ps_grid = np.zeros((nrow, ncol), dtype=np.int64)
+    ps_grid.T[nzix.T] = ij[:, 0]
 
-        from scipy.spatial import Delaunay
-
-        tri = Delaunay(ij[:, 1:])
-        ele = tri.simplices
-        edgs = tri.convex_hull
-
-        n_edge = edgs.shape[0]
-        edgs = np.column_stack(([np.arange(1, n_edge + 1), edgs]))
-        n_ele = ele.shape[0]
-        ele = np.column_stack(([np.arange(1, n_ele + 1), ele]))
-        Z = tri.find_simplex(np.column_stack((II.ravel(), JJ.ravel())))
+    near_i, near_j = distance_transform_edt(
+        ~nzix, return_distances=False, return_indices=True
+    )
+    Z = ps_grid[near_i, near_j]
 
     if DEBUG:
         # Hard to get the same results as the original code as there could be
         # multiple solutions for the nearest neighbors
         Z = loadmat("Z")["Z"]
 
-    # Identify the grid edges
-    Zvec = np.ravel(Z.T)  # Column edges
-    grid_edges = np.vstack((Zvec[:-nrow], Zvec[nrow:])).T
-    Zvec = np.ravel(Z)  # Add the row edges
-    grid_edges = np.vstack(
-        (grid_edges, np.column_stack((Zvec[:-ncol], Zvec[ncol:])))
-    )  # OK
-    del Zvec
-
-    # Sort each edge to have lowest pixel node first
-    I_sort = np.argsort(grid_edges, axis=1)
-    sort_edges = np.take_along_axis(grid_edges, I_sort, axis=1)
-    edge_sign = I_sort[:, 1] - I_sort[:, 0]  # OK
-
-    alledges, II, JJ = np.unique(
-        sort_edges, axis=0, return_index=True, return_inverse=True
-    )
-    sameix = alledges[:, 0] == alledges[:, 1]
-    alledges[sameix, :] = 0  # Set edges connecting identical nodes to (0,0)
+    # Identify the grid edges between cells with different nearest PS, with
+    # the lowest PS first. The sign records whether the grid direction (down
+    # or right) runs from the first to the second PS of the edge.
+    def grid_edges(z1: Array, z2: Array) -> Tuple[Array, Array]:
+        key = np.minimum(z1, z2) * (n_ps + 1) + np.maximum(z1, z2)
+        key[z1 == z2] = 0
+        return key, np.where(z1 > z2, -1, 1)
 
-    # (I+1) matches, (J+1) matches
+    colkey, colsign = grid_edges(Z[:, :-1], Z[:, 1:])
+    rowkey, rowsign = grid_edges(Z[:-1, :], Z[1:, :])
 
-    check("alledges", alledges)
+    # Edges are numbered from 1 in order of their PS, 0 is no edge
+    keys, inverse = np.unique(
+        np.concatenate((colkey.ravel(), rowkey.ravel())), return_inverse=True
+    )
+    if keys[0] != 0:
+        keys = np.insert(keys, 0, 0)
+        inverse += 1
 
-    edgs, I2, J2 = np.unique(alledges, axis=0, return_index=True, return_inverse=True)
-    # We drop (0,0) edge from the list, so we have (n_edge - 1) edges
-    n_edge = I2.shape[0] - 1
-    edgs = np.column_stack(([np.arange(1, n_edge + 1), edgs[1:, :]]))  # OK
+    n_edge = len(keys) - 1
+    edgs = np.column_stack(
+        (np.arange(1, n_edge + 1), keys[1:] // (n_ps + 1), keys[1:] % (n_ps + 1))
+    )
 
     check("edgs", edgs)
 
-    gridedgeix = J2[JJ] * edge_sign
-
-    colix = gridedgeix[: nrow * (ncol - 1)].reshape(ncol - 1, nrow).T
-    rowix = gridedgeix[nrow * (ncol - 1) :].reshape(nrow - 1, ncol)
+    colix = inverse[: colkey.size].reshape(colkey.shape) * colsign
+    rowix = inverse[colkey.size :].reshape(rowkey.shape) * rowsign
 
     log(f"Number of unique edges in grid: {n_edge}")
 
@@ -6314,89 +7946,6 @@ def uw_interp() -> None:
     log("Interpolation done")
 
 
-def ps_setref():
-    """
-    Find reference PS.
-    """
-
-    log("Setting reference PS")
-
-    psver = get_psver()
-
-    ps_temp = stamps_load(f"ps{psver}")
-    assert isinstance(ps_temp, dotdict)
-
-    if ps is None:
-        ps = ps_temp
-    else:
-        ps["ll0"] = ps_temp["ll0"]
-        ps["n_ps"] = ps["lonlat"].shape[0]
-
-    del ps_temp
-
-    param = getparm("ref_x")
-    if param != "":
-        parmname = param.split(" ")[1]
-    else:
-        parmname = ""
-
-
-    if parmname == "ref_x":
-        ref_x = getparm("ref_x")
-        ref_y = getparm("ref_y")
-        ref_ps = np.where(
-            (ps["xy"][:, 1] > ref_x[0])
-            & (ps["xy"][:, 1] < ref_x[1])
-            & (ps["xy"][:, 2] > ref_y[0])
-            & (ps["xy"][:, 2] < ref_y[1])
-        )[0]
-
-    else:
-        ref_lon = np.fromstring(getparm("ref_lon"), sep=" ")
-        ref_lat = np.fromstring(getparm("ref_lat"), sep=" ")
-        ref_centre_lonlat = np.fromstring(getparm("ref_centre_lonlat"), sep=" ")
-        ref_radius = float(getparm("ref_radius"))
-
-        print(f"{ref_lon = }")
-        print(f"{ref_lat = }")
-        print(f"{ref_centre_lonlat = }")
-        print(f"{ref_radius = }")
-
-        if ref_radius == -np.inf:
-            ref_ps = np.array([0])
-
-        else:
-            ref_ps = np.where(
-                (ps["lonlat"][:, 0] > ref_lon[0])
-                & (ps["lonlat"][:, 0] < ref_lon[1])
-                & (ps["lonlat"][:, 1] > ref_lat[0])
-                & (ps["lonlat"][:, 1] < ref_lat[1])
-            )[0]
-
-            if ref_radius < np.inf:
-                ref_xy = llh2local(ref_centre_lonlat.T, ps["ll0"]) * 1000
-                xy = llh2local(ps["lonlat"][ref_ps, :].T, ps["ll0"]) * 1000
-                dist_sq = (xy[0, :] - ref_xy[0]) ** 2 + (xy[1, :] - ref_xy[1]) ** 2
-                ref_ps = ref_ps[dist_sq <= ref_radius**2]
-
-    if len(ref_ps) == 0:
-        if ps is not None:
-            log(
-                "None of your external data points have a reference, all are set as reference."
-            )
-            ref_ps = np.arange(ps.n_ps)
-
-    if ps is None:
-        if ref_ps == 0:
-            log("No reference set")
-        else:
-            log(f"{len(ref_ps)} ref PS selected")
-
-    log(f"Reference PS: {ref_ps}")
-
-    return ref_ps
-
-
 def lscov(A: Array, B: Array, w: Array) -> Array:
     """
     Solves the weighted least squares problem given by A*x = B with weights w.
@@ -6489,90 +8038,11 @@ def print_accuracy(*args: str, tol: float = 1e-6) -> None:
 
     tabulate(table)
 
-    if len(not_found) > 0:
-        log("")
-        log("ERROR, Files not found:")
-        for nf in not_found:
-            log(f"  {nf}")
-
-def ps_deramp(
-    ps: dotdict, ph_all: Array, degree: Optional[int] = None
-) -> Tuple[Array, Array]:
-    """
-    Deramps the data. Deramping is done by fitting a polynomial to the data and
-    subtracting it from the original data.
-    """
-
-    if degree is None:
-        try:
-            degree = int(stamps_load("deramp_degree"))
-            log("Deramping degree loaded from file `deramp_degree`")
-        except (FileNotFoundError, IOError):
-            degree = 1
-
-    log(f"{degree = }")
-
-    # SM from SB inversion deramping
-    if ps.n_ifg != ph_all.shape[1]:
-        ps["n_ifg"] = ph_all.shape[1]
-
-    # detrenting of the data
-    if degree == 1:
-        # z = ax + by + c
-        A = np.column_stack((ps.xy[:, 1:] / 1000, np.ones((ps.n_ps, 1))))
-        log("**** z = ax + by + c")
-
-    elif degree == 1.5:
-        # z = ax + by + cxy + d
-        A = np.column_stack(
-            (
-                ps.xy[:, 1:] / 1000,
-                (ps.xy[:, 1] / 1000) * (ps.xy[:, 2] / 1000),
-                np.ones((ps.n_ps, 1)),
-            )
-        )
-        log("**** z = ax + by + cxy + d")
-
-    elif degree == 2:
-        # z = ax^2 + by^2 + cxy + d
-        A = np.column_stack(
-            (
-                ((ps.xy[:, 1:] / 1000) ** 2),
-                (ps.xy[:, 1] / 1000) * (ps.xy[:, 2] / 1000),
-                np.ones((ps.n_ps, 1)),
-            )
-        )
-        log("**** z = ax^2 + by^2 + cxy + d")
-
-    elif degree == 3:
-        # z = ax^3 + by^3 + cx^2y + dy^2x + ex^2 + fy^2 + gxy + h
-        A = np.column_stack(
-            (
-                ((ps.xy[:, 1:] / 1000) ** 3),
-                ((ps.xy[:, 1] / 1000) ** 2 * (ps.xy[:, 2] / 1000)),
-                ((ps.xy[:, 2] / 1000) ** 2 * (ps.xy[:, 1] / 1000)),
-                ((ps.xy[:, 1:] / 1000) ** 2),
-                (ps.xy[:, 1] / 1000) * (ps.xy[:, 2] / 1000),
-                np.ones((ps.n_ps, 1)),
-            )
-        )
-        log("**** z = ax^3 + by^3 + cx^2y + dy^2x + ex^2 + fy^2 + gxy + h")
-
-    else:
-        raise ValueError("Invalid degree value. Expected 1, 1.5, 2, or 3.")
-
-    ph_ramp = np.full(ph_all.shape, np.nan)
-    for k in range(ps.n_ifg):
-        ix = np.isnan(ph_all[:, k])
-        if ps.n_ps - np.sum(ix) > 5:
-            coeff = np.linalg.lstsq(A[~ix, :], ph_all[~ix, k], rcond=None)[0]
-            ph_ramp[:, k] = np.dot(A, coeff)
-            ph_all[:, k] -= ph_ramp[:, k]
-        else:
-            log(f"Ifg {k + 1} is not deramped")
-
-    return ph_all, ph_ramp
-
+    if len(not_found) > 0:
+        log("")
+        log("ERROR, Files not found:")
+        for nf in not_found:
+            log(f"  {nf}")
 
 def stage7_calc_scla(
     use_small_baselines: int = 0, coest_mean_vel: int = 0, opts: dotdict = dotdict()
@@ -6620,12 +8090,12 @@ def stage7_calc_scla(
         apsname = f"./tca_sb{psver}"
 
     if use_small_baselines == 0:
-        Path(meanvname).unlink(missing_ok=True)
+        stamps_remove(meanvname)
 
     ps = stamps_load(psname)
     assert isinstance(ps, dotdict)
 
-    if Path(bpname).exists():
+    if stamps_exists(bpname):
         bp = stamps_load(bpname)
     else:
         bperp = ps.bperp
@@ -6662,7 +8132,7 @@ def stage7_calc_scla(
 
     unwrap_ifg_index = np.setdiff1d(unwrap_ifg_index, scla_drop_index)
 
-    if Path(apsname_old).exists():
+    if stamps_exists(apsname_old):
         if subtr_tropo == "y":
             log("You are removing atmosphere twice, do not do this.")
         aps = stamps_load(apsname_old)
@@ -6741,7 +8211,7 @@ def stage7_calc_scla(
             if "sb_cov" in phuwres:
                 ifg_vcm = phuwres.sb_cov
     else:
-        if Path(ifgstdname).exists():
+        if stamps_exists(ifgstdname):
             ifgstd = stamps_load(ifgstdname)
             ifg_vcm = np.diag((ifgstd.ifg_std * np.pi / 180) ** 2)
             del ifgstd
@@ -6758,13 +8228,11 @@ def stage7_calc_scla(
 
 
     if scla_method == "L1":
-        for i in range(ps.n_ps):
-            d = ph[i, :]
-            m2 = least_squares(lambda x: d - G @ x, m[:, i]).x
-            K_ps_uw[i] = m2[1]
+        # Refit with an L1 misfit, starting from the weighted L2 solution
+        m2, n_not_converged = lscov_l1(G, ph.T, m)
+        K_ps_uw = m2[1, :]
 
-            if i % 10000 == 0:
-                log(f"{i} of {ps.n_ps} pixels processed")
+        log(f"L1 fit did not converge for {n_not_converged} of {ps.n_ps} PS")
 
     ph_scla = np.tile(K_ps_uw[:, np.newaxis], (1, bperp_mat.shape[1])) * bperp_mat
 
@@ -6780,19 +8248,26 @@ def stage7_calc_scla(
         mean_vel_C_ps_uw = lscov(
             G,
             (uw.ph_uw[:, unwrap_ifg_index] - ph_scla[:, unwrap_ifg_index]).T*56/(-4)/np.pi,
-            ifg_vcm[unwrap_ifg_index - 1, unwrap_ifg_index - 1],
+            ifg_vcm[unwrap_ifg_index, unwrap_ifg_index],
         )
 
         phuw = stamps_load(phuwname)
         uw_2 = phuw["ph_uw"]
 
-        mean_vel_ps_uw = lscov(
-            G,
-            uw_2[:, unwrap_ifg_index].T*56/(-4)/np.pi,
-            ifg_vcm[unwrap_ifg_index - 1, unwrap_ifg_index - 1],
+        mv = ps_mean_velocity(G, uw_2, ifg_vcm, unwrap_ifg_index)
+
+        np.savetxt("mean_velocity_test.txt", mv.x[1, :] * 365)
+
+        stamps_save(
+            meanvname,
+            mean_v=mv.x[1, :] * 365,  # mean velocity (n_ps,) - mm/yr
+            mean_v_std=mv.x_std[1, :] * 365,  # its standard error (n_ps,) - mm/yr
+            intercept=mv.x[0, :],  # (n_ps,) - mm
+            intercept_std=mv.x_std[0, :],  # (n_ps,) - mm
+            rms=mv.rms,  # RMS of the residuals (n_ps,) - mm
         )
 
-        np.savetxt("mean_velocity_test.txt", mean_vel_ps_uw[1,:]*365)
+        log(f"Mean velocity of {np.count_nonzero(np.isnan(mv.x[1, :]))} PS could not be estimated")
 
         np.savetxt("day_diff.txt", G[:,1])
 
@@ -6815,7 +8290,7 @@ def stage7_calc_scla(
             m = lscov(
                 G,
                 (uw.ph_uw[:, unwrap_ifg_index] - ph_scla[:, unwrap_ifg_index]).T,
-                ifg_vcm[unwrap_ifg_index - 1, unwrap_ifg_index - 1],
+                ifg_vcm[unwrap_ifg_index, unwrap_ifg_index],
             )
             C_ps_uw = m[0, :]
 
@@ -6839,12 +8314,49 @@ def stage7_calc_scla(
 
     TS = ts_export_csv()
 
+def ps_mean_velocity(G: Array, ph_uw: Array, ifg_vcm: Array, ifg_index: Array) -> dotdict:
+    """
+    Fit the design matrix `G` (intercept and days since the master) to the
+    unwrapped phase `ph_uw` (n_ps, n_ifg) of the interferograms `ifg_index`
+    (0-based) for all PS, with formal errors from the covariance `ifg_vcm`
+    (n_ifg, n_ifg) of the interferograms. The phase is converted to mm, so
+    the results are as from `lscov_batch` in mm and mm/day.
+
+    Interferograms without a noise estimate (zero variance) would get
+    infinite weight, so they are left out of the fit.
+    """
+
+    vcm = ifg_vcm[np.ix_(ifg_index, ifg_index)]
+    use = np.diag(vcm) > 0
+
+    if not np.all(use):
+        log(
+            f"{np.count_nonzero(~use)} interferograms with zero variance "
+            "not used for the mean velocity"
+        )
+
+    return lscov_batch(
+        G[use],
+        ph_uw[:, ifg_index[use]].T * 56 / (-4) / np.pi,
+        vcm[np.ix_(use, use)],
+    )
+
+
 def ps_deramp(
-    ps: dotdict, ph_all: Array, degree: Optional[int] = None
+    ps: dotdict,
+    ph_all: Array,
+    degree: Optional[int] = None,
+    grid_size: Optional[float] = None,
 ) -> Tuple[Array, Array]:
     """
     Deramps the data. Deramping is done by fitting a polynomial to the data and
     subtracting it from the original data.
+
+    Interferograms with the same pattern of NaN values share a design matrix,
+    so all of them are fitted with a single least-squares factorisation. With
+    a `grid_size` (in metres, default from `deramp_grid_size`) greater than
+    zero, the polynomial is fitted to one PS per grid cell only and then
+    evaluated at every PS, which bounds the cost for very large PS sets.
     """
 
     if degree is None:
@@ -6905,38 +8417,215 @@ def ps_deramp(
     else:
         raise ValueError("Invalid degree value. Expected 1, 1.5, 2, or 3.")
 
+    if grid_size is None:
+        grid_size = float(getparm("deramp_grid_size"))
+
+    # PS used to fit the ramps
+    if grid_size > 0:
+        cell = np.floor(ps.xy[:, 1:] / grid_size).astype(np.int64)
+        _, fit_ix = np.unique(cell, axis=0, return_index=True)
+        log(f"Fitting ramps to {len(fit_ix)} of {ps.n_ps} PS")
+    else:
+        fit_ix = np.arange(ps.n_ps)
+
+    A_fit = A[fit_ix, :]
+    nan_fit = np.isnan(ph_all[fit_ix, :])
+
+    # Group the interferograms by the NaN pattern of the PS used in the fit
+    if nan_fit.any():
+        _, group = np.unique(
+            np.packbits(nan_fit, axis=0).T, axis=0, return_inverse=True
+        )
+        group = group.ravel()
+    else:
+        group = np.zeros(ps.n_ifg, dtype=np.int64)
+
     ph_ramp = np.full(ph_all.shape, np.nan)
-    for k in range(ps.n_ifg):
-        ix = np.isnan(ph_all[:, k])
-        if ps.n_ps - np.sum(ix) > 5:
-            coeff = np.linalg.lstsq(A[~ix, :], ph_all[~ix, k], rcond=None)[0]
-            ph_ramp[:, k] = np.dot(A, coeff)
-            ph_all[:, k] -= ph_ramp[:, k]
+    for g in np.unique(group):
+        cols = np.flatnonzero(group == g)
+        ix = nan_fit[:, cols[0]]
+
+        if len(fit_ix) - np.sum(ix) > 5:
+            coeff = np.linalg.lstsq(
+                A_fit[~ix, :], ph_all[fit_ix[~ix]][:, cols], rcond=None
+            )[0]
+            ph_ramp[:, cols] = A @ coeff
+            ph_all[:, cols] -= ph_ramp[:, cols]
         else:
-            log(f"Ifg {k + 1} is not deramped")
+            for k in cols:
+                log(f"Ifg {k + 1} is not deramped")
 
     return ph_all, ph_ramp
 
 
+def ps_spatial_index(psver: int) -> dotdict:
+    """
+    KD-tree over the local coordinates of the PS of version `psver`.
+
+    The local coordinates (metres from `ll0`, as given by `llh2local`) are
+    computed once and cached beside the ps file as `ps{psver}_index`. The tree is
+    kept in memory for as long as the ps file is unchanged.
+
+    Returns a dotdict with `tree`, `xy` (n_ps, 2), `lonlat` (n_ps, 2) and `ll0`.
+    """
+
+    fn = stamps_file(f"ps{psver}")
+    key = str(fn.resolve())
+    mtime = fn.stat().st_mtime_ns
+
+    if key in PS_INDEX_CACHE and PS_INDEX_CACHE[key].source_mtime == mtime:
+        return PS_INDEX_CACHE[key]
+
+    index_name = f"ps{psver}_index"
+    index = None
+
+    if stamps_exists(index_name):
+        index = stamps_load(index_name)
+        assert isinstance(index, dotdict)
+        if index.source_mtime != mtime:
+            index = None
+
+    if index is None:
+        log(f"Building spatial index of ps{psver}")
+        ps = stamps_load(f"ps{psver}")
+        assert isinstance(ps, dotdict)
+        lonlat = np.array(ps.lonlat)
+        ll0 = np.ravel(ps.ll0)
+        del ps
+        xy = ps_local_xy(lonlat, ll0)
+        stamps_save(index_name, xy=xy, lonlat=lonlat, ll0=ll0, source_mtime=mtime)
+        index = dotdict(xy=xy, lonlat=lonlat, ll0=ll0, source_mtime=mtime)
+
+    index["tree"] = KDTree(index.xy)
+
+    PS_INDEX_CACHE[key] = index
+    return index
+
+
+def ps_local_xy(lonlat: Array, ll0: Array) -> Array:
+    """Local (x, y) coordinates in metres of (n, 2) `lonlat` relative to `ll0`."""
+    return (llh2local(lonlat.T, np.reshape(ll0, (-1, 1))) * 1000).T
+
+
+def ps_select(
+    index: dotdict,
+    lon: Optional[Array] = None,
+    lat: Optional[Array] = None,
+    centre_lonlat: Optional[Array] = None,
+    radius: float = np.inf,
+    k: int = 0,
+) -> Array:
+    """
+    Select PS from a spatial index (see `ps_spatial_index`) in one or more
+    reference regions, and return the sorted indices of all of them.
+
+    Region `i` is the box between `lon[2i]`, `lon[2i+1]` and `lat[2i]`,
+    `lat[2i+1]`, optionally limited to the `radius` (metres) around centre `i`
+    of `centre_lonlat` (lon, lat pairs), or to the `k` PS in the box nearest
+    to that centre. Without boxes the regions are the circles or nearest PS
+    around the centres alone. Candidates are found with the KD-tree and only
+    those are tested exactly. Boxes with infinite bounds, such as StaMPS'
+    default "-inf inf" for no restriction, are tested against all PS.
+    """
+
+    lonlat = index.lonlat
+    boxes = (
+        np.reshape(np.column_stack((np.reshape(lon, (-1, 2)), np.reshape(lat, (-1, 2)))), (-1, 4))
+        if lon is not None and lat is not None and len(lon) > 0
+        else np.empty((0, 4))
+    )
+    centres = (
+        np.reshape(centre_lonlat, (-1, 2))
+        if centre_lonlat is not None and len(centre_lonlat) > 0
+        else np.empty((0, 2))
+    )
+
+    n_region = max(len(boxes), len(centres))
+    selected = []
+
+    for i in range(n_region):
+        box = boxes[i] if i < len(boxes) else None
+        centre = centres[i] if i < len(centres) else None
+
+        if centre is not None:
+            centre_xy = ps_local_xy(centre[np.newaxis, :], index.ll0)[0]
+
+        if box is not None:
+            if np.all(np.isfinite(box)):
+                # Ball around the box that contains all of it
+                corners = np.array(np.meshgrid(box[:2], box[2:])).reshape(2, -1).T
+                corners_xy = ps_local_xy(corners, index.ll0)
+                box_centre = corners_xy.mean(axis=0)
+                box_radius = np.max(np.linalg.norm(corners_xy - box_centre, axis=1))
+                cand = np.array(
+                    index.tree.query_ball_point(box_centre, box_radius * 1.01 + 1),
+                    dtype=np.int64,
+                )
+            else:
+                # An unbounded box has no enclosing ball
+                cand = np.arange(len(lonlat))
+
+            cand = cand[
+                (lonlat[cand, 0] > box[0])
+                & (lonlat[cand, 0] < box[1])
+                & (lonlat[cand, 1] > box[2])
+                & (lonlat[cand, 1] < box[3])
+            ]
+
+            if centre is not None and k > 0:
+                dist = np.linalg.norm(index.xy[cand] - centre_xy, axis=1)
+                cand = cand[np.argsort(dist, kind="stable")[:k]]
+            elif centre is not None and radius < np.inf:
+                dist_sq = np.sum((index.xy[cand] - centre_xy) ** 2, axis=1)
+                cand = cand[dist_sq <= radius**2]
+
+        elif centre is not None and k > 0:
+            _, cand = index.tree.query(centre_xy, k=min(k, len(lonlat)))
+            cand = np.atleast_1d(cand)
+
+        elif centre is not None and radius < np.inf:
+            cand = np.array(index.tree.query_ball_point(centre_xy, radius), dtype=np.int64)
+
+        else:
+            cand = np.arange(len(lonlat))
+
+        selected.append(np.asarray(cand, dtype=np.int64))
+
+    if len(selected) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    return np.unique(np.concatenate(selected))
+
+
 def ps_setref(ps: Optional[dotdict] = None) -> Array:
     """
     Find reference PS.
+
+    The reference regions come from `ref_lon`/`ref_lat` (boxes, as pairs of
+    values), `ref_centre_lonlat` (centres, as lon, lat pairs), `ref_radius`
+    and `ref_nearest` (number of PS nearest to each centre, 0 for all within
+    the radius). Several regions are given by listing several pairs. The PS of
+    the current version are searched through their cached spatial index.
+    `ps` can be given to select from other points (e.g., external data).
     """
 
     log("Setting reference PS")
 
     psver = get_psver()
 
-    ps_temp = stamps_load(f"ps{psver}")
-    assert isinstance(ps_temp, dotdict)
+    index = ps_spatial_index(psver)
 
     if ps is None:
-        ps = ps_temp
+        n_ps = len(index.lonlat)
+        xy = None
     else:
-        ps["ll0"] = ps_temp["ll0"]
-        ps["n_ps"] = ps["lonlat"].shape[0]
-
-    del ps_temp
+        lonlat = np.asarray(ps["lonlat"])
+        xy_ext = ps_local_xy(lonlat, index.ll0)
+        index = dotdict(xy=xy_ext, lonlat=lonlat, ll0=index.ll0, tree=KDTree(xy_ext))
+        ps["ll0"] = index.ll0
+        ps["n_ps"] = lonlat.shape[0]
+        n_ps = ps["n_ps"]
+        xy = ps.get("xy")
 
     param = getparm("ref_x")
     if param != "":
@@ -6944,15 +8633,16 @@ def ps_setref(ps: Optional[dotdict] = None) -> Array:
     else:
         parmname = ""
 
-
     if parmname == "ref_x":
+        if xy is None:
+            xy = stamps_load(f"ps{psver}")["xy"]
         ref_x = getparm("ref_x")
         ref_y = getparm("ref_y")
         ref_ps = np.where(
-            (ps["xy"][:, 1] > ref_x[0])
-            & (ps["xy"][:, 1] < ref_x[1])
-            & (ps["xy"][:, 2] > ref_y[0])
-            & (ps["xy"][:, 2] < ref_y[1])
+            (xy[:, 1] > ref_x[0])
+            & (xy[:, 1] < ref_x[1])
+            & (xy[:, 2] > ref_y[0])
+            & (xy[:, 2] < ref_y[1])
         )[0]
 
     else:
@@ -6960,48 +8650,34 @@ def ps_setref(ps: Optional[dotdict] = None) -> Array:
         ref_lat = np.fromstring(getparm("ref_lat"), sep=" ")
         ref_centre_lonlat = np.fromstring(getparm("ref_centre_lonlat"), sep=" ")
         ref_radius = float(getparm("ref_radius"))
+        ref_nearest = int(getparm("ref_nearest"))
 
-        print(f"{ref_lon = }")
-        print(f"{ref_lat = }")
-        print(f"{ref_centre_lonlat = }")
-        print(f"{ref_radius = }")
+        log(f"{ref_lon = }")
+        log(f"{ref_lat = }")
+        log(f"{ref_centre_lonlat = }")
+        log(f"{ref_radius = }")
+        log(f"{ref_nearest = }")
 
         if ref_radius == -np.inf:
             ref_ps = np.array([0])
 
         else:
-            ref_ps = np.where(
-                (ps["lonlat"][:, 0] > ref_lon[0])
-                & (ps["lonlat"][:, 0] < ref_lon[1])
-                & (ps["lonlat"][:, 1] > ref_lat[0])
-                & (ps["lonlat"][:, 1] < ref_lat[1])
-            )[0]
-
-            print("test",ref_lon[0])
-
-            if ref_radius < np.inf:
-                ref_centre_lonlat = np.reshape(ref_centre_lonlat, (-1, 1))
-                ps["ll0"] = np.reshape(ps["ll0"], (-1, 1))
-                ref_xy = llh2local(ref_centre_lonlat, ps["ll0"]) * 1000
-                xy = llh2local(ps["lonlat"][ref_ps, :].T, ps["ll0"]) * 1000
-                dist_sq = (xy[0, :] - ref_xy[0]) ** 2 + (xy[1, :] - ref_xy[1]) ** 2
-                ref_ps = ref_ps[dist_sq <= ref_radius**2]
-                print(ref_ps)
-
-    if len(ref_ps) == 0:
-        if ps is not None:
-            log(
-                "None of your external data points have a reference, all are set as reference."
+            ref_ps = ps_select(
+                index,
+                lon=ref_lon,
+                lat=ref_lat,
+                centre_lonlat=ref_centre_lonlat,
+                radius=ref_radius,
+                k=ref_nearest,
             )
-            ref_ps = np.arange(ps.n_ps)
 
-    if ps is None:
-        if ref_ps == 0:
-            log("No reference set")
-        else:
-            log(f"{len(ref_ps)} ref PS selected")
+    if len(ref_ps) == 0:
+        log(
+            "None of your external data points have a reference, all are set as reference."
+        )
+        ref_ps = np.arange(n_ps)
 
-    #log(f"Reference PS: {ref_ps}")
+    log(f"{len(ref_ps)} ref PS selected")
 
     return ref_ps
 
@@ -7040,6 +8716,193 @@ def lscov(A: Array, B: Array, w: Array) -> Array:
     return np.array(x)
 
 
+def lscov_batch(A: Array, B: Array, V: Optional[Array] = None) -> dotdict:
+    """
+    Generalised least-squares fit of A*x = B for every column of B, with the
+    standard errors of the solutions and the RMS of the residuals.
+
+    The observations have covariance V, so the design matrix is whitened by
+    the Cholesky factor of V and factorised (QR) once. Columns of B with NaN
+    values are grouped by their pattern of NaNs; each group drops those
+    observations and is solved with its own single factorisation. As in
+    MATLAB's lscov, the standard errors are scaled by the a posteriori
+    variance factor of each column (and are NaN without redundancy).
+
+    Parameters:
+    A : ndarray
+        A 2-D array with shape (m, n), where m is the number of observations
+        and n is the number of variables.
+    B : ndarray
+        A 2-D array with shape (m, k), where k is the number of response
+        variables (e.g., PS).
+    V : ndarray
+        The covariance of the observations with shape (m, m), or their
+        variances with shape (m,). Defaults to the identity.
+
+    Returns:
+    A dotdict with
+    x : ndarray
+        The solutions with shape (n, k).
+    x_std : ndarray
+        The standard errors of the solutions with shape (n, k).
+    rms : ndarray
+        The RMS of the (unweighted) residuals with shape (k,).
+    """
+
+    from scipy.linalg import cholesky, solve_triangular
+
+    n_obs, n_var = A.shape
+    n_col = B.shape[1]
+
+    if V is None:
+        V = np.eye(n_obs)
+    elif V.ndim == 1:
+        V = np.diag(V)
+
+    x = np.full((n_var, n_col), np.nan)
+    x_std = np.full((n_var, n_col), np.nan)
+    rms = np.full(n_col, np.nan)
+
+    nan_mask = np.isnan(B)
+    patterns, group = np.unique(
+        np.packbits(nan_mask, axis=0).T, axis=0, return_inverse=True
+    )
+    group = group.ravel()
+
+    for g in range(len(patterns)):
+        cols = np.flatnonzero(group == g)
+        obs = ~nan_mask[:, cols[0]]
+        n_used = np.count_nonzero(obs)
+
+        if n_used < n_var:
+            continue
+
+        L = cholesky(V[np.ix_(obs, obs)], lower=True)
+        Aw = solve_triangular(L, A[obs], lower=True)
+        Bw = solve_triangular(L, B[np.ix_(obs, cols)], lower=True)
+        Q, R = np.linalg.qr(Aw)
+
+        xg = solve_triangular(R, Q.T @ Bw)
+        x[:, cols] = xg
+
+        res = B[np.ix_(obs, cols)] - A[obs] @ xg
+        rms[cols] = np.sqrt(np.mean(res**2, axis=0))
+
+        dof = n_used - n_var
+        if dof > 0:
+            mse = np.sum((Bw - Aw @ xg) ** 2, axis=0) / dof
+            R_inv = solve_triangular(R, np.eye(n_var))
+            var_unit = np.sum(R_inv**2, axis=1)
+            x_std[:, cols] = np.sqrt(var_unit[:, np.newaxis] * mse)
+
+    return dotdict(x=x, x_std=x_std, rms=rms)
+
+
+def lscov_l1(
+    A: Array,
+    B: Array,
+    x0: Optional[Array] = None,
+    tol: float = 1e-6,
+    max_iter: int = 50,
+    block: int = 10000,
+) -> Tuple[Array, int]:
+    """
+    Solves A*x = B in the L1 sense for every column of B, by iteratively
+    reweighted least squares.
+
+    Each iteration weights the observations by the inverse of their absolute
+    residuals and solves the small weighted normal equations of all columns
+    in a block at once. A block stops iterating once none of its solutions
+    changes by more than `tol` (relative to its size). NaN observations are
+    ignored.
+
+    Parameters:
+    A : ndarray
+        A 2-D array with shape (m, n), where m is the number of observations
+        and n is the number of variables.
+    B : ndarray
+        A 2-D array with shape (m, k), where k is the number of response
+        variables (e.g., PS).
+    x0 : ndarray
+        Starting solutions with shape (n, k), e.g. from `lscov`.
+    tol : float
+        Convergence tolerance on the change of the solutions.
+    max_iter : int
+        Maximum number of iterations of a block.
+    block : int
+        Number of columns of B solved together.
+
+    Returns:
+    x : ndarray
+        The solutions with shape (n, k).
+    n_not_converged : int
+        The number of columns that had not converged after `max_iter`.
+    """
+
+    n_obs, n_var = A.shape
+    n_col = B.shape[1]
+
+    if x0 is None:
+        x0 = np.linalg.lstsq(A, np.nan_to_num(B), rcond=None)[0]
+
+    x = np.array(x0, dtype=np.float64).reshape(n_var, n_col)
+    n_not_converged = 0
+
+    def solve_normal(AtWA: Array, AtWb: Array) -> Array:
+        """Solve a stack of normal equations, in closed form for two
+        variables and with the pseudo-inverse where they are singular."""
+        if n_var == 2:
+            a, b_, d = AtWA[:, 0, 0], AtWA[:, 0, 1], AtWA[:, 1, 1]
+            det = a * d - b_**2
+            ok = np.abs(det) > 1e-12 * np.maximum(a * d, 1e-300)
+            sol = np.empty_like(AtWb)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sol[:, 0] = (d * AtWb[:, 0] - b_ * AtWb[:, 1]) / det
+                sol[:, 1] = (a * AtWb[:, 1] - b_ * AtWb[:, 0]) / det
+            if not np.all(ok):
+                sol[~ok] = (np.linalg.pinv(AtWA[~ok]) @ AtWb[~ok, :, None])[:, :, 0]
+            return sol
+        return (np.linalg.pinv(AtWA) @ AtWb[:, :, np.newaxis])[:, :, 0]
+
+    # Products of all pairs of columns of A, so the normal equations of all
+    # columns of B are a single matrix product
+    AA = (A[:, :, np.newaxis] * A[:, np.newaxis, :]).reshape(n_obs, n_var * n_var)
+
+    for start in range(0, n_col, block):
+        stop = min(start + block, n_col)
+
+        valid = np.isfinite(B[:, start:stop])
+        b = np.where(valid, B[:, start:stop], 0)
+        xb = x[:, start:stop].T  # (n_block, n_var)
+
+        # Columns that are still being iterated
+        active = np.arange(stop - start)
+
+        for _ in range(max_iter):
+            res = b[:, active] - A @ xb[active].T
+            w = valid[:, active] / np.maximum(
+                np.abs(res), 1e-8 * (1 + np.abs(b[:, active]))
+            )
+
+            # Weighted normal equations of every active column
+            AtWA = (w.T @ AA).reshape(-1, n_var, n_var)
+            AtWb = (w * b[:, active]).T @ A
+            x_new = solve_normal(AtWA, AtWb)
+
+            change = np.max(np.abs(x_new - xb[active]), axis=1)
+            scale = 1 + np.max(np.abs(x_new), axis=1)
+            xb[active] = x_new
+
+            active = active[change > tol * scale]
+            if len(active) == 0:
+                break
+
+        n_not_converged += len(active)
+        x[:, start:stop] = xb.T
+
+    return x, n_not_converged
+
+
 def ts_export_csv() -> None:
     """
     Export time series data to CSV files.
@@ -7125,7 +8988,7 @@ def ts_export_csv() -> None:
 
     phuw = stamps_load(phuwname)
     ph_all = phuw["ph_uw"]
-    ph_all = ps_deramp(ps, ph_all)
+    ph_all, _ = ps_deramp(ps, ph_all)
     u_o = ph_all
 
     phuw = stamps_load(phuwname)
@@ -7135,7 +8998,7 @@ def ts_export_csv() -> None:
     scla["ph_scla"]=np.delete(scla["ph_scla"], 0,1)
 
     ph_all = phuw["ph_uw"] - scla["C_ps_uw"][:, np.newaxis] - scla["ph_scla"]
-    ph_all = ps_deramp(ps, ph_all)
+    ph_all, _ = ps_deramp(ps, ph_all)
 
     ph_all = np.array(ph_all)
     ph_all[:, master_ix - 1] = 0
@@ -7370,6 +9233,320 @@ def test_uw_interp() -> None:
             assert results_equal("uw_interp", tol=1e-2)
 
 
+def benchmark_unwrap(
+    sizes: Tuple[int, ...] = (100, 300, 1000),
+    seed: int = 0,
+    sigsq: int = 400,
+    model_noise: float = 0.2,
+) -> None:
+    """Compare the in-process minimum-cost flow solver against Snaphu on
+    synthetic square grids, up to the size of a stage 6 resampling grid. Each
+    grid holds a smooth phase surface with gradients of up to about half a
+    cycle, and the cost offsets come from a version of the true gradients
+    with `model_noise` cycles of noise, as they would from the space-time
+    smoothing in `uw_stat_costs`. Reports the number of residues the offsets
+    leave for the solvers to resolve. Without a Snaphu executable only the
+    in-process solver is timed.
+
+    With Snaphu 2.0.7 both solvers unwrapped every grid correctly, and the
+    in-process solver took 1.4, 3.0 and 3.9 times as long as Snaphu on the
+    100, 300 and 1000 pixel grids (12.5 s against 3.2 s for the largest)."""
+
+    import tempfile
+
+    log("Benchmarking unwrap solvers")
+
+    nshortcycle = 200
+    rng = np.random.default_rng(seed)
+
+    table: Dict[str, list] = {
+        "size": [],
+        "residues": [],
+        "solver": [],
+        "time [s]": [],
+        "correct": [],
+    }
+
+    for n in sizes:
+        y, x = np.mgrid[:n, :n]
+        truth = (
+            4 * np.sin(2 * np.pi * x / n) * np.cos(2 * np.pi * y / n)
+            + 0.3 * y
+            + 0.08 * x
+            + rng.normal(0, 0.1, (n, n))
+        )
+        ifgw = np.exp(2j * np.pi * truth).astype(np.complex64)
+
+        grad_v = np.angle(ifgw[1:, :] * np.conj(ifgw[:-1, :])) / (2 * np.pi)
+        grad_h = np.angle(ifgw[:, 1:] * np.conj(ifgw[:, :-1])) / (2 * np.pi)
+        model_v = np.diff(truth, axis=0) + rng.normal(0, model_noise, (n - 1, n))
+        model_h = np.diff(truth, axis=1) + rng.normal(0, model_noise, (n, n - 1))
+
+        rowcost = np.zeros((n - 1, n * 4), dtype=np.int16)
+        colcost = np.zeros((n, (n - 1) * 4), dtype=np.int16)
+        rowcost[:, 0::4] = -np.round((grad_v - model_v) * nshortcycle)
+        colcost[:, 0::4] = np.round((grad_h - model_h) * nshortcycle)
+        rowcost[:, 1::4] = sigsq
+        colcost[:, 1::4] = sigsq
+        rowcost[:, 2::4] = 32000
+        colcost[:, 2::4] = 32000
+        rowcost[:, 3::4] = -32000  # no cost shelf
+        colcost[:, 3::4] = -32000
+
+        # Residues left after correcting each gradient towards the model
+        corr_v = grad_v + np.round(model_v - grad_v)
+        corr_h = grad_h + np.round(model_h - grad_h)
+        n_residue = int(
+            np.sum(
+                np.abs(
+                    np.round(corr_h[:-1] + corr_v[:, 1:] - corr_h[1:] - corr_v[:, :-1])
+                )
+            )
+        )
+
+        def correct(ifguw: Array) -> float:
+            diff = ifguw / (2 * np.pi) - truth
+            diff -= np.round(np.median(diff))
+            return float(np.mean(np.abs(diff) < 1e-3))
+
+        t0 = time.perf_counter()
+        ifguw = mcf_unwrap(ifgw, rowcost, colcost, nshortcycle)
+        table["size"].append(f"{n}x{n}")
+        table["residues"].append(n_residue)
+        table["solver"].append("mcf")
+        table["time [s]"].append(time.perf_counter() - t0)
+        table["correct"].append(correct(ifguw))
+
+        with tempfile.TemporaryDirectory(dir=".") as tmp:
+            workdir = Path(tmp)
+            with open(workdir / "snaphu.conf", "w") as fid:
+                fid.write("INFILE  snaphu.in\n")
+                fid.write("OUTFILE snaphu.out\n")
+                fid.write("COSTINFILE snaphu.costinfile\n")
+                fid.write("STATCOSTMODE  DEFO\n")
+                fid.write("INFILEFORMAT  COMPLEX_DATA\n")
+                fid.write("OUTFILEFORMAT FLOAT_DATA\n")
+            with open(workdir / "snaphu.costinfile", "wb") as fid:
+                rowcost.tofile(fid)
+                colcost.tofile(fid)
+            ifgw.tofile(workdir / "snaphu.in")
+
+            t0 = time.perf_counter()
+            try:
+                run_snaphu_on(Path("snaphu.conf"), n, workdir)
+                ifguw = np.fromfile(workdir / "snaphu.out", dtype=np.float32)
+            except OSError as e:
+                log(f"Snaphu could not be run, not compared: {e}")
+                continue
+            table["size"].append(f"{n}x{n}")
+            table["residues"].append(n_residue)
+            table["solver"].append("snaphu")
+            table["time [s]"].append(time.perf_counter() - t0)
+            table["correct"].append(correct(ifguw.reshape(n, n)))
+
+    tabulate(table, precision=3)
+
+
+def benchmark_storage(n_ps: int = 200000, n_ifg: int = 30, seed: int = 0) -> None:
+    """Compare the compression codecs of `stamps_save` on synthetic PS phase:
+    a smooth deformation signal with noise, stored as complex64 phase and as
+    float32 unwrapped phase. Reports the compression ratio, the save and load
+    throughputs and the time to read a contiguous 1% of the rows."""
+
+    import tempfile
+
+    log("Benchmarking storage codecs")
+
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 20000, (n_ps, 2))
+    signal = np.sin(xy[:, :1] / 3000) * np.cos(xy[:, 1:] / 5000) * np.arange(n_ifg)
+    ph_uw = (signal + rng.normal(0, 0.3, (n_ps, n_ifg))).astype(np.float32)
+    ph = np.exp(1j * ph_uw).astype(np.complex64)
+    rows = slice(n_ps // 2, n_ps // 2 + n_ps // 100)
+    nbytes = ph.nbytes + ph_uw.nbytes
+
+    table: Dict[str, list] = {
+        "codec": [],
+        "ratio": [],
+        "save [MB/s]": [],
+        "load [MB/s]": [],
+        "1% rows [s]": [],
+    }
+
+    saved_codec = OPTIONS.get("store_compression")
+    try:
+        for codec in ["none", "zlib", "lzma", "bz2"]:
+            OPTIONS["store_compression"] = codec
+
+            with tempfile.TemporaryDirectory(dir=".") as tmp:
+                fn = str(Path(tmp) / "ph")
+
+                t0 = time.perf_counter()
+                stamps_save(fn, ph=ph, ph_uw=ph_uw)
+                t_save = time.perf_counter() - t0
+
+                stored = sum(f.stat().st_size for f in Path(f"{fn}.stamps").iterdir())
+
+                t0 = time.perf_counter()
+                data = stamps_load(fn)
+                assert isinstance(data, dotdict)
+                np.asarray(data.ph).sum()
+                np.asarray(data.ph_uw).sum()
+                t_load = time.perf_counter() - t0
+                del data
+
+                t0 = time.perf_counter()
+                stamps_load_rows(fn, "ph", rows)
+                t_rows = time.perf_counter() - t0
+
+            table["codec"].append(codec)
+            table["ratio"].append(nbytes / stored)
+            table["save [MB/s]"].append(nbytes / 2**20 / t_save)
+            table["load [MB/s]"].append(nbytes / 2**20 / t_load)
+            table["1% rows [s]"].append(t_rows)
+    finally:
+        if saved_codec is None:
+            OPTIONS.pop("store_compression", None)
+        else:
+            OPTIONS["store_compression"] = saved_codec
+
+    tabulate(table, precision=3)
+
+
+def benchmark_storage_layouts(
+    n_ps: int = 200000, n_ifg: int = 60, n_readers: int = 8, seed: int = 0
+) -> None:
+    """Compare the layouts of `stamps_save` (option `store_format`) for typical
+    access patterns on synthetic float32 unwrapped phase: a full load, a
+    contiguous 1% of the PS, a single interferogram, 1% of the PS in four
+    interferograms, and `n_readers` threads each reading a different 1% of
+    the PS at the same time. Reports the times in seconds."""
+
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    log("Benchmarking storage layouts")
+
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 20000, (n_ps, 2))
+    signal = np.sin(xy[:, :1] / 3000) * np.cos(xy[:, 1:] / 5000) * np.arange(n_ifg)
+    ph_uw = (signal + rng.normal(0, 0.3, (n_ps, n_ifg))).astype(np.float32)
+
+    step = n_ps // 100
+    rows = slice(n_ps // 2, n_ps // 2 + step)
+    cols = np.array([0, n_ifg // 3, 2 * n_ifg // 3, n_ifg - 1])
+
+    def read_rows(fn: str, i: int) -> Array:
+        return stamps_load_rows(fn, "ph_uw", slice(i * step, (i + 1) * step))
+
+    table: Dict[str, list] = {
+        "layout": [],
+        "save [s]": [],
+        "load [s]": [],
+        "1% PS [s]": [],
+        "1 ifg [s]": [],
+        "1% PS x 4 ifg [s]": [],
+        f"{n_readers} readers [s]": [],
+    }
+
+    saved_layout = OPTIONS.get("store_format")
+    try:
+        for layout in ["npz", "npy", "chunked"]:
+            OPTIONS["store_format"] = layout
+
+            with tempfile.TemporaryDirectory(dir=".") as tmp:
+                fn = str(Path(tmp) / "ph")
+                times = []
+
+                t0 = time.perf_counter()
+                stamps_save(fn, ph_uw=ph_uw)
+                times.append(time.perf_counter() - t0)
+
+                t0 = time.perf_counter()
+                np.asarray(stamps_load(fn)).sum()
+                times.append(time.perf_counter() - t0)
+
+                for r, c in [(rows, None), (slice(None), n_ifg // 2), (rows, cols)]:
+                    t0 = time.perf_counter()
+                    x = stamps_load_rows(fn, "ph_uw", r, c)
+                    times.append(time.perf_counter() - t0)
+                    assert np.array_equal(x, ph_uw[r] if c is None else ph_uw[r][:, c])
+
+                t0 = time.perf_counter()
+                with ThreadPoolExecutor(n_readers) as executor:
+                    list(executor.map(lambda i: read_rows(fn, i), range(n_readers)))
+                times.append(time.perf_counter() - t0)
+
+            table["layout"].append(layout)
+            for k, t in zip(list(table)[1:], times):
+                table[k].append(t)
+    finally:
+        if saved_layout is None:
+            OPTIONS.pop("store_format", None)
+        else:
+            OPTIONS["store_format"] = saved_layout
+
+    tabulate(table, precision=4)
+
+
+def test_ps_select() -> None:
+    log("Testing ps_select")
+    rng = np.random.default_rng(0)
+    ll0 = np.array([-175.179, -21.145])
+    lonlat = ll0 + rng.uniform(-0.05, 0.05, (2000, 2))
+    xy = ps_local_xy(lonlat, ll0)
+    index = dotdict(xy=xy, lonlat=lonlat, ll0=ll0, tree=KDTree(xy))
+
+    def brute_force(lon: Array, lat: Array) -> Array:
+        return np.where(
+            (lonlat[:, 0] > lon[0])
+            & (lonlat[:, 0] < lon[1])
+            & (lonlat[:, 1] > lat[0])
+            & (lonlat[:, 1] < lat[1])
+        )[0]
+
+    for lon, lat in [
+        (np.array([-175.189, -175.169]), np.array([-21.155, -21.135])),
+        (np.array([-175.23, -175.13]), np.array([-21.195, -21.095])),
+        (np.array([-np.inf, np.inf]), np.array([-np.inf, np.inf])),
+        (np.array([-np.inf, -175.18]), np.array([-21.15, np.inf])),
+    ]:
+        assert np.array_equal(ps_select(index, lon=lon, lat=lat), brute_force(lon, lat))
+
+    # A centre with an infinite radius does not restrict the box
+    lon = np.array([-np.inf, np.inf])
+    lat = np.array([-np.inf, np.inf])
+    ref_ps = ps_select(index, lon=lon, lat=lat, centre_lonlat=ll0, radius=np.inf)
+    assert np.array_equal(ref_ps, np.arange(len(lonlat)))
+
+
+def test_ps_mean_velocity() -> None:
+    log("Testing ps_mean_velocity")
+    rng = np.random.default_rng(0)
+    n_ps, n_ifg, master_ix = 50, 12, 4
+    day = np.sort(rng.uniform(0, 2000, n_ifg))
+    ifg_index = np.setdiff1d(np.arange(n_ifg), master_ix)
+
+    # Distinct variances, so a shifted lookup gives different weights. The
+    # master and one other interferogram have no noise estimate.
+    ifg_std = rng.uniform(5, 60, n_ifg)
+    ifg_std[[master_ix, 9]] = 0
+    ifg_vcm = np.diag((ifg_std * np.pi / 180) ** 2)
+    ph_uw = rng.normal(0, 1, (n_ps, n_ifg)) * (ifg_std * np.pi / 180)
+    ph_uw += np.outer(rng.normal(0, 0.01, n_ps), day - day[master_ix])
+
+    G = np.column_stack((np.ones(len(ifg_index)), day[ifg_index] - day[master_ix]))
+    mv = ps_mean_velocity(G, ph_uw, ifg_vcm, ifg_index)
+
+    # Weighted fit of each PS over the interferograms with a noise estimate,
+    # each weighted with the variance of its own column
+    use = ifg_index[ifg_std[ifg_index] > 0]
+    w = 1 / np.sqrt(np.diag(ifg_vcm)[use])
+    A = np.column_stack((np.ones(len(use)), day[use] - day[master_ix]))
+    x = np.linalg.lstsq(A * w[:, np.newaxis], (ph_uw[:, use] * w).T, rcond=None)[0]
+    assert np.allclose(mv.x, x * 56 / (-4) / np.pi)
+
+
 def test_interp() -> None:
     log("Testing interp function 1")
     x = np.arange(1, 10, dtype=np.float64)
@@ -7448,6 +9625,8 @@ def test_params() -> None:
 
 def run_tests() -> None:
     test_params()
+    test_ps_select()
+    test_ps_mean_velocity()
     test_dates()
     test_interp()
     test_stage1()
@@ -7461,6 +9640,209 @@ def run_tests() -> None:
     log("\nAll tests passed!\n")
 
 
+def run_benchmarks() -> None:
+    benchmark_unwrap()
+    benchmark_storage()
+    benchmark_storage_layouts()
+
+
+def stage_record_input(name: str, digest: Callable[[], str]) -> None:
+    """Record an input of the running stage, with the hash of its content as
+    given by `digest()`, unless it was already read or written by the stage."""
+
+    if STAGE_RECORD is None:
+        return
+
+    if name not in STAGE_RECORD["inputs"] and name not in STAGE_RECORD["outputs"]:
+        STAGE_RECORD["inputs"][name] = digest()
+
+
+def stage_input_file(f: Path | str) -> None:
+    """Record a file (other than a data file) read by the running stage, by
+    its size and modification time."""
+
+    if STAGE_RECORD is not None:
+        name = f"file:{os.path.normpath(str(f))}"
+        stage_record_input(name, lambda: file_state(f))
+
+
+def stage_input_program(cmd: Path | str) -> None:
+    """Record an external program run by the running stage."""
+
+    if STAGE_RECORD is not None:
+        stage_record_input(f"program:{cmd}", lambda: program_hash(cmd))
+
+
+class stage_opts(dotdict):
+    """
+    The options passed to a running stage, as a dotdict that records every
+    field the stage reads (see `stage_begin`).
+    """
+
+    @no_type_check
+    def __getattr__(self, x):
+        return self.get(x)
+
+    @no_type_check
+    def __getitem__(self, x):
+        value = dict.__getitem__(self, x)
+        if STAGE_RECORD is not None:
+            STAGE_RECORD["opts"].setdefault(x, str(value))
+        return value
+
+    @no_type_check
+    def get(self, x, default=None):
+        if x in self:
+            return self[x]
+        if STAGE_RECORD is not None:
+            STAGE_RECORD["opts"].setdefault(x, None)
+        return default
+
+
+def code_version() -> str:
+    """Hash of the source code of this program."""
+
+    return file_hash(Path(__file__))
+
+
+def stage_current_hash(name: str) -> str:
+    """Current hash of a recorded stage input or output."""
+
+    if name.startswith("file:"):
+        return file_state(name[len("file:") :])
+
+    if name.startswith("program:"):
+        return program_hash(name[len("program:") :])
+
+    return stamps_hash(name)
+
+
+def stage_files() -> Dict[str, Tuple[int, int]]:
+    """Modification time and size of the plain files in the current
+    directory, to find the files written by a stage."""
+
+    return {
+        f.name: (f.stat().st_mtime_ns, f.stat().st_size)
+        for f in Path(".").iterdir()
+        if f.is_file() and not f.name.startswith(".stage") and f.suffix != ".log"
+    }
+
+
+def stage_begin(i: int) -> Dict[str, Tuple[int, int]]:
+    """
+    Start recording the data files, other files and options that stage `i`
+    reads and writes in the current (patch) directory. The record of a
+    previous run is removed, so an interrupted stage is never skipped.
+
+    Returns the state of the files in the directory before the stage.
+    """
+
+    global STAGE_RECORD
+
+    Path(f".stage{i}.json").unlink(missing_ok=True)
+
+    STAGE_RECORD = {
+        "inputs": {},
+        "options": {},
+        "opts": {},
+        "set_options": {},
+        "outputs": {},
+    }
+
+    return stage_files()
+
+
+def stage_end(i: int, files_before: Dict[str, Tuple[int, int]]) -> None:
+    """
+    Stop recording stage `i` and write its record to `.stage{i}.json`: the
+    code version, the hashes of its inputs and outputs, the options and
+    fields of `opts` it read and the options it set. Plain files that the
+    stage created or changed are recorded as outputs.
+    """
+
+    import json
+
+    global STAGE_RECORD
+
+    assert STAGE_RECORD is not None
+    record, STAGE_RECORD = STAGE_RECORD, None
+
+    for name, state in stage_files().items():
+        if files_before.get(name) != state:
+            record["outputs"][f"file:{name}"] = file_state(name)
+
+    record["code"] = code_version()
+
+    tmp = Path(f".stage{i}.json.tmp")
+    tmp.write_text(
+        json.dumps(
+            record,
+            indent=1,
+            default=lambda x: x.item() if hasattr(x, "item") else str(x),
+        )
+    )
+    tmp.replace(f".stage{i}.json")
+
+
+def stage_abort() -> None:
+    """Stop recording a stage that failed, without writing its record."""
+
+    global STAGE_RECORD
+
+    STAGE_RECORD = None
+
+
+def stage_is_current(i: int, opts: dotdict = dotdict()) -> bool:
+    """
+    Check whether the last run of stage `i` in the current (patch) directory
+    is still valid, like `make` would: the code, the options the stage read
+    (including those from the parameter files) and the fields of `opts` it
+    read are unchanged, all its inputs, including the external programs it
+    ran, still have the same content, and all its outputs still exist
+    unchanged. Plain files are compared by size and modification time, data
+    files by the hash in their manifest. Inputs that the stage itself
+    rewrote are compared with their state after the stage.
+
+    If so, the options that the stage set are set again, as if it had run.
+    """
+
+    import json
+
+    f = Path(f".stage{i}.json")
+
+    if not f.exists():
+        return False
+
+    record = json.loads(f.read_text())
+
+    if record["code"] != code_version():
+        return False
+
+    for name, value in record["options"].items():
+        if (str(OPTIONS[name]) if name in OPTIONS else None) != value:
+            return False
+
+    if "opts" not in record:
+        return False
+
+    for name, value in record["opts"].items():
+        if (str(opts[name]) if name in opts else None) != value:
+            return False
+
+    for name, digest in record["inputs"].items():
+        if name not in record["outputs"] and stage_current_hash(name) != digest:
+            return False
+
+    for name, digest in record["outputs"].items():
+        if stage_current_hash(name) != digest:
+            return False
+
+    for name, value in record["set_options"].items():
+        OPTIONS[name] = value
+
+    return True
+
+
 def run_all_stages(opts: dotdict = dotdict()) -> None:
     """Run all stages."""
     for i in range(8):
@@ -7475,23 +9857,38 @@ def run_stage(i: int, opts: dotdict = dotdict()) -> None:
         log(f"Running stage {i} in {cwd}")
         stage0_preprocess(opts=opts)
     else:
+        skip_unchanged = str(OPTIONS.get("skip_unchanged_stages", "n")) == "y"
+
         for p in patchdirs():
-            log(f"Running stage {i} in {p}")
             with chdir(p):
-                if i == 1:
-                    stage1_load_data(opts=opts)
-                elif i == 2:
-                    stage2_estimate_noise(opts=opts)
-                elif i == 3:
-                    stage3_select_ps(opts=opts)
-                elif i == 4:
-                    stage4_weed_ps(opts=opts)
-                elif i == 5:
-                    stage5_correct_phases(opts=opts)
-                elif i == 6:
-                    stage6_unwrap_phases(opts=opts)
-                elif i == 7:
-                    stage7_calc_scla(opts=opts)
+                if skip_unchanged and stage_is_current(i, opts):
+                    log(f"Skipping stage {i} in {p}, nothing has changed since its last run")
+                    continue
+
+                log(f"Running stage {i} in {p}")
+                files_before = stage_begin(i)
+                opts_read = stage_opts(opts)
+
+                try:
+                    if i == 1:
+                        stage1_load_data(opts=opts_read)
+                    elif i == 2:
+                        stage2_estimate_noise(opts=opts_read)
+                    elif i == 3:
+                        stage3_select_ps(opts=opts_read)
+                    elif i == 4:
+                        stage4_weed_ps(opts=opts_read)
+                    elif i == 5:
+                        stage5_correct_phases(opts=opts_read)
+                    elif i == 6:
+                        stage6_unwrap_phases(opts=opts_read)
+                    elif i == 7:
+                        stage7_calc_scla(opts=opts_read)
+                except BaseException:
+                    stage_abort()
+                    raise
+
+                stage_end(i, files_before)
 
     log(f"\nStage {i} complete!\n")
 
@@ -7742,6 +10139,7 @@ def print_all_parameters(file: TextIO = sys.stdout) -> None:
     get_and_print("clap_low_pass_wavelength")
     get_and_print("clap_win")
     get_and_print("density_rand")
+    get_and_print("deramp_grid_size")
     get_and_print("drop_ifg_index")
     get_and_print("filter_grid_size")
     get_and_print("filter_weighting")
@@ -7754,6 +10152,7 @@ def print_all_parameters(file: TextIO = sys.stdout) -> None:
     get_and_print("ref_centre_lonlat")
     get_and_print("ref_lat")
     get_and_print("ref_lon")
+    get_and_print("ref_nearest")
     get_and_print("ref_radius")
     get_and_print("ref_x")
     get_and_print("ref_y")
@@ -7762,9 +10161,19 @@ def print_all_parameters(file: TextIO = sys.stdout) -> None:
     get_and_print("scla_drop_index")
     get_and_print("scla_method")
     get_and_print("select_method")
+    get_and_print("skip_unchanged_stages")
     get_and_print("slc_osf")
     get_and_print("small_baseline_flag")
+    get_and_print("snaphu_nproc")
+    get_and_print("snaphu_ntilecol")
+    get_and_print("snaphu_ntilerow")
+    get_and_print("snaphu_tile_overlap")
+    get_and_print("snaphu_workers")
+    get_and_print("store_cache_mb")
+    get_and_print("store_compression")
+    get_and_print("store_format")
     get_and_print("subtr_tropo")
+    get_and_print("triangulation_method")
     get_and_print("tropo_method")
     get_and_print("unwrap_gold_alpha")
     get_and_print("unwrap_gold_n_win")
@@ -7774,11 +10183,13 @@ def print_all_parameters(file: TextIO = sys.stdout) -> None:
     get_and_print("unwrap_method")
     get_and_print("unwrap_patch_phase")
     get_and_print("unwrap_prefilter_flag")
+    get_and_print("unwrap_solver")
     get_and_print("unwrap_spatial_cost_func_flag")
     get_and_print("unwrap_time_win")
     get_and_print("weed_max_noise")
     get_and_print("weed_neighbours")
     get_and_print("weed_standard_dev")
+    get_and_print("weed_streaming")
     get_and_print("weed_time_win")
     get_and_print("weed_zero_elevation")
 
@@ -7849,6 +10260,9 @@ def cli() -> None:
         "-d", "--debug", action="store_true", help="Enable debug outputs"
     )
     parser.add_argument("--test", action="store_true", help="Run the tests")
+    parser.add_argument(
+        "--benchmark", action="store_true", help="Run the benchmarks"
+    )
     parser.add_argument(
         "--check", action="store_true", help="Check against MATLAB outputs"
     )
@@ -7920,6 +10334,10 @@ def cli() -> None:
         if args.test:
             run_tests()
 
+        if args.benchmark:
+            run_benchmarks()
+            sys.exit(0)
+
         if args.check:
             check_results()
             sys.exit(0)
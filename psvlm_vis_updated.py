@@ -24,34 +24,9 @@ from pathlib import Path
 from typing import TextIO, Any, Dict, Tuple, Optional, List, no_type_check
 from numpy.typing import NDArray as Array
 
-
-class dotdict(dict):
-    """
-    A dictionary that allows access to its keys as attributes.
-
-    This gives MATLAB style dot access to dictionary keys. For example, instead
-    of `d['key']` you can use `d.key`. All dict-style data loaded from the
-    StaMPS files using `stamps_load` will be stored in this type of dictionary.
-    """
-
-    @no_type_check
-    def __getattr__(self, x):
-        return dict.get(self, x)
-
-    @no_type_check
-    def __setattr__(self, x):
-        return dict.__setitem__(self, x)
-
-    @no_type_check
-    def __getstate__(self) -> dict:
-        return self.__dict__
-
-    @no_type_check
-    def __setstate__(self, d: dict) -> None:
-        self.__dict__.update(d)
-
-    __delattr__ = dict.__delitem__  # type: ignore
-    __dir__ = dict.keys  # type: ignore
+# Data files are read with the loader of the pipeline, which understands its
+# store directories as well as legacy .npz files
+from psvlm_updated import dotdict, stamps_load
 
 
 def log(msg: str) -> None:
@@ -116,57 +91,6 @@ def datestr(
 
     return ds
 
-def stamps_save(
-    fn: str, *args: Optional[Array | dict], **kwargs: Optional[Any]
-) -> None:
-    """Save a data file with the given name."""
-
-    assert not fn.endswith(".mat")
-    assert not fn.endswith(".pkl")
-
-    if fn.endswith(".npz"):
-        f = Path(fn)
-    else:
-        f = Path(f"{fn}.npz")
-
-    if len(args) > 0 and isinstance(args[0], np.ndarray):
-        np.savez(f, args[0])
-    else:
-        np.savez(f, **dotdict(kwargs))
-
-
-def stamps_load(fn: str, squeeze: bool = True) -> dotdict | Array:
-    """Load a data file with the given name."""
-
-    assert not fn.endswith(".mat")
-    assert not fn.endswith(".pkl")
-
-    if fn.endswith(".npz"):
-        f = Path(fn)
-    else:
-        f = Path(f"{fn}.npz")
-
-    data = np.load(f, allow_pickle=True)  # FIXME: allow_pickle=False?
-
-    assert hasattr(data, "files")
-
-    if len(data.files) == 1:
-        if squeeze:
-            arr = data[data.files[0]]
-            assert isinstance(arr, np.ndarray)
-            return arr
-        else:
-            dn = "".join(x for x in fn if not x.isdigit())
-            return dotdict({dn: data[data.files[0]]})
-
-    dic = {}
-    for k in data.files:
-        if hasattr(data[k], "shape") and data[k].shape == ():
-            dic[k] = data[k].item()
-        else:
-            dic[k] = data[k]
-    return dotdict(dic)
-    
 
 def patchdirs() -> List[Path]:
     """Get the patch directories."""